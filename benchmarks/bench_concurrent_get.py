@@ -0,0 +1,76 @@
+"""Throughput of messages.get from worker threads sharing one MessageClient
+
+The client runs on the fake gmail backend with a simulated network latency
+and the per-user rate limit of gmail, so throughput should grow with the
+number of workers until it reaches the quota ceiling. Run from the
+repository root:
+
+    python benchmarks/bench_concurrent_get.py
+
+"""
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from momomail.gmail.ratelimit import (  # noqa: E402
+    USER_UNITS_PER_SECOND,
+    RateLimiter,
+    quota_units,
+)
+from momomail.gmail.retry import RetryPolicy  # noqa: E402
+from momomail.gmail.testing import (  # noqa: E402
+    FakeGmailHttp,
+    make_message,
+    make_session,
+)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    http = FakeGmailHttp()
+    ids = [f"{i:016x}" for i in range(args.requests)]
+    for id in ids:
+        http.add_message(make_message(id, subject=id))
+    http.latency = args.latency
+    # No burst, so every level is measured at the sustained rate
+    session = make_session(
+        http,
+        rate_limiter=RateLimiter(USER_UNITS_PER_SECOND, burst=5),
+        retry_policy=RetryPolicy(),
+    )
+    client = session.messages()
+
+    results = []
+    for workers in args.workers:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(client.get, ids))
+        seconds = time.perf_counter() - start
+        results.append(
+            {
+                "workers": workers,
+                "seconds": round(seconds, 3),
+                "gets_per_second": round(len(ids) / seconds, 1),
+            }
+        )
+    ceiling = USER_UNITS_PER_SECOND / quota_units("gmail.users.messages.get")
+    print(
+        json.dumps(
+            {"latency": args.latency, "quota_ceiling": ceiling, "results": results},
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
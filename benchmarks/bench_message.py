@@ -0,0 +1,122 @@
+"""Per-message memory and header access time of Message
+
+Compares the previous Message, which scanned payload.headers on every access
+and kept the whole payload alive, with the current one. Run from the
+repository root:
+
+    python benchmarks/bench_message.py
+
+"""
+import json
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from momomail.gmail.message import Message  # noqa: E402
+from momomail.gmail.testing import make_message  # noqa: E402
+
+COUNT = 20000
+EXTRA_HEADERS = [
+    "Delivered-To",
+    "Received",
+    "X-Received",
+    "ARC-Seal",
+    "ARC-Message-Signature",
+    "ARC-Authentication-Results",
+    "Return-Path",
+    "Received-SPF",
+    "Authentication-Results",
+    "DKIM-Signature",
+    "MIME-Version",
+    "Message-ID",
+    "Content-Type",
+]
+
+
+class LegacyMessage:
+    """The access pattern of Message before the header index"""
+
+    def __init__(self, raw_data: dict, client) -> None:
+        self.raw_data = raw_data
+        self.client = client
+
+    def _header(self, name: str) -> str:
+        for header in self.raw_data["payload"]["headers"]:
+            if header["name"] == name:
+                return str(header["value"])
+        return ""
+
+    @property
+    def subject(self) -> str:
+        return self._header("Subject")
+
+    @property
+    def date(self) -> str:
+        return self._header("Date")
+
+    @property
+    def from_(self) -> str:
+        return self._header("From")
+
+    @property
+    def to(self) -> str:
+        return self._header("To")
+
+
+def raw_message(i: int) -> dict:
+    message = make_message(f"{i:016x}", subject=f"subject {i}", body="x" * 2000)
+    # Real messages carry many transport headers before the ones we read
+    extra = [{"name": name, "value": f"{name} value {i}" * 4} for name in EXTRA_HEADERS]
+    message["payload"]["headers"] = extra + message["payload"]["headers"]
+    return message
+
+
+def measure_memory(build) -> float:
+    """Bytes retained per message"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    messages = [build(raw_message(i)) for i in range(COUNT)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del messages
+    return (after - before) / COUNT
+
+
+def measure_access(messages) -> float:
+    """Nanoseconds per header access, four headers per message, three passes"""
+    start = time.perf_counter()
+    for _ in range(3):
+        for message in messages:
+            message.subject, message.date, message.from_, message.to
+    return (time.perf_counter() - start) / (COUNT * 12) * 1e9
+
+
+def compact(raw_data: dict) -> Message:
+    message = Message(raw_data, None)
+    message.release_payload()
+    return message
+
+
+def main() -> dict:
+    legacy = [LegacyMessage(raw_message(i), None) for i in range(COUNT)]
+    current = [Message(raw_message(i), None) for i in range(COUNT)]
+    results = {
+        "count": COUNT,
+        "before": {
+            "bytes_per_message": measure_memory(lambda raw: LegacyMessage(raw, None)),
+            "ns_per_header": measure_access(legacy),
+        },
+        "after": {
+            "bytes_per_message": measure_memory(compact),
+            "ns_per_header": measure_access(current),
+        },
+    }
+    print(json.dumps(results, indent=2))
+    return results
+
+
+if __name__ == "__main__":
+    main()
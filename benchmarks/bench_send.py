@@ -0,0 +1,77 @@
+"""Peak memory of sending a message with a large attachment
+
+Compares MessageClient.send, which streams the message through a spooled
+temporary file and the resumable upload, with building the whole message and
+its base64 encoding in memory. 25 MB is the largest attachment gmail accepts,
+about 34 MB once encoded. The fake gmail backend keeps the bytes it receives,
+so one copy of the message is part of every peak. Run from the
+repository root:
+
+    python benchmarks/bench_send.py
+
+"""
+import argparse
+import json
+import sys
+import tempfile
+import tracemalloc
+from base64 import urlsafe_b64encode
+from email.message import EmailMessage
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from momomail.gmail.testing import FakeGmailHttp, make_session  # noqa: E402
+
+
+def send_in_memory(client, path: Path) -> None:
+    """How send worked before: every copy of the message is in memory at once"""
+    message = EmailMessage()
+    message.set_content("report attached")
+    message["To"] = "a@example.com"
+    message["Subject"] = "report"
+    message.add_attachment(path.read_bytes(), "application", "pdf", filename=path.name)
+    raw = urlsafe_b64encode(message.as_bytes()).decode()
+    client.client.send(userId="me", body={"raw": raw}).execute()
+
+
+def send_streaming(client, path: Path) -> None:
+    client.send(
+        "a@example.com",
+        subject="report",
+        content="report attached",
+        attachment_path=str(path),
+    )
+
+
+def measure(send, path: Path) -> float:
+    client = make_session(FakeGmailHttp()).messages()
+    tracemalloc.start()
+    send(client, path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1024**2
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--size-mb", type=int, default=25)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "report.pdf"
+        with open(path, "wb") as f:
+            for _ in range(args.size_mb):
+                f.write(bytes(range(256)) * 4096)
+        results = {
+            name: round(measure(send, path), 1)
+            for name, send in (
+                ("in_memory_peak_mb", send_in_memory),
+                ("streaming_peak_mb", send_streaming),
+            )
+        }
+    print(json.dumps({"attachment_mb": args.size_mb, **results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
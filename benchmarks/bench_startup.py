@@ -0,0 +1,73 @@
+"""Cold start time: import time and time to the first request
+
+Each sample runs in a fresh interpreter, so nothing is imported or cached
+beforehand. The first request is served by the fake gmail backend, so the
+numbers leave out the network and only measure the library. Run from the
+repository root:
+
+    python benchmarks/bench_startup.py
+
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+SAMPLE = """
+import json
+import time
+
+start = time.perf_counter()
+from momomail.gmail.client import GmailSession
+from momomail.gmail.message import MessageClient
+imported = time.perf_counter()
+
+from momomail.gmail.testing import FakeGmailHttp, make_message, make_session
+
+http = FakeGmailHttp()
+http.add_message(make_message("0000000000000001", subject="hi"))
+ready = time.perf_counter()
+
+MessageClient(session=make_session(http)).get("0000000000000001")
+first_request = time.perf_counter()
+
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "first_request_ms": (first_request - ready) * 1000,
+}))
+"""
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--samples", type=int, default=5)
+    args = parser.parse_args()
+
+    samples = []
+    for _ in range(args.samples):
+        output = subprocess.run(
+            [sys.executable, "-c", SAMPLE],
+            cwd=ROOT,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        samples.append(json.loads(output))
+
+    print(
+        json.dumps(
+            {
+                key: round(statistics.median(sample[key] for sample in samples), 1)
+                for key in ("import_ms", "first_request_ms")
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
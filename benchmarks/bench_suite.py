@@ -0,0 +1,232 @@
+"""Offline benchmark suite of the hot paths of momomail
+
+Every benchmark runs on the fake gmail backend, filled with a generated
+mailbox of realistic MIME trees, with a simulated network latency and a rate
+of quota errors. The mailbox and the errors come from a seed, so two runs do
+the same work and can be compared. Results are printed as JSON:
+
+    python benchmarks/bench_suite.py --output before.json
+    python benchmarks/bench_suite.py --compare before.json
+
+With --compare, benchmarks slower than the previous result by more than the
+threshold, or making more requests not counting retries, are listed and the exit status is 1.
+
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from momomail.gmail.metrics import HistogramSink  # noqa: E402
+from momomail.gmail.testing import (  # noqa: E402
+    FakeGmailHttp,
+    fill_mailbox,
+    make_session,
+)
+
+
+class Env:
+    """The fake backend, its session and the generated mailbox"""
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.http = FakeGmailHttp()
+        self.ids = fill_mailbox(
+            self.http,
+            args.messages,
+            seed=args.seed,
+            max_attachment_size=args.max_attachment_size,
+        )
+        self.label_names = [
+            label["name"] for label in self.http.labels if label["type"] == "user"
+        ]
+        self.session = make_session(self.http)
+        self.histogram = HistogramSink()
+        self.session.instrumentation.add_sink(self.histogram)
+        self.messages = self.session.messages()
+        self.labels = self.session.labels()
+        # Fetched once, the decoding benchmarks do not measure the fetch
+        self.fetched = self.messages.get_many(self.ids).results
+
+
+def bench_list_paging(env: Env) -> int:
+    """Page through the whole mailbox, 100 ids per page"""
+    return sum(1 for _ in env.messages.iter_messages(page_size=100))
+
+
+def bench_get(env: Env) -> int:
+    """One messages.get per message"""
+    ids = env.ids[: env.args.gets]
+    for id in ids:
+        env.messages.get(id)
+    return len(ids)
+
+
+def bench_get_many(env: Env) -> int:
+    """Every message in batch requests"""
+    return len(env.messages.get_many(env.ids).results)
+
+
+def bench_parts(env: Env) -> int:
+    """Walk the parts of every message and decode the text ones"""
+    for message in env.fetched:
+        for part in message.parts:
+            if part.type != "attachment":
+                part.data
+    return len(env.fetched)
+
+
+def bench_dump(env: Env) -> int:
+    """Dump messages with their attachments to disk"""
+    messages = env.fetched[: env.args.dumps]
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            for index, message in enumerate(messages):
+                # Messages of the same subject and day dump to the same name
+                path = Path(directory) / str(index)
+                path.mkdir()
+                os.chdir(path)
+                message.dump()
+        finally:
+            os.chdir(cwd)
+    return len(messages)
+
+
+def bench_batch_labels(env: Env) -> int:
+    """Add a label by name to every message and remove it"""
+    name = env.label_names[0]
+    env.messages.batch_modify(
+        env.ids, add_label_ids=[name], remove_label_ids=["UNREAD"]
+    )
+    env.messages.batch_modify(env.ids, remove_label_ids=[name])
+    return 2 * len(env.ids)
+
+
+def bench_label_lookups(env: Env) -> int:
+    """Label names to ids, and the label listings of LabelClient"""
+    index = env.labels.index
+    names = env.label_names
+    for _ in range(env.args.lookups // len(names)):
+        index.resolve(names)
+        env.labels.labels
+        env.labels.available_label_ids
+    return env.args.lookups // len(names) * len(names)
+
+
+BENCHMARKS: Dict[str, Callable[[Env], int]] = {
+    "list_paging": bench_list_paging,
+    "get": bench_get,
+    "get_many": bench_get_many,
+    "parts": bench_parts,
+    "dump": bench_dump,
+    "batch_labels": bench_batch_labels,
+    "label_lookups": bench_label_lookups,
+}
+
+
+def run(env: Env, bench: Callable[[Env], int], repeat: int) -> dict:
+    samples = []
+    round_trips = env.http.round_trips
+    env.histogram.methods.clear()
+    for _ in range(repeat):
+        # Every repetition meets the same quota errors
+        env.http.random.seed(env.args.seed)
+        start = time.perf_counter()
+        ops = bench(env)
+        samples.append(time.perf_counter() - start)
+    totals = env.histogram.snapshot().values()
+    seconds = statistics.median(samples)
+    return {
+        "ops": ops,
+        "seconds": round(seconds, 6),
+        "min_seconds": round(min(samples), 6),
+        "ops_per_second": round(ops / seconds, 1) if seconds else None,
+        # Per repetition
+        "round_trips": (env.http.round_trips - round_trips) // repeat,
+        "requests": sum(t["count"] for t in totals) // repeat,
+        "retries": sum(t["retries"] for t in totals) // repeat,
+        "errors": sum(t["errors"] for t in totals) // repeat,
+        "quota_units": sum(t["quota_units"] for t in totals) // repeat,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> List[str]:
+    """Benchmarks which got slower or chattier than the baseline"""
+    regressions = []
+    for name, result in results["benchmarks"].items():
+        before = baseline["benchmarks"].get(name)
+        if before is None:
+            continue
+        ratio = result["seconds"] / before["seconds"] if before["seconds"] else 1.0
+        if ratio > 1 + threshold:
+            regressions.append(f"{name}: {ratio:.2f}x the time of the baseline")
+        # Retries depend on which requests met the quota errors
+        requests = result["requests"] - result["retries"]
+        requests_before = before["requests"] - before["retries"]
+        if requests > requests_before:
+            regressions.append(
+                f"{name}: {requests} requests without the retries, "
+                f"{requests_before} in the baseline"
+            )
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-attachment-size", type=int, default=200_000)
+    parser.add_argument("--latency", type=float, default=0.002)
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    parser.add_argument("--gets", type=int, default=100)
+    parser.add_argument("--dumps", type=int, default=50)
+    parser.add_argument("--lookups", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--only", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS)
+    )
+    parser.add_argument("--output", help="Also write the results to this file")
+    parser.add_argument("--compare", help="Results of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    env = Env(args)
+    env.http.latency = args.latency
+    env.http.error_rate = args.error_rate
+    results = {
+        "config": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("only", "output", "compare", "threshold")
+        },
+        "python": platform.python_version(),
+        "benchmarks": {
+            name: run(env, BENCHMARKS[name], args.repeat) for name in args.only
+        },
+    }
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        if baseline["config"] != results["config"]:
+            print("Warning: the baseline was run with other options", file=sys.stderr)
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
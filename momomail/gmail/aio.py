@@ -0,0 +1,726 @@
+"""asyncio clients
+
+The async clients build their requests with the same googleapiclient service
+as the blocking clients, then send them through an async transport instead of
+calling `.execute()`. Requests go through the rate limiter and retry policy of
+the session and at most `max_in_flight` of them are sent at the same time, so
+thousands of calls can overlap on one event loop.
+
+    session = GmailSession.setup()
+    async with AsyncMessageClient(session=session) as client:
+        async for ref in client.iter_messages(search_string="from:bank"):
+            message = await client.get(ref["id"])
+
+The default transport needs aiohttp: `pip install momomail[async]`.
+
+The Message and Thread objects returned by the async clients are the same
+as those of the blocking clients. Their methods which send requests, like
+message.modify(), trash(), part.save(), part.data of an attachment and the
+same methods of Thread, call `.execute()` and block the event loop.
+Do not call them from a coroutine; use the methods of the async client
+instead, e.g. `await client.modify(message.id, ...)` and
+`await client.get_attachment(message.id, part.attachment_id)`, or run them
+with asyncio.to_thread.
+"""
+import asyncio
+import time
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from tempfile import SpooledTemporaryFile
+from typing import Any, AsyncIterator, Iterable, List, Optional, Tuple
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from .batch import MAX_BULK_IDS, BatchResult, BulkResult, chunked
+from .client import MAX_PAGE_SIZE, GmailClient, build_query_string
+from .exceptions import LabelNotAvailableError, LabelNotFoundError
+from .labelindex import SYSTEM_LABEL_IDS
+from .message import RESUMABLE_THRESHOLD, UPLOAD_CHUNK_SIZE, Message, MessageClient
+from .metrics import RequestEvent
+from .mime import Attachment, write_mime
+from .ratelimit import quota_units
+from .retry import error_reason
+from .thread import Thread
+
+
+class AiohttpTransport:
+    """Async transport on aiohttp
+
+    Arguments:
+        limit (int): Max open connections.
+    """
+
+    def __init__(self, limit: int = 100) -> None:
+        try:
+            import aiohttp
+        except ImportError as error:
+            raise ImportError(
+                "AiohttpTransport needs aiohttp. Install it with pip install momomail[async]."
+            ) from error
+        self._aiohttp = aiohttp
+        self.limit = limit
+        self._session = None
+
+    async def request(
+        self, method: str, uri: str, body=None, headers: Optional[dict] = None
+    ) -> Tuple[int, dict, bytes]:
+        if self._session is None:
+            self._session = self._aiohttp.ClientSession(
+                connector=self._aiohttp.TCPConnector(limit=self.limit)
+            )
+        async with self._session.request(
+            method, uri, data=body, headers=headers
+        ) as response:
+            return response.status, dict(response.headers), await response.read()
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncGmailClient(GmailClient):
+    """Base of the async clients
+
+    Arguments:
+        client_secret, refresh_token, session: Same as GmailClient.
+        transport: Object with `async request(method, uri, body, headers) -> (status, headers, content)`.
+            Default is an AiohttpTransport.
+        max_in_flight (int): Max requests sent at the same time.
+    """
+
+    def __init__(
+        self,
+        client_secret: Optional[dict] = None,
+        refresh_token: Optional[str] = None,
+        transport=None,
+        max_in_flight: int = 100,
+        **kwargs,
+    ) -> None:
+        super().__init__(client_secret, refresh_token, **kwargs)
+        self.transport = transport or AiohttpTransport(limit=max_in_flight)
+        self.max_in_flight = max_in_flight
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._refresh_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        await self.transport.close()
+
+    async def execute(self, request) -> Any:
+        """Send a request built by the service and return its deserialized response"""
+        policy = self.retry_policy
+        policy.deposit()
+        units = quota_units(request.methodId)
+        attempt = 1
+        delay = 0.0
+        refreshed = False
+        while True:
+            # Every attempt uses quota, retries included
+            wait = self.rate_limiter.reserve(units) if self.rate_limiter else 0.0
+            if wait > 0:
+                await asyncio.sleep(wait)
+            async with self._semaphore:
+                headers = await self._authorize(dict(request.headers))
+                start = time.perf_counter()
+                status, response_headers, content = await self.transport.request(
+                    request.method, request.uri, request.body, headers
+                )
+                seconds = time.perf_counter() - start
+            response = httplib2.Response({**response_headers, "status": str(status)})
+            error = None
+            if status >= 300:
+                error = HttpError(response, content, uri=request.uri)
+            if self.instrumentation:
+                self.instrumentation.emit(
+                    RequestEvent(
+                        method=request.methodId,
+                        status=status,
+                        seconds=seconds,
+                        bytes_sent=len(request.body or ""),
+                        bytes_received=len(content),
+                        quota_units=units,
+                        attempt=attempt,
+                        error=error and (error_reason(error) or str(status)),
+                    )
+                )
+            if error is None:
+                return request.postproc(response, content)
+            if status == 401 and self.credentials is not None and not refreshed:
+                # The token was revoked or expired early
+                await self._refresh(force=True)
+                refreshed = True
+                continue
+            if policy is None or not policy.should_retry(error, attempt):
+                raise error
+            delay = policy.next_delay(delay, error)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _authorize(self, headers: dict) -> dict:
+        if self.credentials is None:
+            return headers
+        if not self.credentials.valid:
+            await self._refresh()
+        self.credentials.apply(headers)
+        return headers
+
+    async def _refresh(self, force: bool = False) -> None:
+        """Refresh the token in a worker thread, once for all waiting requests"""
+        token = self.credentials.token
+        async with self._refresh_lock:
+            if self.credentials.token != token or (
+                not force and self.credentials.valid
+            ):
+                return
+            from google_auth_httplib2 import Request
+
+            await asyncio.to_thread(self.credentials.refresh, Request(httplib2.Http()))
+
+    async def _resolve(self, names: Optional[Iterable[str]]) -> Optional[List[str]]:
+        """Label names to ids, listing the labels without blocking when needed"""
+        if names is None:
+            return None
+        index = self.label_index
+        names = list(names)
+        # System label ids are used without a lookup
+        listed = index.stale and not SYSTEM_LABEL_IDS.issuperset(names)
+        if listed:
+            await self._load_labels()
+        try:
+            return index.resolve(names, refresh=False)
+        except LabelNotFoundError:
+            if listed:
+                raise
+        # Might have been created since the labels were listed
+        await self._load_labels()
+        return index.resolve(names, refresh=False)
+
+    async def _load_labels(self) -> None:
+        result = await self.execute(self.service.users().labels().list(userId="me"))
+        self.label_index.load(result.get("labels", []))
+
+    async def _aiter_list(
+        self,
+        key: str,
+        query_string: str = "",
+        include_spam_trash: bool = False,
+        page_token: Optional[str] = None,
+        limit: Optional[int] = None,
+        page_size: int = MAX_PAGE_SIZE,
+    ) -> AsyncIterator[dict]:
+        """Async version of GmailClient._iter_list"""
+        count = 0
+        while limit is None or count < limit:
+            max_results = page_size if limit is None else min(page_size, limit - count)
+            result = await self.execute(
+                self.client.list(
+                    userId="me",
+                    q=query_string or None,
+                    pageToken=page_token,
+                    maxResults=max_results,
+                    includeSpamTrash=include_spam_trash,
+                )
+            )
+            items = result.get(key, [])
+            count += len(items)
+            for item in items:
+                yield item
+            page_token = result.get("nextPageToken")
+            if not page_token:
+                return
+
+    async def _list(
+        self,
+        key: str,
+        query_string: str = "",
+        include_spam_trash: bool = False,
+        page_token: Optional[str] = None,
+        exhausted: bool = False,
+    ) -> dict:
+        """Async version of the list methods of the blocking clients"""
+        if exhausted:
+            items = [
+                item
+                async for item in self._aiter_list(
+                    key,
+                    query_string=query_string,
+                    include_spam_trash=include_spam_trash,
+                    page_token=page_token,
+                )
+            ]
+            return {key: items, "nextPageToken": ""}
+        result = await self.execute(
+            self.client.list(
+                userId="me",
+                q=query_string or None,
+                pageToken=page_token,
+                includeSpamTrash=include_spam_trash,
+            )
+        )
+        result.pop("resultSizeEstimate", None)
+        return result
+
+    async def _gather(self, ids: Iterable[str], fetch) -> BatchResult:
+        """Run fetch(id) for every id at once. Failed ids are reported in errors."""
+        ids = list(dict.fromkeys(ids))
+        outcomes = await asyncio.gather(
+            *(fetch(id) for id in ids), return_exceptions=True
+        )
+        result = BatchResult()
+        for id, outcome in zip(ids, outcomes):
+            if isinstance(outcome, HttpError):
+                result.errors[id] = outcome
+            elif isinstance(outcome, BaseException):
+                raise outcome
+            else:
+                result.results.append(outcome)
+        return result
+
+    async def _modify_body(
+        self,
+        add_label_ids: Optional[List[str]],
+        remove_label_ids: Optional[List[str]],
+    ) -> dict:
+        body = {}
+        if add_label_ids:
+            body["addLabelIds"] = await self._resolve(add_label_ids)
+        if remove_label_ids:
+            body["removeLabelIds"] = await self._resolve(remove_label_ids)
+        return body
+
+
+class AsyncMessageClient(AsyncGmailClient):
+    """Async version of MessageClient
+
+    The returned Message objects block when their methods send requests, see
+    the module docstring.
+    """
+
+    def __init__(
+        self,
+        client_secret: Optional[dict] = None,
+        refresh_token: Optional[str] = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(client_secret, refresh_token, **kwargs)
+        self.client = self.service.users().messages()
+
+    async def get(
+        self,
+        id: str,
+        format: str = "full",
+        metadata_headers: Optional[List[str]] = None,
+        fields: Optional[str] = None,
+    ) -> Message:
+        """Get a message. Arguments are the same as MessageClient.get."""
+        message = await self.execute(
+            self.client.get(**self._get_params(id, format, metadata_headers, fields))
+        )
+        return Message(
+            raw_data=message,
+            client=self.client,
+            metadata_headers=metadata_headers,
+            label_index=self.label_index,
+        )
+
+    async def get_many(
+        self,
+        ids: Iterable[str],
+        format: str = "full",
+        metadata_headers: Optional[List[str]] = None,
+        fields: Optional[str] = None,
+    ) -> BatchResult:
+        """Get many messages at once, up to max_in_flight requests at a time
+
+        Returns:
+            A BatchResult. results is a list of Message in the same order as ids,
+            errors maps the id of each failed message to its HttpError.
+        """
+        return await self._gather(
+            ids, lambda id: self.get(id, format, metadata_headers, fields)
+        )
+
+    async def list(
+        self,
+        search_string: Optional[str] = None,
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        read: Optional[bool] = None,
+        from_: Optional[str] = None,
+        to: Optional[str] = None,
+        include_spam_trash: bool = False,
+        page_token: Optional[str] = None,
+        exhausted: bool = False,
+    ) -> dict:
+        """List messages. Arguments and result are the same as MessageClient.list."""
+        query_string = build_query_string(
+            search_string=search_string,
+            before=before,
+            after=after,
+            read=read,
+            from_=from_,
+            to=to,
+        )
+        return await self._list(
+            "messages", query_string, include_spam_trash, page_token, exhausted
+        )
+
+    def iter_messages(
+        self,
+        search_string: Optional[str] = None,
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        read: Optional[bool] = None,
+        from_: Optional[str] = None,
+        to: Optional[str] = None,
+        include_spam_trash: bool = False,
+        page_token: Optional[str] = None,
+        limit: Optional[int] = None,
+        page_size: int = MAX_PAGE_SIZE,
+    ) -> AsyncIterator[dict]:
+        """Async iterator over message ids. Arguments are the same as MessageClient.iter_messages."""
+        query_string = build_query_string(
+            search_string=search_string,
+            before=before,
+            after=after,
+            read=read,
+            from_=from_,
+            to=to,
+        )
+        return self._aiter_list(
+            "messages",
+            query_string=query_string,
+            include_spam_trash=include_spam_trash,
+            page_token=page_token,
+            limit=limit,
+            page_size=page_size,
+        )
+
+    async def modify(
+        self,
+        id: str,
+        add_label_ids: Optional[List[str]] = None,
+        remove_label_ids: Optional[List[str]] = None,
+    ) -> None:
+        """Modify the labels of a message. Label names are accepted as well as ids."""
+        body = await self._modify_body(add_label_ids, remove_label_ids)
+        await self.execute(self.client.modify(userId="me", id=id, body=body))
+
+    async def trash(self, id: str) -> None:
+        await self.execute(self.client.trash(userId="me", id=id))
+
+    async def untrash(self, id: str) -> None:
+        await self.execute(self.client.untrash(userId="me", id=id))
+
+    async def delete(self, id: str) -> None:
+        await self.execute(self.client.delete(userId="me", id=id))
+
+    async def get_attachment(self, message_id: str, attachment_id: str) -> bytes:
+        """Download and decode an attachment of a message"""
+        attachment = await self.execute(
+            self.client.attachments().get(
+                userId="me", messageId=message_id, id=attachment_id
+            )
+        )
+        return urlsafe_b64decode(attachment.get("data", ""))
+
+    async def send(
+        self,
+        to: str,
+        cc: Optional[str] = None,
+        subject: str = "",
+        content: str = "",
+        attachment_path: Optional[str] = None,
+        attachments: Optional[Iterable[Attachment]] = None,
+        from_: Optional[str] = None,
+        headers: Optional[dict] = None,
+        resumable_threshold: int = RESUMABLE_THRESHOLD,
+        chunk_size: int = UPLOAD_CHUNK_SIZE,
+    ) -> dict:
+        """Send a message. Arguments and result are the same as MessageClient.send.
+
+        The message is written to the spooled file in a worker thread, since
+        attachments are read from disk. Messages up to resumable_threshold
+        bytes are sent through the async transport. Larger ones are uploaded
+        in chunks by MessageClient.send_mime in a worker thread, as the
+        resumable upload of googleapiclient has no async version.
+        """
+        if attachment_path is not None:
+            attachments = [attachment_path, *(attachments or [])]
+        spool = SpooledTemporaryFile(max_size=resumable_threshold)
+        try:
+            size = await asyncio.to_thread(
+                write_mime,
+                spool,
+                to=to,
+                subject=subject,
+                content=content,
+                cc=cc,
+                from_=from_,
+                attachments=attachments,
+                headers=headers,
+            )
+            spool.seek(0)
+            if size > resumable_threshold:
+                return await asyncio.to_thread(
+                    MessageClient(session=self.session).send_mime,
+                    spool,
+                    size,
+                    resumable_threshold,
+                    chunk_size,
+                )
+            raw = urlsafe_b64encode(spool.read()).decode()
+            return await self.execute(self.client.send(userId="me", body={"raw": raw}))
+        finally:
+            spool.close()
+
+    async def batch_modify(
+        self,
+        ids: Iterable[str],
+        add_label_ids: Optional[List[str]] = None,
+        remove_label_ids: Optional[List[str]] = None,
+        chunk_size: int = MAX_BULK_IDS,
+    ) -> BulkResult:
+        """Modify the labels of any number of messages, 1000 ids per request"""
+        body = await self._modify_body(add_label_ids, remove_label_ids)
+        return await self._bulk(
+            ids,
+            lambda chunk: self.client.batchModify(
+                userId="me", body={"ids": chunk, **body}
+            ),
+            chunk_size,
+        )
+
+    async def batch_trash(self, ids: Iterable[str], **kwargs) -> BulkResult:
+        return await self.batch_modify(ids, add_label_ids=["TRASH"], **kwargs)
+
+    async def batch_untrash(self, ids: Iterable[str], **kwargs) -> BulkResult:
+        return await self.batch_modify(ids, remove_label_ids=["TRASH"], **kwargs)
+
+    async def batch_delete(
+        self, ids: Iterable[str], chunk_size: int = MAX_BULK_IDS
+    ) -> BulkResult:
+        """Permanently delete any number of messages, 1000 ids per request"""
+        return await self._bulk(
+            ids,
+            lambda chunk: self.client.batchDelete(userId="me", body={"ids": chunk}),
+            chunk_size,
+        )
+
+    async def _bulk(self, ids: Iterable[str], build_request, chunk_size: int):
+        chunks = list(chunked(dict.fromkeys(ids), chunk_size))
+        outcomes = await asyncio.gather(
+            *(self.execute(build_request(chunk)) for chunk in chunks),
+            return_exceptions=True,
+        )
+        result = BulkResult()
+        for chunk, outcome in zip(chunks, outcomes):
+            if isinstance(outcome, HttpError):
+                result.failed.update(dict.fromkeys(chunk, outcome))
+            elif isinstance(outcome, BaseException):
+                raise outcome
+            else:
+                result.succeeded.extend(chunk)
+        return result
+
+
+class AsyncThreadClient(AsyncGmailClient):
+    """Async version of ThreadClient
+
+    The returned Thread objects and their messages block when their methods
+    send requests, see the module docstring.
+    """
+
+    def __init__(
+        self,
+        client_secret: Optional[dict] = None,
+        refresh_token: Optional[str] = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(client_secret, refresh_token, **kwargs)
+        self.client = self.service.users().threads()
+        self.message_client = self.service.users().messages()
+
+    async def get(
+        self,
+        id: str,
+        format: str = "full",
+        metadata_headers: Optional[List[str]] = None,
+        fields: Optional[str] = None,
+    ) -> Thread:
+        """Get a thread. Arguments are the same as ThreadClient.get."""
+        if format == "raw":
+            raise ValueError("threads.get does not support the raw format.")
+        thread = await self.execute(
+            self.client.get(**self._get_params(id, format, metadata_headers, fields))
+        )
+        return Thread(
+            raw_data=thread,
+            client=self.client,
+            message_client=self.message_client,
+            metadata_headers=metadata_headers,
+            label_index=self.label_index,
+        )
+
+    async def get_many(
+        self,
+        ids: Iterable[str],
+        format: str = "full",
+        metadata_headers: Optional[List[str]] = None,
+        fields: Optional[str] = None,
+    ) -> BatchResult:
+        """Get many threads at once, up to max_in_flight requests at a time"""
+        return await self._gather(
+            ids, lambda id: self.get(id, format, metadata_headers, fields)
+        )
+
+    async def list(
+        self,
+        search_string: Optional[str] = None,
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        read: Optional[bool] = None,
+        from_: Optional[str] = None,
+        to: Optional[str] = None,
+        include_spam_trash: bool = False,
+        page_token: Optional[str] = None,
+        exhausted: bool = False,
+    ) -> dict:
+        """List threads. Arguments and result are the same as ThreadClient.list."""
+        query_string = build_query_string(
+            search_string=search_string,
+            before=before,
+            after=after,
+            read=read,
+            from_=from_,
+            to=to,
+        )
+        return await self._list(
+            "threads", query_string, include_spam_trash, page_token, exhausted
+        )
+
+    def iter_threads(
+        self,
+        search_string: Optional[str] = None,
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        read: Optional[bool] = None,
+        from_: Optional[str] = None,
+        to: Optional[str] = None,
+        include_spam_trash: bool = False,
+        page_token: Optional[str] = None,
+        limit: Optional[int] = None,
+        page_size: int = MAX_PAGE_SIZE,
+    ) -> AsyncIterator[dict]:
+        """Async iterator over threads. Arguments are the same as ThreadClient.iter_threads."""
+        query_string = build_query_string(
+            search_string=search_string,
+            before=before,
+            after=after,
+            read=read,
+            from_=from_,
+            to=to,
+        )
+        return self._aiter_list(
+            "threads",
+            query_string=query_string,
+            include_spam_trash=include_spam_trash,
+            page_token=page_token,
+            limit=limit,
+            page_size=page_size,
+        )
+
+    async def modify(
+        self,
+        id: str,
+        add_label_ids: Optional[List[str]] = None,
+        remove_label_ids: Optional[List[str]] = None,
+    ) -> None:
+        """Modify the labels of a thread. Label names are accepted as well as ids."""
+        body = await self._modify_body(add_label_ids, remove_label_ids)
+        await self.execute(self.client.modify(userId="me", id=id, body=body))
+
+    async def trash(self, id: str) -> None:
+        await self.execute(self.client.trash(userId="me", id=id))
+
+    async def untrash(self, id: str) -> None:
+        await self.execute(self.client.untrash(userId="me", id=id))
+
+    async def delete(self, id: str) -> None:
+        await self.execute(self.client.delete(userId="me", id=id))
+
+
+class AsyncLabelClient(AsyncGmailClient):
+    """Async version of LabelClient. Writes keep the label index of the session up to date."""
+
+    def __init__(
+        self,
+        client_secret: Optional[dict] = None,
+        refresh_token: Optional[str] = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(client_secret, refresh_token, **kwargs)
+        self.client = self.service.users().labels()
+
+    async def list(self) -> List[dict]:
+        """Lists all labels in the user's mailbox."""
+        labels = (await self.execute(self.client.list(userId="me")))["labels"]
+        self.label_index.load(labels)
+        return labels
+
+    async def get(self, id: str) -> dict:
+        return await self.execute(self.client.get(userId="me", id=id))
+
+    async def create(
+        self,
+        name: str,
+        messageListVisibility: Optional[str] = None,
+        labelListVisibility: Optional[str] = None,
+        color: Optional[dict] = None,
+    ) -> dict:
+        """Creates a new label."""
+        from .label import LabelInput
+
+        data = LabelInput(
+            name=name,
+            messageListVisibility=messageListVisibility,
+            labelListVisibility=labelListVisibility,
+            color=color,
+        )
+        label = await self.execute(self.client.create(userId="me", body=data.dict()))
+        self.label_index.put(label)
+        return label
+
+    async def _check_available(self, id: str) -> None:
+        """Raise LabelNotAvailableError for system labels, like LabelClient
+
+        Listing the labels without blocking when the id is not loaded.
+        """
+        label = self.label_index.get(id, refresh=False)
+        if label is None:
+            await self.list()
+            label = self.label_index.get(id, refresh=False)
+        if label is None or label["type"] != "user":
+            raise LabelNotAvailableError(id)
+
+    async def patch(self, id: str, body: dict) -> dict:
+        await self._check_available(id)
+        label = await self.execute(self.client.patch(userId="me", id=id, body=body))
+        self.label_index.put(label)
+        return label
+
+    async def update(self, id: str, body: dict) -> dict:
+        await self._check_available(id)
+        label = await self.execute(self.client.update(userId="me", id=id, body=body))
+        self.label_index.put(label)
+        return label
+
+    async def delete(self, id: str) -> None:
+        await self.execute(self.client.delete(userId="me", id=id))
+        self.label_index.remove(id)
@@ -0,0 +1,256 @@
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Union,
+)
+
+from .client import GmailClient
+from .idset import IdSet
+from .ratelimit import quota_units
+
+if TYPE_CHECKING:
+    from googleapiclient.http import HttpRequest
+
+# Gmail accepts at most 100 calls in a single batch request.
+# Ref: https://developers.google.com/gmail/api/guides/batch
+MAX_BATCH_SIZE = 100
+
+# messages.batchModify and messages.batchDelete accept at most 1000 ids.
+MAX_BULK_IDS = 1000
+
+
+@dataclass
+class BatchResult:
+    """Result of a batched call
+
+    results (list): Successful responses, in the same order as the input keys.
+    errors (dict): Map from key to the exception raised by its sub-request.
+    """
+
+    results: List[Any] = field(default_factory=list)
+    errors: Dict[str, Exception] = field(default_factory=dict)
+
+
+@dataclass
+class BulkResult:
+    """Result of a bulk call split into chunks of ids
+
+    succeeded (list): Ids of the chunks which succeeded, in input order. An IdSet
+        when the ids were given as an IdSet.
+    failed (dict): Map from id to the exception raised by its chunk.
+    """
+
+    succeeded: Union[List[str], IdSet] = field(default_factory=list)
+    failed: Dict[str, Exception] = field(default_factory=dict)
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed
+
+
+def chunked(items: Iterable, size: int) -> Iterator[list]:
+    """Split an iterable into lists of at most `size` items."""
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def execute_batched(
+    client: GmailClient,
+    keys: Iterable[str],
+    build_request: Callable[[str], "HttpRequest"],
+    batch_size: int = MAX_BATCH_SIZE,
+    max_workers: int = 4,
+) -> BatchResult:
+    """Run one api call per key through Gmail batch HTTP requests
+
+    Keys are grouped into batches of `batch_size` sub-requests and up to
+    `max_workers` batches are sent at the same time. Duplicated keys are only
+    requested once. Sub-requests failed with retryable errors are retried on
+    their own by the client's retry policy.
+
+    Arguments:
+        client (GmailClient): The client which owns the service and credentials.
+        keys (Iterable[str]): Usually message ids or thread ids.
+        build_request (Callable): Build the HttpRequest for a key.
+            Ex. lambda id: messages.get(userId="me", id=id)
+        batch_size (int): Sub-requests per batch. Should not exceed MAX_BATCH_SIZE.
+        max_workers (int): Number of batches in flight.
+
+    Returns:
+        A BatchResult whose results are the deserialized responses in key order.
+
+    """
+    if not 0 < batch_size <= MAX_BATCH_SIZE:
+        raise ValueError(f"batch_size should be between 1 and {MAX_BATCH_SIZE}.")
+
+    keys = list(dict.fromkeys(keys))
+    responses: Dict[str, Any] = {}
+    errors: Dict[str, Exception] = {}
+
+    policy = client.retry_policy
+
+    def run(chunk: List[str]) -> None:
+        policy.deposit(len(chunk))
+        pending = chunk
+        attempt = 1
+        delay = 0.0
+        while pending:
+            failed: Dict[str, Exception] = {}
+
+            # (method, quota units) and outcome of each sub-request, for instrumentation
+            methods: List[tuple] = []
+            outcomes: Dict[int, Optional[Exception]] = {}
+
+            def callback(request_id: str, response: Any, exception: Exception) -> None:
+                outcomes[int(request_id)] = exception
+                key = pending[int(request_id)]
+                if exception is None:
+                    responses[key] = response
+                elif policy.should_retry(exception, attempt):
+                    failed[key] = exception
+                else:
+                    errors[key] = exception
+
+            batch = client.service.new_batch_http_request(callback=callback)
+            units = 0
+            for index, key in enumerate(pending):
+                request = build_request(key)
+                methods.append((request.methodId, quota_units(request.methodId)))
+                units += methods[-1][1]
+                batch.add(request, request_id=str(index))
+
+            def send() -> None:
+                # Every sub-request is charged its own cost
+                client.rate_limiter.acquire(units)
+                instrumentation = client.instrumentation
+                if not instrumentation:
+                    batch.execute(http=client.http)
+                    return
+                outcomes.clear()
+                start = time.perf_counter()
+                # The quota units are reported by the sub-requests
+                with instrumentation.measure(
+                    client.http, "batch", 0, attempt, batch_size=len(pending)
+                ) as recorder:
+                    batch.execute(http=recorder)
+                seconds = time.perf_counter() - start
+                for index, exception in sorted(outcomes.items()):
+                    method, method_units = methods[index]
+                    instrumentation.emit_sub_request(
+                        method, seconds, method_units, attempt, exception
+                    )
+
+            try:
+                policy.call(send)
+            except Exception as exc:
+                # The whole batch failed, e.g. a transport error.
+                # Report it on every key.
+                for key in pending:
+                    errors.setdefault(key, exc)
+                return
+
+            # Only the failed sub-requests are sent again
+            if failed:
+                delay = policy.next_delay(delay, *failed.values())
+                policy.sleep(delay)
+            pending = list(failed)
+            attempt += 1
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(run, chunked(keys, batch_size)))
+
+    return BatchResult(
+        results=[responses[key] for key in keys if key in responses],
+        errors=errors,
+    )
+
+
+def execute_chunked(
+    ids: Iterable[str],
+    build_request: Callable[[List[str]], "HttpRequest"],
+    chunk_size: int = MAX_BULK_IDS,
+    max_workers: int = 4,
+) -> BulkResult:
+    """Run a bulk api call over any number of ids
+
+    The ids, which may come from a generator, are split into chunks of
+    `chunk_size` and up to `max_workers` chunks are sent at the same time.
+    Duplicated ids are only sent once. Each chunk goes through the client's
+    rate limiter and is retried on its own, so one failed chunk does not fail
+    the others.
+
+    Arguments:
+        ids (Iterable[str]): Message ids, or an IdSet.
+        build_request (Callable): Build the HttpRequest for a chunk.
+            Ex. lambda ids: messages.batchDelete(userId="me", body={"ids": ids})
+        chunk_size (int): Ids per request. Should not exceed MAX_BULK_IDS.
+        max_workers (int): Number of requests in flight.
+
+    Returns:
+        A BulkResult telling which ids succeeded and which failed.
+
+    """
+    if not 0 < chunk_size <= MAX_BULK_IDS:
+        raise ValueError(f"chunk_size should be between 1 and {MAX_BULK_IDS}.")
+
+    # An IdSet is already unique, and sets or lists of its ids as str would
+    # defeat the point of it
+    compact = isinstance(ids, IdSet)
+    succeeded_set = IdSet()
+    seen = set()
+
+    def unique() -> Iterator[str]:
+        if compact:
+            yield from ids
+            return
+        for id in ids:
+            if id not in seen:
+                seen.add(id)
+                yield id
+
+    succeeded: Dict[int, List[str]] = {}
+    failed: Dict[str, Exception] = {}
+    lock = threading.Lock()
+
+    def run(index: int, chunk: List[str]) -> None:
+        try:
+            build_request(chunk).execute()
+        except Exception as exc:
+            with lock:
+                failed.update(dict.fromkeys(chunk, exc))
+        else:
+            with lock:
+                if compact:
+                    succeeded_set.update(chunk)
+                else:
+                    succeeded[index] = chunk
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Keep a bounded number of chunks queued, so a long generator is not read ahead
+        in_flight = set()
+        for index, chunk in enumerate(chunked(unique(), chunk_size)):
+            if len(in_flight) >= max_workers * 2:
+                _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            in_flight.add(executor.submit(run, index, chunk))
+
+    if compact:
+        return BulkResult(succeeded=succeeded_set, failed=failed)
+    return BulkResult(
+        succeeded=[id for index in sorted(succeeded) for id in succeeded[index]],
+        failed=failed,
+    )
@@ -1,16 +1,36 @@
+import hashlib
 import json
 import os
-from functools import lru_cache
+from datetime import datetime, timezone
+from functools import lru_cache, partial
+from typing import TYPE_CHECKING, Iterator, List, Optional, Tuple
 
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from .metrics import Instrumentation, default_instrumentation
+from .ratelimit import RateLimiter, default_rate_limiter
+from .retry import RetryPolicy, default_retry_policy
+
+# googleapiclient, google.auth and oauthlib take most of the import time, so
+# they are imported on first use. Importing a client module stays cheap for
+# short-lived jobs.
+if TYPE_CHECKING:
+    from googleapiclient.discovery import Resource
+
+    from .label import LabelClient
+    from .message import MessageClient
+    from .thread import ThreadClient
 
 
 # Can find the applicable api scope in the https://developers.google.com/identity/protocols/oauth2/scopes#gmail
 # Note: Please generate new refresh token if intending to use different scope
 SCOPES = ["https://mail.google.com/"]
 
+# The largest page size users.messages.list and users.threads.list accept.
+MAX_PAGE_SIZE = 500
+
+# Formats of messages.get and threads.get
+# Ref: https://developers.google.com/gmail/api/reference/rest/v1/Format
+FORMATS = ("minimal", "metadata", "full", "raw")
+
 
 @lru_cache
 def get_client_secret() -> dict:
@@ -23,8 +43,22 @@ def get_client_secret() -> dict:
     )
 
 
+@lru_cache
+def load_discovery_document() -> dict:
+    """Parse the gmail discovery document shipped with googleapiclient once per process
+
+    googleapiclient only fills in default parameters when it builds methods
+    from the document, so the parsed document can be shared by services.
+    """
+    from googleapiclient.discovery_cache import get_static_doc
+
+    return json.loads(get_static_doc("gmail", "v1"))
+
+
 def get_refresh_token() -> None:
     """Get refresh token for GmailClient"""
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
     flow = InstalledAppFlow.from_client_config(get_client_secret(), scopes=SCOPES)
     flow.redirect_uri = "urn:ietf:wg:oauth:2.0:oob"
     auth_url, _ = flow.authorization_url()
@@ -35,33 +69,321 @@ def get_refresh_token() -> None:
         json.dump({"refresh_token": flow.credentials.refresh_token}, f)
 
 
-class GmailClient:
-    def __init__(self, client_secret: dict, refresh_token: str) -> None:
-        # Try to get refresh token
-        if not os.path.isfile("refresh_token.json"):
-            get_refresh_token()
-        with open("refresh_token.json", "r") as f:
-            refresh_token = json.load(f)["refresh_token"]
-
-        credentials = Credentials(
-            None,
+def build_query_string(
+    search_string: Optional[str] = None,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    read: Optional[bool] = None,
+    from_: Optional[str] = None,
+    to: Optional[str] = None,
+) -> str:
+    """Create a gmail search query from arguments"""
+    criteria_list = []
+    if search_string is not None:
+        criteria_list.append(search_string)
+    if before is not None:
+        criteria_list.append(f"before:{before}")
+    if after is not None:
+        criteria_list.append(f"after:{after}")
+    if read is not None:
+        criteria_list.append(f"is:{'read' if read else 'unread'}")
+    if from_ is not None:
+        criteria_list.append(f"from:{from_}")
+    if to is not None:
+        criteria_list.append(f"to:{to}")
+    return " ".join(criteria_list)
+
+
+def load_refresh_token() -> str:
+    """Read refresh_token.json, running the oauth flow first if it does not exist"""
+    if not os.path.isfile("refresh_token.json"):
+        get_refresh_token()
+    with open("refresh_token.json", "r") as f:
+        return json.load(f)["refresh_token"]
+
+
+class TokenCache:
+    """Access tokens kept in a JSON file until they expire
+
+    Short-lived jobs can reuse the access token of a previous process instead
+    of refreshing one on their first request. Tokens are keyed by the client
+    id and a hash of the refresh token. The file is replaced atomically and is
+    only readable by its owner. When processes save at the same time one of
+    the entries may be lost, which only costs a refresh.
+
+    Arguments:
+        path (str): Path of the cache file.
+        margin (float): Tokens expiring within this many seconds are not loaded.
+    """
+
+    def __init__(self, path: str = "token_cache.json", margin: float = 60.0) -> None:
+        self.path = path
+        self.margin = margin
+
+    @staticmethod
+    def _key(client_id: str, refresh_token: str) -> str:
+        digest = hashlib.sha256(refresh_token.encode()).hexdigest()[:16]
+        return f"{client_id}:{digest}"
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def load(
+        self, client_id: str, refresh_token: str
+    ) -> Optional[Tuple[str, datetime]]:
+        """Cached token and its expiry (naive UTC), or None if missing or expiring"""
+        entry = self._read().get(self._key(client_id, refresh_token))
+        if entry is None:
+            return None
+        expiry = datetime.fromisoformat(entry["expiry"])
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        if (expiry - now).total_seconds() <= self.margin:
+            return None
+        return entry["token"], expiry
+
+    def save(
+        self, client_id: str, refresh_token: str, token: str, expiry: datetime
+    ) -> None:
+        if expiry is None:
+            return
+        entries = self._read()
+        entries[self._key(client_id, refresh_token)] = {
+            "token": token,
+            "expiry": expiry.isoformat(),
+        }
+        # Write then rename, so other processes never read a half written file
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+
+class GmailSession:
+    """Credentials, service, rate limiter and HTTP pool shared by clients
+
+    Creating a client on its own sets all of these up again. A session sets
+    them up once and hands out clients which share them, so the discovery
+    document is parsed once and every client uses the same access token.
+
+        session = GmailSession.setup(token_cache=TokenCache())
+        message_client = session.messages()
+        thread_client = session.threads()
+        label_client = session.labels()
+
+    Arguments:
+        client_secret (dict): Content of client_secret.json.
+        refresh_token (str): Refresh token of the user.
+        rate_limiter (RateLimiter): Default is the limiter shared by all sessions.
+        retry_policy (RetryPolicy): Default is the policy shared by all sessions.
+        token_cache (TokenCache): Reuse access tokens across processes.
+        instrumentation (Instrumentation): Where request events go. Default is the one shared by all sessions.
+    """
+
+    def __init__(
+        self,
+        client_secret: dict,
+        refresh_token: str,
+        rate_limiter: Optional[RateLimiter] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        token_cache: Optional[TokenCache] = None,
+        instrumentation: Optional[Instrumentation] = None,
+    ) -> None:
+        # Sessions share one limiter and retry budget unless given their own
+        self.rate_limiter = rate_limiter or default_rate_limiter
+        self.retry_policy = retry_policy or default_retry_policy
+        self.instrumentation = (
+            instrumentation if instrumentation is not None else default_instrumentation
+        )
+        self.token_cache = token_cache
+
+        from .pool import HttpPool, SharedCredentials
+
+        client_id = client_secret["installed"]["client_id"]
+        token, expiry = None, None
+        if token_cache is not None:
+            token, expiry = token_cache.load(client_id, refresh_token) or (None, None)
+        self.credentials = SharedCredentials(
+            token,
             refresh_token=refresh_token,
+            expiry=expiry,
             token_uri="https://oauth2.googleapis.com/token",
-            client_id=client_secret["installed"]["client_id"],
+            client_id=client_id,
             client_secret=client_secret["installed"]["client_secret"],
             scopes=SCOPES,
         )
-        self.service = build("gmail", "v1", credentials=credentials)
+        if token_cache is not None:
+            self.credentials.on_refresh = lambda credentials: token_cache.save(
+                client_id, refresh_token, credentials.token, credentials.expiry
+            )
+        # One transport per thread, so the clients can be shared by worker threads
+        self._init_service(HttpPool(self.credentials))
+
+    def _init_service(self, http) -> None:
+        """Build the service and what depends on it on top of a transport"""
+        from .labelindex import LabelIndex
+
+        self.http = http
+        self.service = self._build_service(http=http)
+        self.label_index = LabelIndex(self.service.users().labels())
+
+    def _build_service(self, **kwargs) -> "Resource":
+        """Build the gmail service whose requests go through the rate limiter and retry policy
+
+        The service is built from the discovery document shipped with
+        googleapiclient, nothing is fetched.
+        """
+        from googleapiclient.discovery import build_from_document
+
+        from .request import GmailHttpRequest
+
+        request_builder = partial(
+            GmailHttpRequest,
+            rate_limiter=self.rate_limiter,
+            retry_policy=self.retry_policy,
+            instrumentation=self.instrumentation,
+        )
+        return build_from_document(
+            load_discovery_document(), requestBuilder=request_builder, **kwargs
+        )
 
     @classmethod
-    def setup(cls):
-        """Offers another way to initialize this client."""
-        # Try to get refresh token
-        if not os.path.isfile("refresh_token.json"):
-            get_refresh_token()
-        with open("refresh_token.json", "r") as f:
-            refresh_token = json.load(f)["refresh_token"]
+    def setup(cls, **kwargs) -> "GmailSession":
+        """Create a session from client_secret.json and refresh_token.json
+
+        Keyword arguments are passed to the constructor. Ex. token_cache
+        """
         return cls(
             client_secret=get_client_secret(),
-            refresh_token=refresh_token,
+            refresh_token=load_refresh_token(),
+            **kwargs,
         )
+
+    def messages(self, **kwargs) -> "MessageClient":
+        """MessageClient on this session. Keyword arguments are passed to it. Ex. store"""
+        from .message import MessageClient
+
+        return MessageClient(session=self, **kwargs)
+
+    def threads(self, **kwargs) -> "ThreadClient":
+        """ThreadClient on this session. Keyword arguments are passed to it. Ex. store"""
+        from .thread import ThreadClient
+
+        return ThreadClient(session=self, **kwargs)
+
+    def labels(self, **kwargs) -> "LabelClient":
+        """LabelClient on this session"""
+        from .label import LabelClient
+
+        return LabelClient(session=self, **kwargs)
+
+
+class GmailClient:
+    """Base of the clients
+
+    Arguments:
+        client_secret (dict): Content of client_secret.json. Not needed with a session.
+        refresh_token (str): Refresh token of the user. Not needed with a session.
+        rate_limiter (RateLimiter): Ignored with a session, which has its own.
+        retry_policy (RetryPolicy): Ignored with a session, which has its own.
+        session (GmailSession): Share the credentials and service of a session.
+    """
+
+    def __init__(
+        self,
+        client_secret: Optional[dict] = None,
+        refresh_token: Optional[str] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        session: Optional[GmailSession] = None,
+    ) -> None:
+        if session is None:
+            if client_secret is None or refresh_token is None:
+                raise ValueError(
+                    "client_secret and refresh_token are required without a session."
+                )
+            session = GmailSession(
+                client_secret,
+                refresh_token,
+                rate_limiter=rate_limiter,
+                retry_policy=retry_policy,
+            )
+        self.session = session
+        self.rate_limiter = session.rate_limiter
+        self.retry_policy = session.retry_policy
+        self.instrumentation = session.instrumentation
+        self.credentials = session.credentials
+        self.http = session.http
+        self.service = session.service
+        self.label_index = session.label_index
+
+    @classmethod
+    def setup(cls, **kwargs):
+        """Offers another way to initialize this client.
+
+        Keyword arguments are passed to the constructor. Ex. rate_limiter, retry_policy
+        """
+        return cls(
+            client_secret=get_client_secret(),
+            refresh_token=load_refresh_token(),
+            **kwargs,
+        )
+
+    @staticmethod
+    def _get_params(
+        id: str,
+        format: str,
+        metadata_headers: Optional[List[str]],
+        fields: Optional[str],
+    ) -> dict:
+        """Parameters of messages.get and threads.get"""
+        if format not in FORMATS:
+            raise ValueError(f"format should be one of {FORMATS}.")
+        params = {"userId": "me", "id": id, "format": format}
+        if metadata_headers:
+            params["metadataHeaders"] = metadata_headers
+        if fields is not None:
+            params["fields"] = fields
+        return params
+
+    def _iter_list(
+        self,
+        key: str,
+        query_string: str = "",
+        include_spam_trash: bool = False,
+        page_token: Optional[str] = None,
+        limit: Optional[int] = None,
+        page_size: int = MAX_PAGE_SIZE,
+    ) -> Iterator[dict]:
+        """Yield the items of a paged list call page by page
+
+        Only one page is held in memory at a time.
+
+        Arguments:
+            key (str): The key of items in the response. Ex. messages or threads.
+            query_string (str): Gmail search query.
+            include_spam_trash (bool): Include items from SPAM and TRASH.
+            page_token (str): Start from a specific page.
+            limit (int): Stop after yielding this many items. None means no limit.
+            page_size (int): maxResults of each list call, up to 500.
+        """
+        count = 0
+        while limit is None or count < limit:
+            max_results = page_size if limit is None else min(page_size, limit - count)
+            result = self.client.list(
+                userId="me",
+                q=query_string or None,
+                pageToken=page_token,
+                maxResults=max_results,
+                includeSpamTrash=include_spam_trash,
+            ).execute()
+            items = result.get(key, [])
+            count += len(items)
+            yield from items
+            page_token = result.get("nextPageToken")
+            if not page_token:
+                return
@@ -8,3 +8,15 @@ class LabelNotAvailableError(Exception):
     def __init__(self, msg: str, *args, **kwargs) -> None:
         msg = f"The label: {msg} is not able change. Please refer to labelclient.available_labels for more information"
         super().__init__(msg, *args, **kwargs)
+
+
+class FieldNotFetchedError(Exception):
+    def __init__(self, msg: str, *args, **kwargs) -> None:
+        msg = f"The field: {msg} was not fetched. Please get the message with format='full' or include it in fields"
+        super().__init__(msg, *args, **kwargs)
+
+
+class UnsupportedQueryError(Exception):
+    def __init__(self, msg: str, *args, **kwargs) -> None:
+        msg = f"The query: {msg} is not supported by the local search index. Please search with MessageClient.list instead"
+        super().__init__(msg, *args, **kwargs)
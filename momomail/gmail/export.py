@@ -0,0 +1,195 @@
+import mailbox
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Union
+
+from .batch import MAX_BATCH_SIZE, BatchResult, chunked
+from .message import Message, MessageClient
+
+EXPORT_FORMATS = ("maildir", "mbox", "eml")
+
+JOURNAL_NAME = ".momomail-export.journal"
+
+
+@dataclass
+class ExportStats:
+    """Progress of an export
+
+    messages (int): Messages written in this run.
+    bytes (int): Bytes of RFC 822 messages written in this run.
+    skipped (int): Messages skipped because the journal says they were exported.
+    failed (dict): Map from message id to the error of its fetch.
+    seconds (float): Time spent so far.
+    """
+
+    messages: int = 0
+    bytes: int = 0
+    skipped: int = 0
+    failed: Dict[str, Exception] = field(default_factory=dict)
+    seconds: float = 0.0
+
+    @property
+    def messages_per_second(self) -> float:
+        return self.messages / self.seconds if self.seconds else 0.0
+
+    @property
+    def mb_per_second(self) -> float:
+        return self.bytes / 1024**2 / self.seconds if self.seconds else 0.0
+
+
+class Exporter:
+    """Parallel, resumable bulk export of messages
+
+    Messages are fetched with format=raw through batch requests and written as
+    a Maildir, an mbox file, or one .eml file per message. The id of every
+    written message is appended to a journal, so running the same export again
+    after it was stopped skips what is already done.
+
+    While one chunk of messages is written, the next one is fetched. At most
+    `batch_size * max_in_flight` messages are fetched at a time.
+
+        exporter = Exporter(MessageClient.setup(), "backup", format="mbox")
+        stats = exporter.export(search_string="from:bank", before="2023/1/1")
+
+    Arguments:
+        client (MessageClient): Client to fetch messages with.
+        path (str): Maildir directory, mbox file, or directory of .eml files.
+        format (str): maildir, mbox or eml.
+        journal_path (str): Checkpoint journal. Default is next to path.
+        batch_size (int): Messages per batch request, up to 100.
+        max_in_flight (int): Batch requests in flight.
+        progress (Callable): Called with ExportStats after each chunk.
+    """
+
+    def __init__(
+        self,
+        client: MessageClient,
+        path: Union[str, Path],
+        format: str = "maildir",
+        journal_path: Optional[Union[str, Path]] = None,
+        batch_size: int = MAX_BATCH_SIZE,
+        max_in_flight: int = 4,
+        progress: Optional[Callable[[ExportStats], None]] = None,
+    ) -> None:
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f"format should be one of {EXPORT_FORMATS}.")
+        self.client = client
+        self.path = Path(path)
+        self.format = format
+        if journal_path is None:
+            journal_path = self.path.parent / f"{self.path.name}{JOURNAL_NAME}"
+        self.journal_path = Path(journal_path)
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.progress = progress
+
+    def load_journal(self) -> Set[str]:
+        """Ids of the messages already exported"""
+        if not self.journal_path.is_file():
+            return set()
+        with open(self.journal_path, "r") as f:
+            return {line.strip() for line in f if line.strip()}
+
+    def export(self, ids: Optional[Iterable] = None, **list_kwargs) -> ExportStats:
+        """Export messages
+
+        Arguments:
+            ids (Iterable): Message ids, or dicts with an id key as yielded by iter_messages.
+                If None, the messages matching list_kwargs are exported.
+            list_kwargs: Search arguments of MessageClient.iter_messages. Ex. search_string, before
+
+        Returns:
+            ExportStats of this run.
+        """
+        if ids is None:
+            ids = self.client.iter_messages(**list_kwargs)
+        done = self.load_journal()
+        stats = ExportStats()
+        start = time.monotonic()
+
+        def pending() -> Iterator[str]:
+            for id in ids:
+                id = id["id"] if isinstance(id, dict) else id
+                if id in done:
+                    stats.skipped += 1
+                else:
+                    yield id
+
+        chunks = chunked(pending(), self.batch_size * self.max_in_flight)
+        writer = self._open_writer()
+        try:
+            with open(self.journal_path, "a") as journal, ThreadPoolExecutor(
+                1
+            ) as fetcher:
+                future: Optional[Future] = None
+                next_chunk = next(chunks, None)
+                if next_chunk is not None:
+                    future = fetcher.submit(self._fetch, next_chunk)
+                while future is not None:
+                    result: BatchResult = future.result()
+                    # Fetch the next chunk while writing this one
+                    next_chunk = next(chunks, None)
+                    future = (
+                        fetcher.submit(self._fetch, next_chunk)
+                        if next_chunk is not None
+                        else None
+                    )
+                    self._write(writer, result.results, journal, stats)
+                    stats.failed.update(result.errors)
+                    stats.seconds = time.monotonic() - start
+                    if self.progress is not None:
+                        self.progress(stats)
+        finally:
+            if writer is not None:
+                writer.close()
+        stats.seconds = time.monotonic() - start
+        return stats
+
+    def _fetch(self, ids: List[str]) -> BatchResult:
+        return self.client.get_many(
+            ids,
+            format="raw",
+            batch_size=self.batch_size,
+            max_workers=self.max_in_flight,
+        )
+
+    def _open_writer(self) -> Optional[mailbox.Mailbox]:
+        if self.format == "maildir":
+            return mailbox.Maildir(self.path, create=True)
+        if self.format == "mbox":
+            return mailbox.mbox(self.path, create=True)
+        self.path.mkdir(parents=True, exist_ok=True)
+        return None
+
+    def _write(
+        self,
+        writer: Optional[mailbox.Mailbox],
+        messages: List[Message],
+        journal,
+        stats: ExportStats,
+    ) -> None:
+        for message in messages:
+            raw = message.raw
+            if self.format == "maildir":
+                mail = mailbox.MaildirMessage(raw)
+                mail.set_subdir("cur")
+                if "UNREAD" not in message.label_ids:
+                    mail.add_flag("S")
+                if "STARRED" in message.label_ids:
+                    mail.add_flag("F")
+                writer.add(mail)
+            elif self.format == "mbox":
+                writer.add(raw)
+            else:
+                (self.path / f"{message.id}.eml").write_bytes(raw)
+            stats.messages += 1
+            stats.bytes += len(raw)
+        if self.format == "mbox":
+            writer.flush()
+        # Only journal messages which are on disk
+        journal.writelines(f"{message.id}\n" for message in messages)
+        journal.flush()
+        os.fsync(journal.fileno())
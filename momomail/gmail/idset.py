@@ -0,0 +1,269 @@
+import heapq
+import re
+import sys
+from array import array
+from bisect import bisect_left
+from pathlib import Path
+from typing import Iterable, Iterator, List, Set, Union
+
+# Gmail message and thread ids are 64 bit numbers written as 16 hex digits
+ID_PATTERN = re.compile(r"[0-9a-f]{16}")
+
+# Ids added since the last merge are kept in a set of at most this many
+RUN_SIZE = 65536
+
+# Sorted runs kept before they are merged into one
+MAX_RUNS = 16
+
+FILE_MAGIC = b"MOMOIDS1"
+
+
+def pack(id: str) -> int:
+    """The 64 bit number of a gmail id
+
+    Raises:
+        ValueError: The id is not 16 lower case hex digits.
+    """
+    if not ID_PATTERN.fullmatch(id):
+        raise ValueError(f"{id!r} is not a gmail id of 16 hex digits.")
+    return int(id, 16)
+
+
+def unpack(value: int) -> str:
+    return f"{value:016x}"
+
+
+def _new_array(values: Iterable[int] = ()) -> array:
+    return array("Q", values)
+
+
+def _contains(values: array, value: int) -> bool:
+    index = bisect_left(values, value)
+    return index < len(values) and values[index] == value
+
+
+def _unique(values: Iterable[int]) -> Iterator[int]:
+    """Drop repeats from sorted values"""
+    previous = None
+    for value in values:
+        if value != previous:
+            yield value
+            previous = value
+
+
+class IdSet:
+    """A set of gmail message or thread ids packed as 64 bit integers
+
+    Holding ids as str costs about 65 bytes each and the dicts returned by
+    list about 300 bytes per message. An IdSet keeps them in sorted arrays of
+    8 bytes per id, so the ids of a 2M message mailbox take 16 MB.
+
+        ids = client.list_ids(search_string="older_than:5y")
+        ids -= IdSet.load("kept.ids")
+        client.batch_trash(ids)
+
+    Ids are iterated in ascending order, which for gmail is about the order
+    they were created. Membership tests are binary searches. Union merges the
+    sorted arrays in one pass. Intersection looks up each id of the smaller
+    set in the larger, and difference each id of this set in the other, with
+    a binary search, so they take O(n log m) instead of a merge of both.
+    Adding an id which is already there does nothing, so pages of a list can
+    be added as they come without deduplicating them first.
+
+    Not thread-safe.
+
+    Arguments:
+        ids (Iterable[str]): Ids to start with.
+    """
+
+    __slots__ = ("_runs", "_pending")
+
+    def __init__(self, ids: Iterable[str] = ()) -> None:
+        # Sorted, disjoint arrays
+        self._runs: List[array] = []
+        # Recently added ids, not in any run
+        self._pending: Set[int] = set()
+        self.update(ids)
+
+    @classmethod
+    def from_refs(cls, refs: Iterable[dict], key: str = "id") -> "IdSet":
+        """Collect ids from list results
+
+        Arguments:
+            refs (Iterable[dict]): Ex. the items of iter_messages or list(exhausted=True)["messages"].
+            key (str): id, or threadId for the threads of listed messages.
+        """
+        return cls(ref[key] for ref in refs)
+
+    @classmethod
+    def _from_sorted(cls, values: array) -> "IdSet":
+        id_set = cls()
+        if values:
+            id_set._runs.append(values)
+        return id_set
+
+    def _values(self) -> array:
+        """All the values in one sorted array"""
+        if self._pending:
+            self._runs.append(_new_array(sorted(self._pending)))
+            self._pending = set()
+        if len(self._runs) > 1:
+            self._runs = [_new_array(heapq.merge(*self._runs))]
+        return self._runs[0] if self._runs else _new_array()
+
+    def _has(self, value: int) -> bool:
+        return value in self._pending or any(
+            _contains(run, value) for run in self._runs
+        )
+
+    def add(self, id: str) -> None:
+        value = pack(id)
+        if not self._has(value):
+            self._pending.add(value)
+            if len(self._pending) >= RUN_SIZE:
+                self._flush()
+
+    def update(self, ids: Iterable[str]) -> None:
+        """Add many ids. Another IdSet is merged without unpacking it."""
+        if isinstance(ids, IdSet):
+            self._runs = self.union(ids)._runs
+            return
+        for id in ids:
+            self.add(id)
+
+    def _flush(self) -> None:
+        self._runs.append(_new_array(sorted(self._pending)))
+        self._pending = set()
+        if len(self._runs) > MAX_RUNS:
+            self._values()
+
+    def discard(self, id: str) -> None:
+        value = pack(id)
+        self._pending.discard(value)
+        for run in self._runs:
+            index = bisect_left(run, value)
+            if index < len(run) and run[index] == value:
+                del run[index]
+                return
+
+    def clear(self) -> None:
+        self._runs = []
+        self._pending = set()
+
+    def __contains__(self, id: object) -> bool:
+        if not isinstance(id, str) or not ID_PATTERN.fullmatch(id):
+            return False
+        return self._has(int(id, 16))
+
+    def __len__(self) -> int:
+        return len(self._pending) + sum(len(run) for run in self._runs)
+
+    def __iter__(self) -> Iterator[str]:
+        return map(unpack, self._values())
+
+    def __repr__(self) -> str:
+        return f"IdSet(<{len(self)} ids>)"
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, IdSet):
+            return NotImplemented
+        return self._values() == other._values()
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes taken by the packed ids"""
+        return 8 * len(self)
+
+    @staticmethod
+    def _coerce(other: Iterable[str]) -> "IdSet":
+        return other if isinstance(other, IdSet) else IdSet(other)
+
+    def union(self, other: Iterable[str]) -> "IdSet":
+        other = self._coerce(other)
+        merged = heapq.merge(self._values(), other._values())
+        return IdSet._from_sorted(_new_array(_unique(merged)))
+
+    def intersection(self, other: Iterable[str]) -> "IdSet":
+        other = self._coerce(other)
+        small, large = sorted((self._values(), other._values()), key=len)
+        return IdSet._from_sorted(
+            _new_array(value for value in small if _contains(large, value))
+        )
+
+    def difference(self, other: Iterable[str]) -> "IdSet":
+        other = self._coerce(other)
+        excluded = other._values()
+        return IdSet._from_sorted(
+            _new_array(
+                value for value in self._values() if not _contains(excluded, value)
+            )
+        )
+
+    def difference_update(self, other: Iterable[str]) -> None:
+        self._runs = self.difference(other)._runs
+        self._pending = set()
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+    def __ior__(self, other: Iterable[str]) -> "IdSet":
+        self.update(self._coerce(other))
+        return self
+
+    def __isub__(self, other: Iterable[str]) -> "IdSet":
+        self.difference_update(other)
+        return self
+
+    def apply(self, event) -> None:
+        """Apply a change event of SyncEngine, to keep the ids of a mailbox"""
+        # Imported here, sync imports message and batch, which import this module
+        from .sync import FullResync, MessageAdded, MessageDeleted
+
+        if isinstance(event, MessageAdded):
+            self.add(event.id)
+        elif isinstance(event, MessageDeleted):
+            self.discard(event.id)
+        elif isinstance(event, FullResync):
+            # Messages which are still there come back as MessageAdded
+            self.clear()
+
+    def to_bytes(self) -> bytes:
+        values = self._values()
+        if sys.byteorder == "big":
+            values = _new_array(values)
+            values.byteswap()
+        return FILE_MAGIC + len(values).to_bytes(8, "little") + values.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "IdSet":
+        """Read the output of to_bytes
+
+        Raises:
+            ValueError: The data was not written by to_bytes.
+        """
+        header = len(FILE_MAGIC) + 8
+        if data[: len(FILE_MAGIC)] != FILE_MAGIC:
+            raise ValueError("Not an IdSet.")
+        start = len(FILE_MAGIC)
+        count = int.from_bytes(data[start:header], "little")
+        if len(data) != header + 8 * count:
+            raise ValueError("The IdSet is truncated.")
+        values = _new_array()
+        values.frombytes(data[header:])
+        if sys.byteorder == "big":
+            values.byteswap()
+        return cls._from_sorted(values)
+
+    def save(self, path: Union[str, Path]) -> None:
+        """Write the ids to a file, 8 bytes per id"""
+        # Write then rename, so a crash never leaves a half written file
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.to_bytes())
+        Path(tmp_path).replace(path)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "IdSet":
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())
@@ -5,6 +5,7 @@ from pydantic import BaseModel, validator
 
 from .client import GmailClient
 from .exceptions import LabelNotAvailableError
+from .labelindex import LabelIndex
 
 
 class LabelListVisibility(str, Enum):
@@ -197,19 +198,31 @@ class LabelOutput(LabelBase):
 
 
 class LabelClient(GmailClient):
-    def __init__(self, client_secret: dict, refresh_token: str) -> None:
-        super().__init__(client_secret, refresh_token)
+    def __init__(
+        self,
+        client_secret: Optional[dict] = None,
+        refresh_token: Optional[str] = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(client_secret, refresh_token, **kwargs)
         self.client = self.service.users().labels()
 
+    @property
+    def index(self) -> LabelIndex:
+        """Cached labels shared by the clients of the session. See LabelIndex."""
+        return self.label_index
+
     @property
     def labels(self):
         """List all labels"""
-        return [label["name"] for label in self.list()]
+        return [label["name"] for label in self.label_index.labels]
 
     @property
     def available_label_ids(self) -> List[dict]:
         """List all the labels which are available to change"""
-        return [label["id"] for label in self.list() if label["type"] == "user"]
+        return [
+            label["id"] for label in self.label_index.labels if label["type"] == "user"
+        ]
 
     def create(
         self,
@@ -217,7 +230,7 @@ class LabelClient(GmailClient):
         messageListVisibility: Optional[str] = None,
         labelListVisibility: Optional[str] = None,
         color: Optional[dict] = None,
-    ):
+    ) -> dict:
         """Creates a new label."""
         data = LabelInput(
             name=name,
@@ -225,7 +238,9 @@ class LabelClient(GmailClient):
             labelListVisibility=labelListVisibility,
             color=color,
         )
-        self.client.create(userId="me", body=data.dict()).execute()
+        label = self.client.create(userId="me", body=data.dict()).execute()
+        self.label_index.put(label)
+        return label
 
     def delete(self, id):
         """Delete label
@@ -234,14 +249,17 @@ class LabelClient(GmailClient):
         from any messages and threads that it is applied to.
         """
         self.client.delete(userId="me", id=id).execute()
+        self.label_index.remove(id)
 
     def get(self, id: str) -> dict:
         """Gets the specified label."""
         return self.client.get(userId="me", id=id).execute()
 
     def list(self) -> List[dict]:
-        """Lists all labels in the user's mailbox."""
-        return self.client.list(userId="me").execute()["labels"]
+        """Lists all labels in the user's mailbox. The label index is loaded with them."""
+        labels = self.client.list(userId="me").execute()["labels"]
+        self.label_index.load(labels)
+        return labels
 
     def patch(self, id: str, body: dict):
         """Patch the specified label.
@@ -251,10 +269,14 @@ class LabelClient(GmailClient):
         """
         if id not in self.available_label_ids:
             raise LabelNotAvailableError(id)
-        return self.client.patch(userId="me", id=id, body=body).execute()
+        label = self.client.patch(userId="me", id=id, body=body).execute()
+        self.label_index.put(label)
+        return label
 
     def update(self, id: str, body: dict):
         """Updates the specified label."""
         if id not in self.available_label_ids:
             raise LabelNotAvailableError(id)
-        return self.client.update(userId="me", id=id, body=body).execute()
+        label = self.client.update(userId="me", id=id, body=body).execute()
+        self.label_index.put(label)
+        return label
@@ -0,0 +1,169 @@
+import re
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional
+
+from .exceptions import LabelNotFoundError
+
+if TYPE_CHECKING:
+    from googleapiclient.discovery import Resource
+
+# Ids of system labels. Their names are reserved, so no user label can be
+# named like them and they are used without a lookup.
+# Ref: https://developers.google.com/gmail/api/guides/labels
+SYSTEM_LABEL_IDS = frozenset(
+    "INBOX SPAM TRASH UNREAD STARRED IMPORTANT SENT DRAFT CHAT".split()
+)
+
+# Forms of the other label ids. A user label can be named like them, so they
+# are only trusted as ids when the labels have never been listed.
+LABEL_ID_PATTERN = re.compile(r"CATEGORY_[A-Z]+|Label_\d+")
+
+
+class LabelIndex:
+    """Labels of the mailbox cached for ttl seconds
+
+    Maps label names to ids and ids to the label resources, so label names can
+    be used wherever gmail wants ids. The labels are listed again when they
+    are older than ttl, or when a name is not found and the labels were not
+    just listed. LabelClient keeps the index up to date with its own writes.
+
+    Arguments:
+        client (Resource): users().labels() of a gmail service.
+        ttl (float): Seconds the listed labels are trusted.
+        clock (Callable): time.monotonic. Replaceable for testing.
+    """
+
+    def __init__(
+        self,
+        client: "Resource",
+        ttl: float = 300.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.client = client
+        self.ttl = ttl
+        self.clock = clock
+        self._by_id: Dict[str, dict] = {}
+        self._by_name: Dict[str, str] = {}
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def stale(self) -> bool:
+        """The labels were never listed or are older than ttl"""
+        return self._loaded_at is None or self.clock() - self._loaded_at >= self.ttl
+
+    def refresh(self) -> None:
+        """List the labels again"""
+        self.load(self.client.list(userId="me").execute().get("labels", []))
+
+    def load(self, labels: List[dict]) -> None:
+        """Replace the labels with a fresh labels.list result"""
+        with self._lock:
+            self._by_id = {}
+            self._by_name = {}
+            for label in labels:
+                self._put(label)
+            self._loaded_at = self.clock()
+
+    def invalidate(self) -> None:
+        """Make the next lookup list the labels again"""
+        self._loaded_at = None
+
+    def _ensure(self) -> None:
+        if self.stale:
+            self.refresh()
+
+    def _put(self, label: dict) -> None:
+        old = self._by_id.get(label["id"])
+        if old is not None:
+            self._by_name.pop(old["name"].lower(), None)
+        self._by_id[label["id"]] = label
+        # Gmail label names are unique regardless of case
+        self._by_name[label["name"].lower()] = label["id"]
+
+    def put(self, label: dict) -> None:
+        """Add or replace a label, e.g. after it was created or updated"""
+        with self._lock:
+            self._put(label)
+
+    def remove(self, id: str) -> None:
+        """Forget a deleted label"""
+        with self._lock:
+            label = self._by_id.pop(id, None)
+            if label is not None:
+                self._by_name.pop(label["name"].lower(), None)
+
+    @property
+    def labels(self) -> List[dict]:
+        """All label resources"""
+        self._ensure()
+        return list(self._by_id.values())
+
+    def get(self, id: str, refresh: bool = True) -> Optional[dict]:
+        """Label resource of an id, None if there is no such label
+
+        Arguments:
+            refresh (bool): List the labels when stale. If False, only the labels
+                already loaded are used.
+        """
+        if refresh:
+            self._ensure()
+        return self._by_id.get(id)
+
+    def id_of(self, name: str) -> Optional[str]:
+        """Id of a label name, case-insensitive. None if there is no such label"""
+        self._ensure()
+        return self._by_name.get(name.lower())
+
+    def resolve(
+        self, names: Optional[Iterable[str]], refresh: bool = True
+    ) -> Optional[List[str]]:
+        """Turn label names into ids
+
+        Each value is looked up as a label name first, then as a label id, so a
+        user label named like an id, e.g. Label_3, is found by its name. System
+        label ids like INBOX are kept as they are without a lookup. Values of
+        the form of other label ids are only trusted without a lookup when the
+        labels could not be listed, i.e. refresh is False and they never were.
+
+        Arguments:
+            names (Iterable[str]): Label names or ids.
+            refresh (bool): List the labels when needed. If False, only the labels
+                already loaded are used, whatever their age.
+
+        Raises:
+            LabelNotFoundError: A value is neither a label id nor a label name.
+        """
+        if names is None:
+            return None
+        refreshed = not refresh or self.stale
+        ids = []
+        for name in names:
+            if name in SYSTEM_LABEL_IDS:
+                ids.append(name)
+                continue
+            id = self._lookup(name, refresh)
+            if id is None and not refreshed:
+                # Might have been created since the labels were listed
+                self.refresh()
+                refreshed = True
+                id = self._lookup(name)
+            if (
+                id is None
+                and self._loaded_at is None
+                and LABEL_ID_PATTERN.fullmatch(name)
+            ):
+                id = name
+            if id is None:
+                raise LabelNotFoundError(name)
+            ids.append(id)
+        return ids
+
+    def _lookup(self, name: str, refresh: bool = True) -> Optional[str]:
+        if refresh:
+            self._ensure()
+        id = self._by_name.get(name.lower())
+        if id is None and name in self._by_id:
+            id = name
+        return id
@@ -0,0 +1,358 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from io import BytesIO
+from pathlib import Path
+from string import Formatter
+from typing import Callable, Dict, Iterable, List, Optional, Set, Union
+
+from .message import MessageClient
+from .mime import Attachment, encode_attachment, write_mime
+
+_formatter = Formatter()
+
+
+def _compile(template: Optional[str]) -> Optional[list]:
+    """Split a str.format template into (literal, field, format_spec, conversion) once"""
+    if template is None:
+        return None
+    return list(_formatter.parse(template))
+
+
+def _render(segments: Optional[list], record: dict) -> Optional[str]:
+    if segments is None:
+        return None
+    out = []
+    for literal, name, format_spec, conversion in segments:
+        out.append(literal)
+        if name is not None:
+            value, _ = _formatter.get_field(name, (), record)
+            value = _formatter.convert_field(value, conversion)
+            out.append(format(value, format_spec))
+    return "".join(out)
+
+
+class MailTemplate:
+    """A message template filled in for each recipient
+
+    Subject, content, to, cc, from_ and header values are str.format templates
+    taking the fields of a recipient record, ex. "Hi {name}". They are parsed
+    once. Attachments are the same for every recipient and are encoded once.
+
+    Arguments:
+        subject (str): Subject template.
+        content (str): Text body template.
+        to (str): To template.
+        cc (str): Cc template.
+        from_ (str): From template. Gmail uses the authenticated user when None.
+        attachments (Iterable): Paths, or (filename, binary file object) pairs.
+        headers (dict): Extra header templates.
+    """
+
+    def __init__(
+        self,
+        subject: str,
+        content: str,
+        to: str = "{email}",
+        cc: Optional[str] = None,
+        from_: Optional[str] = None,
+        attachments: Optional[Iterable[Attachment]] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        self._subject = _compile(subject)
+        self._content = _compile(content)
+        self._to = _compile(to)
+        self._cc = _compile(cc)
+        self._from = _compile(from_)
+        self._headers = {
+            name: _compile(value) for name, value in (headers or {}).items()
+        }
+        self.attachments = [
+            encode_attachment(attachment) for attachment in attachments or []
+        ]
+
+    def render(self, record: dict, headers: Optional[dict] = None) -> bytes:
+        """The RFC 822 message of a recipient
+
+        Raises:
+            KeyError: A field of the template is missing from the record.
+        """
+        buffer = BytesIO()
+        write_mime(
+            buffer,
+            to=_render(self._to, record),
+            subject=_render(self._subject, record),
+            content=_render(self._content, record),
+            cc=_render(self._cc, record),
+            from_=_render(self._from, record),
+            attachments=self.attachments,
+            headers={
+                **{
+                    name: _render(value, record)
+                    for name, value in self._headers.items()
+                },
+                **(headers or {}),
+            },
+        )
+        return buffer.getvalue()
+
+
+@dataclass
+class RecipientStatus:
+    """What happened to one recipient
+
+    key (str): Key of the recipient record.
+    status (str): sent, already_sent (by an earlier run), failed, or deferred (max_sends was reached).
+    id (str): Gmail id of the sent message.
+    message_id (str): Message-ID header of the message.
+    error (Exception): Why the message was not sent.
+    """
+
+    key: str
+    status: str
+    id: Optional[str] = None
+    message_id: Optional[str] = None
+    error: Optional[Exception] = None
+
+
+@dataclass
+class MergeResult:
+    """Result of MailMerge.send
+
+    statuses (dict): Map from recipient key to RecipientStatus, in the order of the records.
+    seconds (float): Time spent.
+    """
+
+    statuses: Dict[str, RecipientStatus] = field(default_factory=dict)
+    seconds: float = 0.0
+
+    @property
+    def counts(self) -> Dict[str, int]:
+        """Number of recipients by status"""
+        return dict(Counter(status.status for status in self.statuses.values()))
+
+    @property
+    def failed(self) -> List[RecipientStatus]:
+        return [s for s in self.statuses.values() if s.status == "failed"]
+
+
+class MailMerge:
+    """Send a template to many recipients, once each
+
+    Messages are rendered and sent by `max_workers` threads through the
+    connection pool, rate limiter and retry policy of the client's session,
+    so a send costs 100 quota units like any other and the throughput stays
+    within the per-user quota.
+
+    Every message gets a Message-ID derived from the campaign and the
+    recipient key. Before a message is sent, its key is written to a journal
+    and synced to disk, and after it is sent, the gmail id. Running the same
+    campaign again skips the recipients the journal says were sent. A
+    recipient whose send was in flight during a crash is looked up in gmail by
+    its Message-ID and only sent if it is not there, so no one gets the
+    message twice. The same lookup is made before a send is retried after a
+    5xx, which gmail may answer after it accepted the message.
+
+        merge = MailMerge(
+            session.messages(),
+            MailTemplate(subject="Your invoice, {name}", content="Hi {name}, ..."),
+            campaign="invoices-2024-03",
+        )
+        result = merge.send(csv.DictReader(open("recipients.csv")))
+
+    Arguments:
+        client (MessageClient): Client to send with.
+        template (MailTemplate): Message of every recipient.
+        campaign (str): Name of this bulk send. Same name, same Message-IDs and journal.
+        journal_path (str): Journal of the campaign. Default is "<campaign>.merge.journal".
+        key_field (str): Field of the records which identifies a recipient.
+        max_workers (int): Messages rendered and sent at the same time.
+        max_sends (int): Stop sending after this many messages, ex. the daily sending
+            limit. The other recipients are deferred to the next run.
+        message_id_domain (str): Domain part of the Message-IDs.
+        progress (Callable): Called with each RecipientStatus.
+    """
+
+    def __init__(
+        self,
+        client: MessageClient,
+        template: MailTemplate,
+        campaign: str,
+        journal_path: Optional[Union[str, Path]] = None,
+        key_field: str = "email",
+        max_workers: int = 4,
+        max_sends: Optional[int] = None,
+        message_id_domain: str = "momomail",
+        progress: Optional[Callable[[RecipientStatus], None]] = None,
+    ) -> None:
+        self.client = client
+        self.template = template
+        self.campaign = campaign
+        if journal_path is None:
+            journal_path = f"{campaign}.merge.journal"
+        self.journal_path = Path(journal_path)
+        self.key_field = key_field
+        self.max_workers = max_workers
+        self.max_sends = max_sends
+        self.message_id_domain = message_id_domain
+        self.progress = progress
+        self._lock = threading.Lock()
+        self._journal = None
+
+    def message_id(self, key: str) -> str:
+        """Message-ID of a recipient, without the angle brackets"""
+        digest = hashlib.sha256(f"{self.campaign}\0{key}".encode()).hexdigest()
+        return f"{digest[:32]}@{self.message_id_domain}"
+
+    def load_journal(self) -> Dict[str, dict]:
+        """Last journal entry of each recipient key"""
+        entries = {}
+        if not self.journal_path.is_file():
+            return entries
+        with open(self.journal_path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash
+                    continue
+                entries[entry["key"]] = entry
+        return entries
+
+    def send(self, records: Iterable[dict]) -> MergeResult:
+        """Send the template to every record
+
+        Arguments:
+            records (Iterable[dict]): Recipient records, ex. rows of csv.DictReader.
+                Records with a key seen before in the same call are ignored.
+
+        Returns:
+            MergeResult with the status of every recipient.
+        """
+        journal = self.load_journal()
+        result = MergeResult()
+        start = time.monotonic()
+        attempts = 0
+        pending: Set[Future] = set()
+
+        def collect(futures: Iterable[Future]) -> None:
+            for future in futures:
+                self._report(result, future.result())
+
+        with open(self.journal_path, "a") as self._journal, ThreadPoolExecutor(
+            self.max_workers
+        ) as executor:
+            try:
+                for record in records:
+                    key = str(record[self.key_field])
+                    if key in result.statuses:
+                        continue
+                    entry = journal.get(key)
+                    if entry is not None and entry["status"] == "sent":
+                        status = RecipientStatus(
+                            key, "already_sent", entry["id"], entry["message_id"]
+                        )
+                    elif self.max_sends is not None and attempts >= self.max_sends:
+                        status = RecipientStatus(key, "deferred")
+                    else:
+                        attempts += 1
+                        # Keeps the order of the records
+                        result.statuses[key] = None
+                        pending.add(
+                            executor.submit(
+                                self._deliver, record, key, entry is not None
+                            )
+                        )
+                        # Render no more than a few messages ahead of the senders
+                        if len(pending) >= 2 * self.max_workers:
+                            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                            collect(done)
+                        continue
+                    self._report(result, status)
+                collect(pending)
+            finally:
+                self._journal = None
+        result.seconds = time.monotonic() - start
+        return result
+
+    def _report(self, result: MergeResult, status: RecipientStatus) -> None:
+        result.statuses[status.key] = status
+        if self.progress is not None:
+            self.progress(status)
+
+    def _deliver(self, record: dict, key: str, unconfirmed: bool) -> RecipientStatus:
+        message_id = self.message_id(key)
+        try:
+            if unconfirmed:
+                # The last run stopped while sending it
+                found = self._find(message_id)
+                if found is not None:
+                    self._write(key, "sent", message_id, found["id"])
+                    return RecipientStatus(key, "already_sent", found["id"], message_id)
+            raw = self.template.render(
+                record, headers={"Message-ID": f"<{message_id}>"}
+            )
+            self._write(key, "sending", message_id)
+            sent = self._send(raw, message_id)
+            self._write(key, "sent", message_id, sent["id"])
+            return RecipientStatus(key, "sent", sent["id"], message_id)
+        except Exception as error:
+            return RecipientStatus(key, "failed", message_id=message_id, error=error)
+
+    def _find(self, message_id: str) -> Optional[dict]:
+        """The id and threadId of the sent message of a Message-ID, if gmail has it"""
+        return next(
+            self.client.iter_messages(
+                search_string=f"rfc822msgid:{message_id}",
+                include_spam_trash=True,
+                limit=1,
+            ),
+            None,
+        )
+
+    def _send(self, raw: bytes, message_id: str) -> dict:
+        """Send a message, without resending it after gmail may have accepted it
+
+        The retry policy of the session would send the request again after a
+        5xx, which gmail can answer after it delivered the message. The retries
+        are made here instead, and after a 5xx the message is looked up by its
+        Message-ID before it is sent again.
+        """
+        from googleapiclient.errors import HttpError
+
+        request = self.client.send_mime_request(BytesIO(raw), len(raw))
+        policy = getattr(request, "retry_policy", None)
+        request.retry_policy = None
+        if policy is None:
+            return request.execute()
+        server_error = False
+
+        def attempt() -> dict:
+            nonlocal server_error
+            if server_error:
+                found = self._find(message_id)
+                if found is not None:
+                    return found
+            try:
+                return request.execute()
+            except HttpError as error:
+                server_error = error.resp.status >= 500
+                raise
+
+        return policy.call(attempt)
+
+    def _write(
+        self, key: str, status: str, message_id: str, id: Optional[str] = None
+    ) -> None:
+        entry = {"key": key, "status": status, "message_id": message_id, "id": id}
+        with self._lock:
+            self._journal.write(json.dumps(entry) + "\n")
+            self._journal.flush()
+            # Nothing is sent before the journal knows about it
+            if status == "sending":
+                os.fsync(self._journal.fileno())
@@ -1,16 +1,41 @@
-import copy
-import mimetypes
-import os
 import re
-import time
 from base64 import urlsafe_b64decode, urlsafe_b64encode
-from email.message import EmailMessage
 from pathlib import Path
-from typing import Dict, List, Optional
+from tempfile import SpooledTemporaryFile
+from typing import TYPE_CHECKING, BinaryIO, Dict, Iterable, Iterator, List, Optional
 
-from googleapiclient.discovery import Resource
+from .batch import (
+    MAX_BATCH_SIZE,
+    MAX_BULK_IDS,
+    BatchResult,
+    BulkResult,
+    execute_batched,
+    execute_chunked,
+)
+from .client import MAX_PAGE_SIZE, GmailClient, build_query_string
+from .exceptions import FieldNotFetchedError
+from .idset import IdSet
+from .mime import Attachment, write_mime
+from .store import MessageStore
+from .writeback import current_queue
 
-from .client import GmailClient
+if TYPE_CHECKING:
+    from googleapiclient.discovery import Resource
+    from googleapiclient.http import HttpRequest
+
+    from .labelindex import LabelIndex
+
+# Filenames of text parts without a filename
+TEXT_FILENAMES = {"text/plain": "sample.txt", "text/html": "sample.html"}
+
+# Decoded bytes written per chunk when saving parts
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+# Messages larger than this are sent with the resumable upload
+RESUMABLE_THRESHOLD = 5 * 1024 * 1024
+
+# Bytes per resumable upload request, a multiple of 256 KB
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
 
 
 class Message:
@@ -20,40 +45,113 @@ class Message:
     ORM. Properties are the data in this model, methods allow ORM to
     control the gmail api.
 
+    A message may be fetched partially, with format minimal/metadata/raw or a
+    fields mask. Properties whose data was not fetched raise FieldNotFetchedError.
+
+    Headers are indexed by lower case name in one pass on first access. To
+    hold many messages in memory, call release_payload once the body and parts
+    are no longer needed; only the header index and the top level fields are kept.
+
     """
 
-    def __init__(self, raw_data: dict, client: Resource) -> None:
+    __slots__ = ("raw_data", "client", "metadata_headers", "label_index", "_headers")
+
+    def __init__(
+        self,
+        raw_data: dict,
+        client: "Resource",
+        metadata_headers: Optional[List[str]] = None,
+        label_index: Optional["LabelIndex"] = None,
+    ) -> None:
         self.raw_data = raw_data
         self.client = client
+        # Headers requested with format=metadata. None means all headers.
+        self.metadata_headers = metadata_headers
+        # Turns label names into ids in modify. None means ids only.
+        self.label_index = label_index
+        self._headers: Optional[Dict[str, str]] = None
 
     def __str__(self) -> str:
-        return self.subject
+        try:
+            return self.subject
+        except FieldNotFetchedError:
+            return self.id
+
+    def _field(self, *keys: str):
+        """Get raw_data[key1][key2]..., raise FieldNotFetchedError if missing"""
+        data = self.raw_data
+        for key in keys:
+            if key not in data:
+                raise FieldNotFetchedError(".".join(keys))
+            data = data[key]
+        return data
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        """Top level headers keyed by lower case name
+
+        When a header appears more than once, the first value is kept.
+        """
+        if self._headers is None:
+            headers = {}
+            for header in self._field("payload", "headers"):
+                headers.setdefault(header["name"].lower(), str(header["value"]))
+            self._headers = headers
+        return self._headers
+
+    def header(self, name: str) -> Optional[str]:
+        """Value of a header, case-insensitive. None if the message has no such header."""
+        return self._lookup_header(name.lower())
+
+    def _header(self, name: str) -> str:
+        """Value of a header by its lower case name, empty string if it is missing"""
+        value = self._lookup_header(name)
+        return "" if value is None else value
+
+    def _lookup_header(self, name: str) -> Optional[str]:
+        headers = self._headers
+        if headers is None:
+            headers = self.headers
+        value = headers.get(name)
+        if value is not None:
+            return value
+        if self.metadata_headers is not None and name not in (
+            header.lower() for header in self.metadata_headers
+        ):
+            raise FieldNotFetchedError(f"payload.headers.{name}")
+        return None
+
+    def release_payload(self) -> None:
+        """Drop the payload tree and keep only the header index
+
+        After this, body and parts raise FieldNotFetchedError.
+        """
+        if "payload" in self.raw_data:
+            # Build the index before the headers go away
+            self._headers = self.headers
+            self.raw_data = {
+                key: value for key, value in self.raw_data.items() if key != "payload"
+            }
 
     @property
     def id(self) -> str:
-        return self.raw_data["id"]
+        return self._field("id")
 
     @property
     def thread_id(self) -> str:
-        return self.raw_data["threadId"]
+        return self._field("threadId")
 
     @property
     def label_ids(self) -> List[str]:
-        return self.raw_data["labelIds"]
+        return self._field("labelIds")
 
     @property
     def subject(self) -> str:
-        for header in self.raw_data["payload"]["headers"]:
-            if header["name"] == "Subject":
-                return str(header["value"])
-        return ""
+        return self._header("subject")
 
     @property
     def date(self) -> str:
-        for header in self.raw_data["payload"]["headers"]:
-            if header["name"] == "Date":
-                return str(header["value"])
-        return ""
+        return self._header("date")
 
     def _format_date(self, date_string: str) -> str:
         """Format date string"""
@@ -78,27 +176,31 @@ class Message:
 
     @property
     def from_(self) -> Optional[str]:
-        for header in self.raw_data["payload"]["headers"]:
-            if header["name"] == "From":
-                return str(header["value"])
-        return ""
+        return self._header("from")
 
     @property
     def to(self) -> str:
-        for header in self.raw_data["payload"]["headers"]:
-            if header["name"] == "To":
-                return str(header["value"])
-        return ""
+        return self._header("to")
 
     @property
     def body(self) -> str:
-        body_data = self.raw_data["payload"]["body"].get("data")
+        body_data = self._field("payload", "body").get("data")
         if body_data:
             return urlsafe_b64decode(body_data).decode()
         return ""
 
     @property
-    def parts(self) -> List[Dict[str, str]]:
+    def raw(self) -> bytes:
+        """The RFC 822 message. Needs format=raw."""
+        return urlsafe_b64decode(self._field("raw"))
+
+    @property
+    def parts(self) -> List["Part"]:
+        """Leaf parts of the payload
+
+        Parts are lightweight descriptors, their content is only decoded or
+        downloaded when asked for. See Part.
+        """
         # parts could be nested, use DFS to recursively parse out data
         # DFS can keep the order
         result = []
@@ -108,9 +210,11 @@ class Message:
                 if part.get("parts"):
                     dfs(part.get("parts"), result)
                 else:
-                    result.append(self._parse_part(part))
+                    parsed = self._parse_part(part)
+                    if parsed is not None:
+                        result.append(parsed)
 
-        dfs(copy.deepcopy(self.raw_data["payload"]["parts"]), result)
+        dfs(self._field("payload").get("parts", []), result)
 
         return result
 
@@ -126,81 +230,175 @@ class Message:
         add_label_ids: Optional[List[str]] = None,
         remove_label_ids: Optional[List[str]] = None,
     ) -> None:
+        """Modify the labels of this message
+
+        Label names are accepted as well as ids when the message was built by a
+        client, inside a ModifyQueue or not.
+        """
+        if self.label_index is not None:
+            add_label_ids = self.label_index.resolve(add_label_ids)
+            remove_label_ids = self.label_index.resolve(remove_label_ids)
         body = {}
         if add_label_ids:
             body["addLabelIds"] = add_label_ids
         if remove_label_ids:
             body["removeLabelIds"] = remove_label_ids
+        queue = current_queue()
+        if queue is not None:
+            queue.add([self.id], add_label_ids, remove_label_ids)
+            return
         self.client.modify(userId="me", id=self.id, body=body).execute()
 
     def trash(self) -> None:
         """Move this message to trash."""
+        queue = current_queue()
+        if queue is not None:
+            queue.add([self.id], add_label_ids=["TRASH"])
+            return
         self.client.trash(userId="me", id=self.id).execute()
 
     def untrash(self) -> None:
         """Untrash this message."""
+        queue = current_queue()
+        if queue is not None:
+            queue.add([self.id], remove_label_ids=["TRASH"])
+            return
         self.client.untrash(userId="me", id=self.id).execute()
 
-    def dump(self) -> None:
-        """Dump the mail content"""
+    def dump(self, chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+        """Dump the mail content
+
+        Attachments are downloaded one at a time and decoded to the file in
+        chunks, so only one attachment is in memory at a time, as its response
+        and base64 text, and the decoded bytes are never built.
+        """
         mail_dir = Path(f"{self.subject}-{self._format_date(self.date)}")
         mail_dir.mkdir()
-        if self.body:
+        body = self.body
+        if body:
             with open(mail_dir / "body.txt", "w") as f:
-                f.write(self.body)
+                f.write(body)
         for part in self.parts:
-            # attachment need to use byte format to write
-            buffer_format = "wb" if part["type"] == "attachment" else "w"
-            with open(mail_dir / part["filename"], buffer_format) as f:
-                f.write(part["data"])
+            part.save(mail_dir / part.filename, chunk_size=chunk_size)
 
     def get_attachment(self, attachment_id: str) -> bytes:
         """Get attachment"""
-        data = (
+        return urlsafe_b64decode(self._get_attachment_data(attachment_id))
+
+    def _get_attachment_data(self, attachment_id: str) -> str:
+        """Get the base64url encoded content of an attachment"""
+        return (
             self.client.attachments()
             .get(id=attachment_id, userId="me", messageId=self.id)
             .execute()
             .get("data")
         )
-        return urlsafe_b64decode(data)
-
-    def _parse_part(self, part: dict) -> Optional[dict]:
-        if part.get("mimeType") == "text/plain":
-            filename = part.get("filename", "") or "sample.txt"
-            data = part.get("body", {}).get("data", "")
-            if data:
-                data = urlsafe_b64decode(data).decode()
-                return {
-                    "filename": filename,
-                    "type": "text/plain",
-                    "data": data,
-                }
-
-        elif part.get("mimeType") == "text/html":
-            filename = part.get("filename", "") or "sample.html"
-            data = part.get("body", {}).get("data", "")
-            if data:
-                data = urlsafe_b64decode(data).decode()
-                return {
-                    "filename": filename,
-                    "type": "text/html",
-                    "data": data,
-                }
+
+    def _parse_part(self, part: dict) -> Optional["Part"]:
+        body = part.get("body", {})
+        if not body.get("data") and not body.get("attachmentId"):
+            return None
+        return Part(self, part)
+
+
+class Part:
+    """A leaf part of a message
+
+    Only the description of the part is kept. The content is decoded, or
+    downloaded for attachments, every time data is read or the part is saved.
+
+    For backward compatibility, part["filename"], part["type"] and part["data"]
+    are also supported.
+
+    Attributes:
+        filename (str): The filename, or sample.txt/sample.html/sample if it has none.
+        type (str): text/plain, text/html or attachment.
+        mime_type (str): The mime type of the part.
+        size (int): Size of the decoded content in bytes.
+    """
+
+    __slots__ = ("message", "filename", "type", "mime_type", "size", "_body")
+
+    def __init__(self, message: Message, part: dict) -> None:
+        self.message = message
+        self.mime_type = part.get("mimeType", "")
+        if self.mime_type in TEXT_FILENAMES:
+            self.type = self.mime_type
         else:
-            if part.get("body", {}).get("attachmentId"):
-                data = self.get_attachment(part["body"]["attachmentId"])
-                filename = part.get("filename", "") or "sample"
-                return {
-                    "filename": filename,
-                    "type": "attachment",
-                    "data": data,
-                }
+            self.type = "attachment"
+        self.filename = part.get("filename", "") or TEXT_FILENAMES.get(
+            self.mime_type, "sample"
+        )
+        self._body = part.get("body", {})
+        self.size = self._body.get("size", 0)
+
+    def __repr__(self) -> str:
+        return f"Part(filename={self.filename!r}, type={self.type!r}, size={self.size})"
+
+    def __getitem__(self, key: str):
+        if key not in ("filename", "type", "data"):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    @property
+    def attachment_id(self) -> Optional[str]:
+        return self._body.get("attachmentId")
+
+    def _encoded(self) -> str:
+        """base64url encoded content, downloaded if it is an attachment"""
+        if self._body.get("data"):
+            return self._body["data"]
+        return self.message._get_attachment_data(self.attachment_id)
+
+    @property
+    def content(self) -> bytes:
+        """Decoded content"""
+        return urlsafe_b64decode(self._encoded())
+
+    @property
+    def data(self):
+        """Decoded text (str) for text parts, bytes for attachments"""
+        if self.type == "attachment":
+            return self.content
+        return self.content.decode()
+
+    def save(self, path, chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+        """Decode the content straight into a file
+
+        The content is decoded chunk by chunk instead of building the full
+        bytes object. The base64 text of an attachment is still downloaded
+        whole first, googleapiclient reads the full response before parsing
+        it, so memory use is about the size of the encoded attachment.
+
+        Returns:
+            Number of bytes written.
+        """
+        encoded = self._encoded()
+        # 4 base64 characters decode to 3 bytes
+        step = max(4, chunk_size // 3 * 4)
+        written = 0
+        with open(path, "wb") as f:
+            for start in range(0, len(encoded), step):
+                end = start + step
+                chunk = encoded[start:end]
+                chunk += "=" * (-len(chunk) % 4)
+                written += f.write(urlsafe_b64decode(chunk))
+        return written
 
 
 class MessageClient(GmailClient):
-    def __init__(self, client_secret: dict, refresh_token: str) -> None:
-        super().__init__(client_secret, refresh_token)
+    def __init__(
+        self,
+        client_secret: Optional[dict] = None,
+        refresh_token: Optional[str] = None,
+        store: Optional[MessageStore] = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(client_secret, refresh_token, **kwargs)
         self.client = self.service.users().messages()
+        # Optional persistent cache of messages. Writes of this client update
+        # it, changes made elsewhere come from applying SyncEngine events.
+        self.store = store
 
     def delete(self, id: str) -> None:
         """Delete message from mail box.
@@ -208,11 +406,124 @@ class MessageClient(GmailClient):
         Dangerous, suggest to use trash instead.
         """
         self.client.delete(userId="me", id=id).execute()
+        if self.store is not None:
+            self.store.delete(id)
 
-    def get(self, id: str) -> Message:
-        """Get message message by its id"""
-        message: dict = self.client.get(userId="me", id=id).execute()
-        return Message(raw_data=message, client=self.client)
+    def _store_labels(self, message: dict) -> None:
+        """Save the labels returned by a write of one message to the store"""
+        if self.store is not None and "labelIds" in message:
+            self.store.update_labels(message["id"], message["labelIds"])
+
+    def get(
+        self,
+        id: str,
+        format: str = "full",
+        metadata_headers: Optional[List[str]] = None,
+        fields: Optional[str] = None,
+    ) -> Message:
+        """Get message message by its id
+
+        Ask for less than the full message to shrink the payload. Ex. header
+        only triage can use format="metadata", metadata_headers=["Subject", "From"].
+
+        Arguments:
+            id (str): Message id.
+            format (str): minimal, metadata, full or raw.
+            metadata_headers (list): Headers to return when format is metadata. None means all.
+            fields (str): Partial response mask. Ex. "id,labelIds,payload/headers"
+        """
+        use_store = self._use_store(format, metadata_headers, fields)
+        if use_store:
+            message = self.store.get(id, format=format)
+            if message is not None:
+                return Message(
+                    raw_data=message, client=self.client, label_index=self.label_index
+                )
+        message: dict = self.client.get(
+            **self._get_params(id, format, metadata_headers, fields)
+        ).execute()
+        if use_store:
+            self.store.put(message, format=format)
+        return Message(
+            raw_data=message,
+            client=self.client,
+            metadata_headers=metadata_headers,
+            label_index=self.label_index,
+        )
+
+    def _use_store(
+        self,
+        format: str,
+        metadata_headers: Optional[List[str]],
+        fields: Optional[str],
+    ) -> bool:
+        """Only complete messages of a format go through the store"""
+        return self.store is not None and not metadata_headers and fields is None
+
+    def get_many(
+        self,
+        ids: Iterable[str],
+        format: str = "full",
+        metadata_headers: Optional[List[str]] = None,
+        fields: Optional[str] = None,
+        batch_size: int = MAX_BATCH_SIZE,
+        max_workers: int = 4,
+    ) -> BatchResult:
+        """Get many messages with batch requests
+
+        Instead of one round trip per message, ids are grouped into Gmail batch
+        requests and several batches are sent concurrently. Messages found in
+        the store are not requested.
+
+        Arguments:
+            ids (Iterable[str]): Message ids. Ex. the ids returned by list.
+            format (str): minimal, metadata, full or raw.
+            metadata_headers (list): Headers to return when format is metadata. None means all.
+            fields (str): Partial response mask applied to each message.
+            batch_size (int): Messages per batch request, up to 100.
+            max_workers (int): Number of batch requests in flight.
+
+        Returns:
+            A BatchResult. results is a list of Message in the same order as ids,
+            errors maps the id of each failed message to its HttpError.
+
+        """
+        ids = list(dict.fromkeys(ids))
+        use_store = self._use_store(format, metadata_headers, fields)
+        messages = {}
+        if use_store:
+            for id in ids:
+                message = self.store.get(id, format=format)
+                if message is not None:
+                    messages[id] = message
+
+        missing = [id for id in ids if id not in messages]
+        result = execute_batched(
+            self,
+            missing,
+            lambda id: self.client.get(
+                **self._get_params(id, format, metadata_headers, fields)
+            ),
+            batch_size=batch_size,
+            max_workers=max_workers,
+        )
+        # results keep the order of the keys, the id may be masked out by fields
+        fetched = [id for id in missing if id not in result.errors]
+        for id, message in zip(fetched, result.results):
+            messages[id] = message
+            if use_store:
+                self.store.put(message, format=format)
+        result.results = [
+            Message(
+                raw_data=messages[id],
+                client=self.client,
+                metadata_headers=metadata_headers,
+                label_index=self.label_index,
+            )
+            for id in ids
+            if id in messages
+        ]
+        return result
 
     def list(
         self,
@@ -228,9 +539,10 @@ class MessageClient(GmailClient):
     ):
         """Create a query string from arguments and query all the results
 
-        Each query has the max results. The default value is 100. To make the arguments simple,
-        we do not change the maxResults parameter. Instead, we add a exhausted parameter to let
-        user to decide if query to the end.
+        Without exhausted, one page is requested with the default maxResults of
+        gmail, 100, and nextPageToken tells how to get the next one. With
+        exhausted, pages of maxResults=500 are requested until the end, like
+        iter_messages does, and the messages are returned in one list.
 
         Ref:
             https://developers.google.com/gmail/api/reference/rest/v1/users.messages/list
@@ -253,21 +565,24 @@ class MessageClient(GmailClient):
             nextPageToken: A token which is used to get next page data. If exhausted is True, this item will be empty string.
 
         """
-        # Build the query string
-        criteria_list = []
-        if search_string is not None:
-            criteria_list.append(search_string)
-        if before is not None:
-            criteria_list.append(f"before:{before}")
-        if after is not None:
-            criteria_list.append(f"after:{after}")
-        if read is not None:
-            criteria_list.append(f"is:{'read' if read else 'unread'}")
-        if from_ is not None:
-            criteria_list.append(f"from:{from_}")
-        if to is not None:
-            criteria_list.append(f"to:{to}")
-        query_string = " ".join(criteria_list)
+        query_string = build_query_string(
+            search_string=search_string,
+            before=before,
+            after=after,
+            read=read,
+            from_=from_,
+            to=to,
+        )
+
+        if exhausted:
+            # Throttling is done by the rate limiter under every request
+            total_result = self._iter_list(
+                "messages",
+                query_string=query_string,
+                include_spam_trash=include_spam_trash,
+                page_token=page_token,
+            )
+            return {"messages": list(total_result), "nextPageToken": ""}
 
         if query_string:
             result = self.client.list(
@@ -282,22 +597,88 @@ class MessageClient(GmailClient):
                 pageToken=page_token,
                 includeSpamTrash=include_spam_trash,
             ).execute()
+        result.pop("resultSizeEstimate")
+        return result
+
+    def iter_messages(
+        self,
+        search_string: Optional[str] = None,
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        read: Optional[bool] = None,
+        from_: Optional[str] = None,
+        to: Optional[str] = None,
+        include_spam_trash: bool = False,
+        page_token: Optional[str] = None,
+        limit: Optional[int] = None,
+        page_size: int = MAX_PAGE_SIZE,
+    ) -> Iterator[dict]:
+        """Iterate over the messages matching the arguments
 
-        if not exhausted or (exhausted and not result.get("nextPageToken")):
-            result.pop("resultSizeEstimate")
-            return result
+        Unlike list with exhausted=True, messages are yielded as soon as each page
+        arrives and only one page is held in memory, so the memory usage does not
+        grow with the size of the mailbox.
 
-        total_result = result["messages"]
-        while result.get("nextPageToken"):
-            # max limit is 250 units per second
-            time.sleep(1)
-            result = self.client.list(
-                userId="me",
-                q=query_string,
-                pageToken=result["nextPageToken"],
-            ).execute()
-            total_result.extend(result["messages"])
-        return {"messages": total_result, "nextPageToken": ""}
+        Arguments:
+            search_string, before, after, read, from_, to: Same as list.
+            include_spam_trash (bool): Include messages from SPAM and TRASH.
+            page_token (str): Start from a specific page.
+            limit (int): Stop after this many messages. None means all of them.
+            page_size (int): Messages requested per page, up to 500.
+
+        Yields:
+            dict: The element of messages in list result. Ex. {"id": ..., "threadId": ...}
+
+        """
+        query_string = build_query_string(
+            search_string=search_string,
+            before=before,
+            after=after,
+            read=read,
+            from_=from_,
+            to=to,
+        )
+        return self._iter_list(
+            "messages",
+            query_string=query_string,
+            include_spam_trash=include_spam_trash,
+            page_token=page_token,
+            limit=limit,
+            page_size=page_size,
+        )
+
+    def list_ids(
+        self,
+        search_string: Optional[str] = None,
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        read: Optional[bool] = None,
+        from_: Optional[str] = None,
+        to: Optional[str] = None,
+        include_spam_trash: bool = False,
+        key: str = "id",
+    ) -> IdSet:
+        """Ids of the messages matching the arguments, packed in an IdSet
+
+        Pages are added to the IdSet as they arrive. The ids of 2M messages take
+        16 MB, instead of the hundreds of MB of list with exhausted=True.
+
+        Arguments:
+            search_string, before, after, read, from_, to, include_spam_trash: Same as iter_messages.
+            key (str): id, or threadId for the ids of the threads of the messages.
+        """
+        return IdSet.from_refs(
+            self.iter_messages(
+                search_string=search_string,
+                before=before,
+                after=after,
+                read=read,
+                from_=from_,
+                to=to,
+                include_spam_trash=include_spam_trash,
+            ),
+            key=key,
+        )
 
     def modify(
         self,
@@ -305,78 +686,190 @@ class MessageClient(GmailClient):
         add_label_ids: Optional[List[str]] = None,
         remove_label_ids: Optional[List[str]] = None,
     ) -> None:
+        """Modify the labels of a message. Label names are accepted as well as ids."""
         body = {}
         if add_label_ids:
-            body["addLabelIds"] = add_label_ids
+            body["addLabelIds"] = self.label_index.resolve(add_label_ids)
         if remove_label_ids:
-            body["removeLabelIds"] = remove_label_ids
-        self.client.modify(userId="me", id=id, body=body).execute()
+            body["removeLabelIds"] = self.label_index.resolve(remove_label_ids)
+        self._store_labels(self.client.modify(userId="me", id=id, body=body).execute())
 
     def send(
         self,
         to: str,
-        cc: str,
-        subject: str,
-        content: str,
-        attachment_path: str,
-    ):
-        """This method will create a draft and send."""
-        message = EmailMessage()
-        message.set_content(content)
-        message["To"] = to
-        message["From"] = "aaa"
-        message["Subject"] = subject
+        cc: Optional[str] = None,
+        subject: str = "",
+        content: str = "",
+        attachment_path: Optional[str] = None,
+        attachments: Optional[Iterable[Attachment]] = None,
+        from_: Optional[str] = None,
+        headers: Optional[dict] = None,
+        resumable_threshold: int = RESUMABLE_THRESHOLD,
+        chunk_size: int = UPLOAD_CHUNK_SIZE,
+    ) -> dict:
+        """Send a message
+
+        The message is written to a spooled temporary file, attachments a chunk
+        at a time. Messages up to resumable_threshold bytes are sent in one
+        request. Larger ones are uploaded in chunks through the resumable
+        upload endpoint; a failed chunk is retried by the retry policy and the
+        upload resumes where gmail says it stopped. Memory use stays around
+        chunk_size, whatever the size of the message.
+
+        Arguments:
+            to (str): Recipients.
+            cc (str): Cc recipients.
+            subject (str): Subject.
+            content (str): Text body.
+            attachment_path (str): Path of a file to attach. Same as attachments=[attachment_path].
+            attachments (Iterable): Paths, or (filename, binary file object) pairs.
+            from_ (str): Sender. Gmail uses the authenticated user when None.
+            headers (dict): Extra headers.
+            resumable_threshold (int): Size in bytes above which the resumable upload is used.
+            chunk_size (int): Bytes per upload request. A multiple of 256 KB.
+
+        Returns:
+            The sent message resource, with id, threadId and labelIds.
+        """
+        if attachment_path is not None:
+            attachments = [attachment_path, *(attachments or [])]
+        with SpooledTemporaryFile(max_size=resumable_threshold) as spool:
+            size = write_mime(
+                spool,
+                to=to,
+                subject=subject,
+                content=content,
+                cc=cc,
+                from_=from_,
+                attachments=attachments,
+                headers=headers,
+            )
+            spool.seek(0)
+            return self.send_mime(spool, size, resumable_threshold, chunk_size)
+
+    def send_mime(
+        self,
+        fp: BinaryIO,
+        size: int,
+        resumable_threshold: int = RESUMABLE_THRESHOLD,
+        chunk_size: int = UPLOAD_CHUNK_SIZE,
+    ) -> dict:
+        """Send an RFC 822 message read from a binary file
 
-        # attachment file
-        attachment_filename = os.path.basename(attachment_path)
-        # guessing the MIME type
-        type_subtype = (mimetypes.guess_type(attachment_filename))[0] or ""
-        maintype, subtype = type_subtype.split("/")
+        Arguments:
+            fp (BinaryIO): Seekable file positioned at the start of the message.
+            size (int): Size of the message in bytes.
+            resumable_threshold, chunk_size: Same as send.
 
-        with open(attachment_filename, "rb") as fp:
-            attachment_data = fp.read()
-        message.add_attachment(attachment_data, maintype, subtype)
+        Returns:
+            The sent message resource.
+        """
+        # execute uploads chunk by chunk. After a failed chunk, the retry
+        # asks gmail how much it received and continues from there.
+        return self.send_mime_request(
+            fp, size, resumable_threshold, chunk_size
+        ).execute()
 
-        # encoded message
-        encoded_message = urlsafe_b64encode(message.as_bytes()).decode()
+    def send_mime_request(
+        self,
+        fp: BinaryIO,
+        size: int,
+        resumable_threshold: int = RESUMABLE_THRESHOLD,
+        chunk_size: int = UPLOAD_CHUNK_SIZE,
+    ) -> "HttpRequest":
+        """The messages.send request of send_mime, not executed yet
+
+        Executing it again after an error resumes a resumable upload.
+        """
+        if size <= resumable_threshold:
+            raw = urlsafe_b64encode(fp.read()).decode()
+            return self.client.send(userId="me", body={"raw": raw})
 
-        create_message = {"raw": encoded_message}
-        self.client.send(userId="me", body=create_message).execute()
+        from googleapiclient.http import MediaIoBaseUpload
+
+        media = MediaIoBaseUpload(
+            fp, mimetype="message/rfc822", chunksize=chunk_size, resumable=True
+        )
+        return self.client.send(userId="me", media_body=media)
 
     def trash(self, id: str) -> None:
         """Move message to trash."""
-        self.client.trash(userId="me", id=id).execute()
+        self._store_labels(self.client.trash(userId="me", id=id).execute())
 
     def untrash(self, id: str) -> None:
         """Untrash message."""
-        self.client.untrash(userId="me", id=id).execute()
+        self._store_labels(self.client.untrash(userId="me", id=id).execute())
 
     def batch_modify(
         self,
-        ids: List[str],
+        ids: Iterable[str],
         add_label_ids: Optional[List[str]] = None,
         remove_label_ids: Optional[List[str]] = None,
-    ) -> None:
-        body = {"ids": ids}
+        chunk_size: int = MAX_BULK_IDS,
+        max_workers: int = 4,
+    ) -> BulkResult:
+        """Modify the labels of any number of messages
+
+        Gmail accepts at most 1000 ids per batchModify, so the ids are sent in
+        chunks, up to max_workers at a time. See execute_chunked.
+
+        Arguments:
+            ids (Iterable[str]): Message ids. A generator or an IdSet works as well.
+            add_label_ids (list): Label ids or names to add.
+            remove_label_ids (list): Label ids or names to remove.
+            chunk_size (int): Ids per request, up to 1000.
+            max_workers (int): Requests in flight.
+
+        Returns:
+            BulkResult with the succeeded and failed ids.
+        """
+        body = {}
         if add_label_ids:
-            body["addLabelIds"] = add_label_ids
+            body["addLabelIds"] = self.label_index.resolve(add_label_ids)
         if remove_label_ids:
-            body["removeLabelIds"] = remove_label_ids
-        self.client.batchModify(userId="me", body=body).execute()
+            body["removeLabelIds"] = self.label_index.resolve(remove_label_ids)
+        result = execute_chunked(
+            ids,
+            lambda chunk: self.client.batchModify(
+                userId="me", body={"ids": chunk, **body}
+            ),
+            chunk_size=chunk_size,
+            max_workers=max_workers,
+        )
+        if self.store is not None:
+            self.store.change_labels(
+                result.succeeded, body.get("addLabelIds"), body.get("removeLabelIds")
+            )
+        return result
 
-    def batch_trash(self, ids: List[str]) -> None:
+    def batch_trash(self, ids: Iterable[str], **kwargs) -> BulkResult:
         """Batch move messages into trash can"""
-        self.batch_modify(ids=ids, add_label_ids=["TRASH"])
+        return self.batch_modify(ids=ids, add_label_ids=["TRASH"], **kwargs)
 
-    def batch_untrash(self, ids: List[str]) -> None:
+    def batch_untrash(self, ids: Iterable[str], **kwargs) -> BulkResult:
         """Batch move messages out of trash can"""
-        self.batch_modify(ids=ids, remove_label_ids=["TRASH"])
+        return self.batch_modify(ids=ids, remove_label_ids=["TRASH"], **kwargs)
 
-    def batch_delete(self, ids: List[str]) -> None:
+    def batch_delete(
+        self,
+        ids: Iterable[str],
+        chunk_size: int = MAX_BULK_IDS,
+        max_workers: int = 4,
+    ) -> BulkResult:
         """Batch delete messages
 
         Should be very careful since this method will completely delete the messages.
         You can use batch_trash instead to put messages into trash can.
 
+        Ids are sent in chunks of up to 1000 like batch_modify.
+
         """
-        self.client.batchDelete(userId="me", body={"ids": ids}).execute()
+        result = execute_chunked(
+            ids,
+            lambda chunk: self.client.batchDelete(userId="me", body={"ids": chunk}),
+            chunk_size=chunk_size,
+            max_workers=max_workers,
+        )
+        if self.store is not None:
+            self.store.delete_many(result.succeeded)
+        return result
@@ -0,0 +1,348 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+@dataclass(frozen=True)
+class RequestEvent:
+    """One HTTP attempt of an api call
+
+    method (str): Method id, ex. gmail.users.messages.get. "batch" for a batch request.
+    status (int): HTTP status of the last response, 0 when no response was received.
+    seconds (float): Latency, from sending the request to the deserialized response.
+    bytes_sent (int): Request body bytes, summed over the chunks of an upload.
+    bytes_received (int): Response body bytes after decompression.
+    quota_units (int): Quota units charged. 0 for a batch, its sub-requests have their own events.
+    attempt (int): 1 for the first attempt, 2 for the first retry and so on.
+    batch_size (int): Sub-requests of a batch request, 0 otherwise.
+    error (str): Reason of the error, ex. rateLimitExceeded. None on success.
+    """
+
+    method: str
+    status: int
+    seconds: float
+    bytes_sent: int
+    bytes_received: int
+    quota_units: int
+    attempt: int = 1
+    batch_size: int = 0
+    error: Optional[str] = None
+
+
+Sink = Callable[[RequestEvent], None]
+
+
+class _Recorder:
+    """Wraps an http object to count the bytes and keep the status of its responses"""
+
+    def __init__(self, http) -> None:
+        self.http = http
+        self.status = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        response, content = self.http.request(uri, method, body, headers, **kwargs)
+        length = {k.lower(): v for k, v in (headers or {}).items()}.get(
+            "content-length"
+        )
+        if length is not None:
+            # Chunks of uploads are file objects
+            self.bytes_sent += int(length)
+        elif isinstance(body, (str, bytes)):
+            self.bytes_sent += len(body)
+        self.bytes_received += len(content or b"")
+        self.status = response.status
+        return response, content
+
+    def __getattr__(self, name: str):
+        # googleapiclient looks for credentials on the http object
+        return getattr(self.http, name)
+
+
+class Instrumentation:
+    """Sends a RequestEvent of every api call to the sinks
+
+    Every request of a session goes through its instrumentation, including
+    retries and upload chunks. A batch request emits a "batch" event with its
+    latency and bytes, and every sub-request emits an event of its own method
+    with its status, error and quota units. Sub-request events carry the
+    latency of their batch and no bytes, and the batch event no quota units,
+    so totals are not counted twice. Without sinks the requests are sent as
+    they are and nothing is measured.
+
+        histogram = HistogramSink()
+        session.instrumentation.add_sink(histogram)
+
+    Sinks are called from the thread which made the request and should be quick.
+    """
+
+    def __init__(self, sinks: Optional[List[Sink]] = None) -> None:
+        self.sinks: List[Sink] = list(sinks or [])
+
+    def __bool__(self) -> bool:
+        return bool(self.sinks)
+
+    def add_sink(self, sink: Sink) -> None:
+        self.sinks = [*self.sinks, sink]
+
+    def remove_sink(self, sink: Sink) -> None:
+        self.sinks = [s for s in self.sinks if s is not sink]
+
+    def emit(self, event: RequestEvent) -> None:
+        for sink in self.sinks:
+            sink(event)
+
+    def emit_sub_request(
+        self,
+        method: str,
+        seconds: float,
+        quota_units: int,
+        attempt: int,
+        error: Optional[Exception] = None,
+    ) -> None:
+        """Emit the event of a sub-request answered inside a batch
+
+        Its bytes are counted by the event of the batch request.
+        """
+        from .retry import error_reason
+
+        if error is None:
+            status, reason = 200, None
+        elif getattr(error, "resp", None) is not None:
+            status = error.resp.status
+            reason = error_reason(error) or str(status)
+        else:
+            status, reason = 0, type(error).__name__
+        self.emit(
+            RequestEvent(
+                method=method,
+                status=status,
+                seconds=seconds,
+                bytes_sent=0,
+                bytes_received=0,
+                quota_units=quota_units,
+                attempt=attempt,
+                error=reason,
+            )
+        )
+
+    @contextmanager
+    def measure(
+        self,
+        http,
+        method: str,
+        quota_units: int,
+        attempt: int = 1,
+        batch_size: int = 0,
+    ) -> Iterator[_Recorder]:
+        """Time the requests sent through the yielded http object and emit one event"""
+        # Imported here, googleapiclient is loaded lazily
+        from googleapiclient.errors import HttpError
+
+        from .retry import error_reason
+
+        recorder = _Recorder(http)
+        error = None
+        start = time.perf_counter()
+        try:
+            yield recorder
+        except HttpError as exc:
+            error = error_reason(exc) or str(exc.resp.status)
+            raise
+        except Exception as exc:
+            error = type(exc).__name__
+            raise
+        finally:
+            self.emit(
+                RequestEvent(
+                    method=method,
+                    status=recorder.status,
+                    seconds=time.perf_counter() - start,
+                    bytes_sent=recorder.bytes_sent,
+                    bytes_received=recorder.bytes_received,
+                    quota_units=quota_units,
+                    attempt=attempt,
+                    batch_size=batch_size,
+                    error=error,
+                )
+            )
+
+
+# Shared by every session which is not given its own instrumentation.
+default_instrumentation = Instrumentation()
+
+
+@dataclass
+class MethodStats:
+    """Totals of one method in a HistogramSink"""
+
+    # One count per latency bucket, and one over the last bound
+    bucket_counts: List[int]
+    count: int = 0
+    errors: int = 0
+    retries: int = 0
+    seconds: float = 0.0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    quota_units: int = 0
+
+
+class HistogramSink:
+    """Keeps latency histograms and totals by method in memory
+
+    Arguments:
+        buckets (tuple): Upper bounds in seconds of the latency buckets.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(sorted(buckets))
+        self.methods: Dict[str, MethodStats] = {}
+        self.statuses: Dict[Tuple[str, int], int] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event: RequestEvent) -> None:
+        with self._lock:
+            stats = self.methods.get(event.method)
+            if stats is None:
+                stats = self.methods[event.method] = MethodStats(
+                    bucket_counts=[0] * (len(self.buckets) + 1)
+                )
+            stats.count += 1
+            stats.errors += event.error is not None
+            stats.retries += event.attempt > 1
+            stats.seconds += event.seconds
+            stats.bytes_sent += event.bytes_sent
+            stats.bytes_received += event.bytes_received
+            stats.quota_units += event.quota_units
+            stats.bucket_counts[bisect_left(self.buckets, event.seconds)] += 1
+            key = (event.method, event.status)
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+
+    def quantile(self, method: str, q: float) -> float:
+        """Upper bound of the bucket holding the q quantile of a method's latency"""
+        # Copied under the lock, the sink may be adding an event meanwhile
+        with self._lock:
+            stats = self.methods[method]
+            total = stats.count
+            bucket_counts = list(stats.bucket_counts)
+        rank = q * total
+        seen = 0
+        for bound, count in zip(self.buckets, bucket_counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self) -> Dict[str, dict]:
+        """Totals by method, ex. for logging"""
+        with self._lock:
+            return {
+                method: {
+                    "count": stats.count,
+                    "errors": stats.errors,
+                    "retries": stats.retries,
+                    "seconds": stats.seconds,
+                    "bytes_sent": stats.bytes_sent,
+                    "bytes_received": stats.bytes_received,
+                    "quota_units": stats.quota_units,
+                }
+                for method, stats in self.methods.items()
+            }
+
+
+class PrometheusExporter:
+    """Renders a HistogramSink in the Prometheus text format
+
+        histogram = HistogramSink()
+        session.instrumentation.add_sink(histogram)
+        PrometheusExporter(histogram).serve(9464)
+
+    Arguments:
+        histogram (HistogramSink): Where the metrics come from.
+        prefix (str): Prefix of the metric names.
+    """
+
+    def __init__(self, histogram: HistogramSink, prefix: str = "momomail") -> None:
+        self.histogram = histogram
+        self.prefix = prefix
+
+    def render(self) -> str:
+        p = self.prefix
+        histogram = self.histogram
+        with histogram._lock:
+            methods = sorted(histogram.methods.items())
+            statuses = sorted(histogram.statuses.items())
+            lines = [
+                f"# HELP {p}_request_seconds Latency of gmail api requests.",
+                f"# TYPE {p}_request_seconds histogram",
+            ]
+            for method, stats in methods:
+                cumulative = 0
+                bounds = [*map(repr, histogram.buckets), "+Inf"]
+                for bound, count in zip(bounds, stats.bucket_counts):
+                    cumulative += count
+                    lines.append(
+                        f'{p}_request_seconds_bucket{{method="{method}",le="{bound}"}} {cumulative}'
+                    )
+                lines.append(
+                    f'{p}_request_seconds_sum{{method="{method}"}} {stats.seconds}'
+                )
+                lines.append(
+                    f'{p}_request_seconds_count{{method="{method}"}} {stats.count}'
+                )
+            lines += [
+                f"# HELP {p}_requests_total Gmail api requests by status.",
+                f"# TYPE {p}_requests_total counter",
+            ]
+            for (method, status), count in statuses:
+                lines.append(
+                    f'{p}_requests_total{{method="{method}",status="{status}"}} {count}'
+                )
+            for name, help in (
+                ("retries", "Retried requests."),
+                ("bytes_sent", "Request body bytes."),
+                ("bytes_received", "Response body bytes."),
+                ("quota_units", "Quota units charged."),
+            ):
+                lines += [
+                    f"# HELP {p}_{name}_total {help}",
+                    f"# TYPE {p}_{name}_total counter",
+                ]
+                for method, stats in methods:
+                    lines.append(
+                        f'{p}_{name}_total{{method="{method}"}} {getattr(stats, name)}'
+                    )
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int = 9464, address: str = ""):
+        """Serve the metrics over HTTP from a daemon thread
+
+        Returns:
+            The HTTPServer. Call shutdown() to stop it.
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                body = exporter.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        server = ThreadingHTTPServer((address, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
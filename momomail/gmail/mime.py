@@ -0,0 +1,116 @@
+import mimetypes
+import os
+import uuid
+from base64 import encodebytes
+from email.message import EmailMessage
+from io import BytesIO
+from pathlib import Path
+from typing import BinaryIO, Iterable, Optional, Tuple, Union
+
+# Bytes of attachment read per step. A multiple of 57, so every step encodes
+# to whole 76 character base64 lines.
+ENCODE_CHUNK_SIZE = 57 * 4096
+
+Attachment = Union[str, Path, Tuple[str, BinaryIO], "EncodedPart"]
+
+
+def _open_attachment(attachment: Attachment) -> Tuple[str, BinaryIO, bool]:
+    """Filename, file object and whether it was opened here"""
+    if isinstance(attachment, tuple):
+        filename, fp = attachment
+        return filename, fp, False
+    return os.path.basename(attachment), open(attachment, "rb"), True
+
+
+class EncodedPart(bytes):
+    """An attachment part encoded beforehand by encode_attachment"""
+
+
+def write_attachment(fp: BinaryIO, attachment: Attachment) -> None:
+    """Write the headers and base64 body of an attachment part"""
+    filename, source, opened = _open_attachment(attachment)
+    try:
+        part = EmailMessage()
+        part["Content-Type"] = (
+            mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        )
+        part.add_header("Content-Disposition", "attachment", filename=filename)
+        part["Content-Transfer-Encoding"] = "base64"
+        fp.write(part.as_bytes())
+        while True:
+            chunk = source.read(ENCODE_CHUNK_SIZE)
+            if not chunk:
+                break
+            fp.write(encodebytes(chunk))
+    finally:
+        if opened:
+            source.close()
+
+
+def encode_attachment(attachment: Attachment) -> EncodedPart:
+    """Encode an attachment part once, to put it in many messages"""
+    buffer = BytesIO()
+    write_attachment(buffer, attachment)
+    return EncodedPart(buffer.getvalue())
+
+
+def write_mime(
+    fp: BinaryIO,
+    to: str,
+    subject: str = "",
+    content: str = "",
+    cc: Optional[str] = None,
+    from_: Optional[str] = None,
+    attachments: Optional[Iterable[Attachment]] = None,
+    headers: Optional[dict] = None,
+) -> int:
+    """Write an RFC 822 message to a binary file
+
+    Attachments are read and base64 encoded a chunk at a time, so the message
+    is never held in memory as a whole.
+
+    Arguments:
+        fp (BinaryIO): File to write to.
+        to, subject, content, cc, from_: Headers and text body. Gmail fills in From when it is None.
+        attachments (Iterable): Paths, (filename, binary file object) pairs or EncodedPart.
+        headers (dict): Extra headers. Ex. {"Message-ID": "<...>"}
+
+    Returns:
+        Number of bytes written.
+    """
+    start = fp.tell()
+    root = EmailMessage()
+    root["To"] = to
+    if cc:
+        root["Cc"] = cc
+    if from_:
+        root["From"] = from_
+    root["Subject"] = subject
+    for name, value in (headers or {}).items():
+        root[name] = value
+    attachments = list(attachments or [])
+    if not attachments:
+        root.set_content(content)
+        fp.write(root.as_bytes())
+        return fp.tell() - start
+
+    boundary = f"=============={uuid.uuid4().hex}=="
+    root["MIME-Version"] = "1.0"
+    root["Content-Type"] = f'multipart/mixed; boundary="{boundary}"'
+    for name, value in root.items():
+        fp.write(root.policy.fold_binary(name, value))
+    fp.write(b"\n")
+
+    delimiter = f"--{boundary}\n".encode()
+    text = EmailMessage()
+    text.set_content(content)
+    fp.write(delimiter)
+    fp.write(text.as_bytes())
+    for attachment in attachments:
+        fp.write(b"\n" + delimiter)
+        if isinstance(attachment, EncodedPart):
+            fp.write(attachment)
+        else:
+            write_attachment(fp, attachment)
+    fp.write(f"\n--{boundary}--\n".encode())
+    return fp.tell() - start
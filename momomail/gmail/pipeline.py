@@ -0,0 +1,257 @@
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional
+
+from .batch import MAX_BATCH_SIZE, chunked
+from .message import Message, MessageClient
+
+# Marks the end of the items of a queue
+_DONE = object()
+
+
+@dataclass
+class StageStats:
+    """Time spent by a stage of a Pipeline
+
+    name (str): list, fetch or handle.
+    workers (int): Threads running the stage.
+    items (int): Ids listed, messages fetched or messages handled.
+    busy (float): Seconds spent working, summed over the workers.
+    waiting (float): Seconds spent waiting for input from the previous stage.
+    blocked (float): Seconds spent waiting for room in the queue of the next stage.
+    """
+
+    name: str
+    workers: int = 1
+    items: int = 0
+    busy: float = 0.0
+    waiting: float = 0.0
+    blocked: float = 0.0
+
+    def add(self, items: int = 0, busy=0.0, waiting=0.0, blocked=0.0) -> None:
+        self.items += items
+        self.busy += busy
+        self.waiting += waiting
+        self.blocked += blocked
+
+
+@dataclass
+class PipelineStats:
+    """Result of Pipeline.run
+
+    stages (dict): StageStats of list, fetch and handle.
+    failed (dict): Map from message id to the error of its fetch.
+    seconds (float): Time spent by the run.
+    """
+
+    stages: Dict[str, StageStats] = field(default_factory=dict)
+    failed: dict = field(default_factory=dict)
+    seconds: float = 0.0
+
+    def utilization(self, name: str) -> float:
+        """Share of the run a stage was busy, 1.0 means all its workers always worked"""
+        stage = self.stages[name]
+        if not self.seconds:
+            return 0.0
+        return stage.busy / (stage.workers * self.seconds)
+
+    @property
+    def bottleneck(self) -> str:
+        """Name of the busiest stage"""
+        return max(self.stages, key=self.utilization)
+
+
+class Pipeline:
+    """List, fetch and handle messages at the same time
+
+    One thread pages through the ids, `fetch_workers` threads fetch them with
+    batch requests and the handler is called with each Message in the calling
+    thread. The stages are connected by bounded queues, so fetching starts
+    with the first page of ids, and a slow handler holds back fetching instead
+    of piling messages up in memory. At most about
+    `(2 * queue_size + fetch_workers) * batch_size` messages are held at a time.
+
+        pipeline = Pipeline(MessageClient.setup(), handler=print, format="metadata")
+        stats = pipeline.run(search_string="from:bank")
+        print(stats.bottleneck, stats.utilization("fetch"))
+
+    Arguments:
+        client (MessageClient): Client to list and fetch messages with.
+        handler (Callable): Called with each Message.
+        format (str): minimal, metadata or full.
+        metadata_headers (list): Headers to return when format is metadata. None means all.
+        batch_size (int): Messages per batch request, up to 100.
+        fetch_workers (int): Batch requests in flight.
+        queue_size (int): Batches held between two stages.
+    """
+
+    def __init__(
+        self,
+        client: MessageClient,
+        handler: Callable[[Message], None],
+        format: str = "full",
+        metadata_headers: Optional[List[str]] = None,
+        batch_size: int = MAX_BATCH_SIZE,
+        fetch_workers: int = 4,
+        queue_size: int = 4,
+    ) -> None:
+        self.client = client
+        self.handler = handler
+        self.format = format
+        self.metadata_headers = metadata_headers
+        self.batch_size = batch_size
+        self.fetch_workers = fetch_workers
+        self.queue_size = queue_size
+
+    def run(self, ids: Optional[Iterable] = None, **list_kwargs) -> PipelineStats:
+        """Run the pipeline until every message is handled
+
+        Arguments:
+            ids (Iterable): Message ids, or dicts with an id key as yielded by iter_messages.
+                If None, the messages matching list_kwargs are listed.
+            list_kwargs: Arguments of MessageClient.iter_messages. Ex. search_string, limit
+
+        Returns:
+            PipelineStats of the run.
+
+        Raises:
+            The first error raised by the handler, by listing or by a fetch worker.
+            The other stages are stopped first.
+        """
+        if ids is None:
+            ids = self.client.iter_messages(**list_kwargs)
+        stats = PipelineStats(
+            stages={
+                "list": StageStats("list"),
+                "fetch": StageStats("fetch", workers=self.fetch_workers),
+                "handle": StageStats("handle"),
+            }
+        )
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._errors: List[BaseException] = []
+        id_batches = queue.Queue(self.queue_size)
+        message_batches = queue.Queue(self.queue_size)
+
+        start = time.monotonic()
+        threads = [
+            threading.Thread(
+                target=self._guard, args=(self._list, ids, id_batches, stats)
+            )
+        ]
+        threads += [
+            threading.Thread(
+                target=self._guard,
+                args=(self._fetch, id_batches, message_batches, stats),
+            )
+            for _ in range(self.fetch_workers)
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            self._handle(message_batches, stats.stages["handle"])
+        except BaseException:
+            self._stop.set()
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+            stats.seconds = time.monotonic() - start
+        if self._errors:
+            raise self._errors[0]
+        return stats
+
+    def _guard(self, target: Callable, *args) -> None:
+        try:
+            target(*args)
+        except BaseException as error:
+            with self._lock:
+                self._errors.append(error)
+            self._stop.set()
+
+    def _put(self, q: queue.Queue, item) -> float:
+        """Put an item, giving up when the pipeline stops. Returns the seconds blocked."""
+        start = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        return time.monotonic() - start
+
+    def _get(self, q: queue.Queue):
+        """Get an item, or _DONE when the pipeline stops"""
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _list(self, ids: Iterable, out: queue.Queue, stats: PipelineStats) -> None:
+        stage = stats.stages["list"]
+        batches = chunked(
+            (id["id"] if isinstance(id, dict) else id for id in ids), self.batch_size
+        )
+        try:
+            while not self._stop.is_set():
+                start = time.monotonic()
+                batch = next(batches, None)
+                busy = time.monotonic() - start
+                if batch is None:
+                    stage.add(busy=busy)
+                    break
+                stage.add(len(batch), busy=busy, blocked=self._put(out, batch))
+        finally:
+            for _ in range(self.fetch_workers):
+                self._put(out, _DONE)
+
+    def _fetch(
+        self, source: queue.Queue, out: queue.Queue, stats: PipelineStats
+    ) -> None:
+        stage = stats.stages["fetch"]
+        try:
+            while True:
+                start = time.monotonic()
+                batch = self._get(source)
+                waited = time.monotonic() - start
+                if batch is _DONE:
+                    with self._lock:
+                        stage.add(waiting=waited)
+                    return
+                start = time.monotonic()
+                result = self.client.get_many(
+                    batch,
+                    format=self.format,
+                    metadata_headers=self.metadata_headers,
+                    batch_size=self.batch_size,
+                    max_workers=1,
+                )
+                busy = time.monotonic() - start
+                blocked = self._put(out, result.results)
+                with self._lock:
+                    stage.add(len(result.results), busy, waited, blocked)
+                    stats.failed.update(result.errors)
+        finally:
+            self._put(out, _DONE)
+
+    def _handle(self, source: queue.Queue, stage: StageStats) -> None:
+        running = self.fetch_workers
+        while running:
+            start = time.monotonic()
+            messages = self._get(source)
+            waited = time.monotonic() - start
+            if messages is _DONE:
+                stage.add(waiting=waited)
+                if self._stop.is_set():
+                    return
+                running -= 1
+                continue
+            start = time.monotonic()
+            for message in messages:
+                self.handler(message)
+            stage.add(len(messages), busy=time.monotonic() - start, waiting=waited)
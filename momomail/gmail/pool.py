@@ -0,0 +1,112 @@
+import threading
+import weakref
+from typing import Callable, Optional
+
+import httplib2
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
+
+# Google only compresses responses for user agents which contain "gzip".
+# Ref: https://developers.google.com/gmail/api/guides/performance
+USER_AGENT = "momomail (gzip)"
+
+
+class SharedCredentials(Credentials):
+    """Credentials which can be shared by threads
+
+    Only one thread refreshes the access token at a time. Threads which find
+    the token expired together wait for that refresh instead of each asking
+    for a new token.
+
+    on_refresh, if set, is called with the credentials after every refresh.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.on_refresh: Optional[Callable[["SharedCredentials"], None]] = None
+        self._refresh_lock = threading.Lock()
+
+    def refresh(self, request) -> None:
+        token = self.token
+        with self._refresh_lock:
+            # Another thread got a new token while this one was waiting
+            if self.token != token and self.valid:
+                return
+            super().refresh(request)
+            if self.on_refresh is not None:
+                self.on_refresh(self)
+
+    def __getstate__(self) -> dict:
+        state = super().__getstate__()
+        state.pop("_refresh_lock", None)
+        state.pop("on_refresh", None)
+        return state
+
+    def __setstate__(self, d: dict) -> None:
+        super().__setstate__(d)
+        self.on_refresh = None
+        self._refresh_lock = threading.Lock()
+
+
+class HttpPool:
+    """Thread-safe stand-in for httplib2.Http
+
+    httplib2.Http is not thread-safe, so the pool keeps one transport per
+    thread and hands each request to the transport of the calling thread. The
+    transports share the credentials and keep their connections alive between
+    requests. Every request asks for gzip compressed responses.
+
+    A service built with `http=pool` can be used by many worker threads at once.
+
+    Arguments:
+        credentials (Credentials): Credentials to authorize requests with. None sends requests as they are.
+        http_factory (Callable): Create the underlying transport of a thread.
+    """
+
+    def __init__(
+        self,
+        credentials: Optional[Credentials] = None,
+        http_factory: Callable[[], httplib2.Http] = httplib2.Http,
+    ) -> None:
+        self.credentials = credentials
+        self.http_factory = http_factory
+        self._local = threading.local()
+        self._transports = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    @property
+    def transport(self):
+        """Transport of the current thread"""
+        transport = getattr(self._local, "transport", None)
+        if transport is None:
+            transport = self.http_factory()
+            if self.credentials is not None:
+                transport = AuthorizedHttp(self.credentials, http=transport)
+            self._local.transport = transport
+            with self._lock:
+                self._transports.add(transport)
+        return transport
+
+    def request(
+        self,
+        uri: str,
+        method: str = "GET",
+        body=None,
+        headers: Optional[dict] = None,
+        **kwargs,
+    ):
+        headers = dict(headers or {})
+        user_agent = headers.get("user-agent", "")
+        if "gzip" not in user_agent:
+            headers["user-agent"] = f"{user_agent} {USER_AGENT}".strip()
+        headers.setdefault("accept-encoding", "gzip, deflate")
+        return self.transport.request(uri, method, body, headers, **kwargs)
+
+    def close(self) -> None:
+        """Close the connections of every thread"""
+        with self._lock:
+            transports = list(self._transports)
+        for transport in transports:
+            close = getattr(transport, "close", None)
+            if close is not None:
+                close()
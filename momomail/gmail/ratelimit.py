@@ -0,0 +1,123 @@
+import threading
+import time
+from typing import Callable, Optional
+
+# Quota units consumed by each method.
+# Ref: https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    "gmail.users.getProfile": 1,
+    "gmail.users.stop": 50,
+    "gmail.users.watch": 100,
+    "gmail.users.drafts.create": 10,
+    "gmail.users.drafts.delete": 10,
+    "gmail.users.drafts.get": 5,
+    "gmail.users.drafts.list": 5,
+    "gmail.users.drafts.send": 100,
+    "gmail.users.drafts.update": 15,
+    "gmail.users.history.list": 2,
+    "gmail.users.labels.create": 5,
+    "gmail.users.labels.delete": 5,
+    "gmail.users.labels.get": 1,
+    "gmail.users.labels.list": 1,
+    "gmail.users.labels.patch": 5,
+    "gmail.users.labels.update": 5,
+    "gmail.users.messages.batchDelete": 50,
+    "gmail.users.messages.batchModify": 50,
+    "gmail.users.messages.delete": 10,
+    "gmail.users.messages.get": 5,
+    "gmail.users.messages.import": 25,
+    "gmail.users.messages.insert": 25,
+    "gmail.users.messages.list": 5,
+    "gmail.users.messages.modify": 5,
+    "gmail.users.messages.send": 100,
+    "gmail.users.messages.trash": 5,
+    "gmail.users.messages.untrash": 5,
+    "gmail.users.messages.attachments.get": 5,
+    "gmail.users.threads.delete": 20,
+    "gmail.users.threads.get": 10,
+    "gmail.users.threads.list": 10,
+    "gmail.users.threads.modify": 10,
+    "gmail.users.threads.trash": 10,
+    "gmail.users.threads.untrash": 10,
+}
+
+# Settings methods are mostly 1 unit for reads and 5 units for writes. Use the
+# higher cost for anything not listed above.
+DEFAULT_QUOTA_UNITS = 5
+
+# Per-user rate limit: 15,000 quota units per user per minute.
+USER_UNITS_PER_SECOND = 250
+
+
+def quota_units(method_id: Optional[str]) -> int:
+    """Quota units of an api method. Ex. gmail.users.messages.get"""
+    return QUOTA_UNITS.get(method_id, DEFAULT_QUOTA_UNITS)
+
+
+class RateLimiter:
+    """Token bucket counted in quota units
+
+    The bucket holds up to `burst` units and refills at `units_per_second`.
+    Calls go through immediately while there are enough units left. After the
+    bucket is empty every caller waits for its own share of the refill, so the
+    throughput slows down smoothly to `units_per_second` instead of stopping.
+
+    The limiter is thread-safe, one instance can be shared by all clients of
+    the same user.
+
+    Arguments:
+        units_per_second (float): Sustained rate. Default is the per-user quota.
+        burst (float): Bucket size. Default is one second of units_per_second.
+        clock (Callable): Monotonic clock in seconds. Replaceable for testing.
+        sleep (Callable): Sleep function. Replaceable for testing.
+    """
+
+    def __init__(
+        self,
+        units_per_second: float = USER_UNITS_PER_SECOND,
+        burst: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ) -> None:
+        if units_per_second <= 0:
+            raise ValueError("units_per_second should be positive.")
+        self.units_per_second = units_per_second
+        self.burst = burst if burst is not None else units_per_second
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = self.burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, units: float) -> float:
+        """Take units from the bucket
+
+        Returns:
+            Seconds the caller should wait before sending the request.
+        """
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(
+                self.burst,
+                self._tokens + (now - self._updated) * self.units_per_second,
+            )
+            self._updated = now
+            self._tokens -= units
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.units_per_second
+
+    def acquire(self, units: float) -> float:
+        """Block until units are available
+
+        Returns:
+            Seconds waited.
+        """
+        delay = self.reserve(units)
+        if delay > 0:
+            self.sleep(delay)
+        return delay
+
+
+# Shared by every client which is not given its own limiter.
+default_rate_limiter = RateLimiter()
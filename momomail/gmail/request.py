@@ -0,0 +1,54 @@
+from itertools import count
+
+from googleapiclient.http import HttpRequest
+
+from .metrics import Instrumentation
+from .ratelimit import RateLimiter, quota_units
+from .retry import RetryPolicy
+
+
+class GmailHttpRequest(HttpRequest):
+    """HttpRequest which goes through the client's rate limiter, retry policy and instrumentation
+
+    googleapiclient creates every request of a service with its requestBuilder,
+    so using this class there puts the limiter and retries under every
+    `.execute()`, including the ones made by Message and Thread objects.
+    """
+
+    def __init__(
+        self,
+        *args,
+        rate_limiter: RateLimiter = None,
+        retry_policy: RetryPolicy = None,
+        instrumentation: Instrumentation = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy
+        self.instrumentation = instrumentation
+
+    @property
+    def quota_units(self) -> int:
+        return quota_units(self.methodId)
+
+    def execute(self, http=None, num_retries=0):
+        attempts = count(1)
+
+        def execute_once():
+            return self._execute_once(http, num_retries, next(attempts))
+
+        if self.retry_policy is None:
+            return execute_once()
+        return self.retry_policy.call(execute_once)
+
+    def _execute_once(self, http, num_retries, attempt=1):
+        # Every attempt uses quota, retries included
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(self.quota_units)
+        if not self.instrumentation:
+            return super().execute(http=http, num_retries=num_retries)
+        with self.instrumentation.measure(
+            http or self.http, self.methodId, self.quota_units, attempt
+        ) as recorder:
+            return super().execute(http=recorder, num_retries=num_retries)
@@ -0,0 +1,186 @@
+import json
+import random
+import threading
+import time
+from collections import Counter
+from email.utils import parsedate_to_datetime
+from typing import TYPE_CHECKING, Callable, Optional, TypeVar
+
+# googleapiclient is imported where errors are checked, so importing the
+# clients does not load it
+if TYPE_CHECKING:
+    from googleapiclient.errors import HttpError
+
+T = TypeVar("T")
+
+# Transient server errors
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+# Gmail answers 403 with these reasons when the rate limit is exceeded
+RETRYABLE_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+
+def error_reason(error: "HttpError") -> str:
+    """Reason of an HttpError. Ex. rateLimitExceeded"""
+    try:
+        content = error.content
+        if isinstance(content, bytes):
+            content = content.decode()
+        return json.loads(content)["error"]["errors"][0]["reason"]
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        return ""
+
+
+def retry_after(error: "HttpError") -> Optional[float]:
+    """Seconds from the Retry-After header of an HttpError, if any"""
+    value = error.resp.get("retry-after") if error.resp is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryStats:
+    """Thread-safe counters of retries and give-ups
+
+    Both counters are keyed by "<status> <reason>". Ex. "429 rateLimitExceeded"
+    """
+
+    def __init__(self) -> None:
+        self.retries: Counter = Counter()
+        self.give_ups: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def record_retry(self, key: str) -> None:
+        with self._lock:
+            self.retries[key] += 1
+
+    def record_give_up(self, key: str) -> None:
+        with self._lock:
+            self.give_ups[key] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"retries": dict(self.retries), "give_ups": dict(self.give_ups)}
+
+
+class RetryPolicy:
+    """Retry 429, 5xx and rate limit 403 errors with decorrelated jitter
+
+    The delay before each retry is random between base_delay and three times
+    the previous delay, capped by max_delay. A Retry-After header from the
+    server is honored when it asks for a longer wait.
+
+    Retries are also limited by a budget shared by all requests: every request
+    deposits budget_ratio tokens, up to `budget`, and every retry withdraws one.
+    When gmail is having a bad time, the budget runs out and errors are raised
+    instead of piling more load onto the server.
+
+    Arguments:
+        max_attempts (int): Attempts per request, including the first one.
+        base_delay (float): Shortest delay in seconds.
+        max_delay (float): Longest delay in seconds.
+        budget_ratio (float): Retries allowed per request on average.
+        budget (float): Retries available from the start and the most the budget refills to.
+        sleep (Callable): Sleep function. Replaceable for testing.
+        uniform (Callable): random.uniform. Replaceable for testing.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 5,
+        base_delay: float = 0.5,
+        max_delay: float = 32.0,
+        budget_ratio: float = 0.2,
+        budget: float = 20.0,
+        sleep: Callable[[float], None] = time.sleep,
+        uniform: Callable[[float, float], float] = random.uniform,
+    ) -> None:
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.budget = budget
+        self.sleep = sleep
+        self.uniform = uniform
+        self.stats = RetryStats()
+        self._budget = budget
+        self._lock = threading.Lock()
+
+    def is_retryable(self, error: Exception) -> bool:
+        from googleapiclient.errors import HttpError
+
+        if not isinstance(error, HttpError):
+            return False
+        status = error.resp.status
+        if status in RETRYABLE_STATUS:
+            return True
+        return status == 403 and error_reason(error) in RETRYABLE_REASONS
+
+    def deposit(self, requests: int = 1) -> None:
+        """Add budget for new requests"""
+        with self._lock:
+            self._budget = min(self.budget, self._budget + requests * self.budget_ratio)
+
+    def should_retry(self, error: Exception, attempt: int) -> bool:
+        """Decide if a request failed at its `attempt`th attempt should be sent again
+
+        Withdraws budget and counts a retry when it returns True, counts a give
+        up when a retryable error is not retried.
+        """
+        if not self.is_retryable(error):
+            return False
+        key = f"{error.resp.status} {error_reason(error)}".strip()
+        with self._lock:
+            allowed = attempt < self.max_attempts and self._budget >= 1
+            if allowed:
+                self._budget -= 1
+        if allowed:
+            self.stats.record_retry(key)
+        else:
+            self.stats.record_give_up(key)
+        return allowed
+
+    def next_delay(self, previous: float, *errors: Exception) -> float:
+        """Seconds to wait before the next attempt
+
+        Arguments:
+            previous (float): The previous delay, 0 before the first retry.
+            errors: Errors of the failed attempt, used for Retry-After.
+        """
+        from googleapiclient.errors import HttpError
+
+        delay = min(
+            self.max_delay,
+            self.uniform(self.base_delay, max(self.base_delay, previous * 3)),
+        )
+        for error in errors:
+            if isinstance(error, HttpError):
+                delay = max(delay, retry_after(error) or 0.0)
+        return delay
+
+    def call(self, func: Callable[[], T]) -> T:
+        """Call func and retry it on retryable errors"""
+        from googleapiclient.errors import HttpError
+
+        self.deposit()
+        attempt = 1
+        delay = 0.0
+        while True:
+            try:
+                return func()
+            except HttpError as error:
+                if not self.should_retry(error, attempt):
+                    raise
+                delay = self.next_delay(delay, error)
+                self.sleep(delay)
+                attempt += 1
+
+
+# Shared by every client which is not given its own policy.
+default_retry_policy = RetryPolicy()
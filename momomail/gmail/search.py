@@ -0,0 +1,432 @@
+import heapq
+import re
+import shlex
+import threading
+from base64 import urlsafe_b64decode
+from bisect import bisect_left
+from dataclasses import dataclass
+from datetime import datetime
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Set
+
+from .exceptions import LabelNotFoundError, UnsupportedQueryError
+
+if TYPE_CHECKING:
+    from .labelindex import LabelIndex
+    from .message import MessageClient
+    from .store import MessageStore
+
+# Fields of the inverted index. Bare search words match any of them.
+TEXT_FIELDS = ("subject", "from", "to", "body")
+
+# Operators answered by the index. Others raise UnsupportedQueryError.
+OPERATORS = {"from", "to", "subject", "label", "is", "in", "has", "before", "after"}
+
+# is: and in: values which are labels
+LABEL_ALIASES = {
+    "unread": "UNREAD",
+    "starred": "STARRED",
+    "important": "IMPORTANT",
+    "inbox": "INBOX",
+    "sent": "SENT",
+    "draft": "DRAFT",
+    "drafts": "DRAFT",
+    "spam": "SPAM",
+    "trash": "TRASH",
+}
+
+ADDRESS_PATTERN = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> Set[str]:
+    """Lower case words of a text. Email addresses are also kept whole."""
+    text = text.lower()
+    tokens = set(WORD_PATTERN.findall(text))
+    for address in ADDRESS_PATTERN.findall(text):
+        tokens.add(address)
+        tokens.update(address.split("@"))
+    return tokens
+
+
+def parse_date(value: str) -> int:
+    """Milliseconds of a before:/after: value, 2024/1/31 at local midnight or epoch seconds"""
+    if value.isdigit():
+        return int(value) * 1000
+    try:
+        date = datetime.strptime(value.replace("-", "/"), "%Y/%m/%d")
+    except ValueError:
+        raise UnsupportedQueryError(value) from None
+    return int(date.timestamp() * 1000)
+
+
+def _text_parts(payload: dict) -> Iterator[dict]:
+    if payload.get("parts"):
+        for part in payload["parts"]:
+            yield from _text_parts(part)
+    elif payload.get("mimeType", "").startswith("text/") and not payload.get(
+        "filename"
+    ):
+        yield payload
+
+
+def _has_attachment(payload: dict) -> bool:
+    if payload.get("filename"):
+        return True
+    return any(_has_attachment(part) for part in payload.get("parts", []))
+
+
+@dataclass
+class _Document:
+    thread_id: str
+    date: int
+    label_ids: Set[str]
+    tokens: Dict[str, Set[str]]
+
+
+class SearchIndex:
+    """Local inverted index answering searches without requests
+
+    Messages are indexed by the words of their subject, from, to and text
+    body, by label and by internalDate. Searches take the arguments of
+    MessageClient.list and return message refs newest first, in the same shape
+    as iter_messages, without using any quota.
+
+    The index is kept in memory. Build it from a MessageStore or from fetched
+    messages, then keep it current with the events of SyncEngine:
+
+        index = SearchIndex.from_store(store)
+        for event in engine.sync():
+            index.apply(event)
+        index.fetch_pending(message_client)
+        refs = index.search(search_string="invoice -paid", after="2024/1/1", read=False)
+
+    search_string understands words, "quoted phrases" (matched as all of
+    their words), -negation and the from:, to:, subject:, label:, is:, in:,
+    has:attachment, before: and after: operators. Other gmail syntax raises
+    UnsupportedQueryError, so callers can fall back to MessageClient.list.
+    Messages fetched with format=metadata are searchable by everything but body words.
+
+    Arguments:
+        label_index (LabelIndex): Resolves label: names from the labels it already
+            loaded, without a request. A name it does not know raises
+            UnsupportedQueryError. Without it label: takes ids only.
+    """
+
+    def __init__(self, label_index: Optional["LabelIndex"] = None) -> None:
+        self.label_index = label_index
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self) -> None:
+        self.pending: Set[str] = set()
+        self._documents: Dict[str, _Document] = {}
+        self._postings: Dict[str, Dict[str, Set[str]]] = {
+            field: {} for field in (*TEXT_FIELDS, "any")
+        }
+        self._labels: Dict[str, Set[str]] = {}
+        # (internalDate, id), sorted by _dates when it is needed
+        self._by_date: List[tuple] = []
+        self._dates_sorted = True
+
+    @classmethod
+    def from_store(
+        cls, store: "MessageStore", label_index: Optional["LabelIndex"] = None
+    ) -> "SearchIndex":
+        """Index the messages of a store
+
+        Only messages stored in the full or metadata format are indexed, the
+        minimal and raw formats have no headers to search.
+        """
+        index = cls(label_index)
+        for message in store.iter_messages(formats=("full", "metadata")):
+            index.add(message)
+        return index
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    def __contains__(self, id: str) -> bool:
+        return id in self._documents
+
+    def add(self, message: dict) -> None:
+        """Index a message resource, replacing its previous version"""
+        headers = {
+            header["name"].lower(): header["value"]
+            for header in message.get("payload", {}).get("headers", [])
+        }
+        body = []
+        for part in _text_parts(message.get("payload", {})):
+            data = part.get("body", {}).get("data")
+            if data:
+                text = urlsafe_b64decode(data).decode(errors="replace")
+                if part["mimeType"] == "text/html":
+                    text = re.sub(r"<[^>]*>", " ", text)
+                body.append(text)
+        tokens = {
+            "subject": tokenize(headers.get("subject", "")),
+            "from": tokenize(headers.get("from", "")),
+            "to": tokenize(" ".join([headers.get("to", ""), headers.get("cc", "")])),
+            "body": tokenize(" ".join(body)),
+        }
+        # Bare words match any field, one lookup instead of a union per query
+        tokens["any"] = set().union(*tokens.values())
+        label_ids = set(message.get("labelIds", []))
+        if _has_attachment(message.get("payload", {})):
+            label_ids.add("has:attachment")
+        document = _Document(
+            thread_id=message.get("threadId", message["id"]),
+            date=int(message.get("internalDate") or 0),
+            label_ids=label_ids,
+            tokens=tokens,
+        )
+        with self._lock:
+            self._remove(message["id"])
+            self._documents[message["id"]] = document
+            for field, field_tokens in tokens.items():
+                postings = self._postings[field]
+                for token in field_tokens:
+                    postings.setdefault(token, set()).add(message["id"])
+            for label_id in label_ids:
+                self._labels.setdefault(label_id, set()).add(message["id"])
+            entry = (document.date, message["id"])
+            if self._by_date and entry < self._by_date[-1]:
+                # Sorted once before the next lookup instead of on every add
+                self._dates_sorted = False
+            self._by_date.append(entry)
+            self.pending.discard(message["id"])
+
+    def add_many(self, messages: Iterable) -> None:
+        """Index message resources or Message objects"""
+        for message in messages:
+            self.add(getattr(message, "raw_data", message))
+
+    def remove(self, id: str) -> None:
+        with self._lock:
+            self._remove(id)
+            self.pending.discard(id)
+
+    def _remove(self, id: str) -> None:
+        document = self._documents.pop(id, None)
+        if document is None:
+            return
+        for field, field_tokens in document.tokens.items():
+            postings = self._postings[field]
+            for token in field_tokens:
+                ids = postings[token]
+                ids.discard(id)
+                if not ids:
+                    del postings[token]
+        for label_id in document.label_ids:
+            self._labels[label_id].discard(id)
+        dates = self._dates()
+        del dates[bisect_left(dates, (document.date, id))]
+
+    def _dates(self) -> List[tuple]:
+        """(internalDate, id) of every message in ascending order"""
+        if not self._dates_sorted:
+            self._by_date.sort()
+            self._dates_sorted = True
+        return self._by_date
+
+    def update_labels(self, id: str, label_ids: Iterable[str]) -> None:
+        """Replace the label ids of an indexed message"""
+        with self._lock:
+            document = self._documents.get(id)
+            if document is None:
+                return
+            label_ids = set(label_ids)
+            if "has:attachment" in document.label_ids:
+                label_ids.add("has:attachment")
+            for label_id in document.label_ids - label_ids:
+                self._labels[label_id].discard(id)
+            for label_id in label_ids - document.label_ids:
+                self._labels.setdefault(label_id, set()).add(id)
+            document.label_ids = label_ids
+
+    def clear(self) -> None:
+        with self._lock:
+            self._reset()
+
+    def apply(self, event) -> None:
+        """Apply a change event of SyncEngine
+
+        Added messages can not be indexed from the event alone, their ids are
+        collected in pending until fetch_pending or add is called.
+        """
+        # Imported here, sync imports message which imports the store
+        from .sync import (
+            FullResync,
+            LabelsAdded,
+            LabelsRemoved,
+            MessageAdded,
+            MessageDeleted,
+        )
+
+        if isinstance(event, (LabelsAdded, LabelsRemoved)):
+            self.update_labels(event.id, event.message_label_ids)
+        elif isinstance(event, MessageDeleted):
+            self.remove(event.id)
+        elif isinstance(event, MessageAdded):
+            with self._lock:
+                if event.id not in self._documents:
+                    self.pending.add(event.id)
+        elif isinstance(event, FullResync):
+            # Messages which are still there come back as MessageAdded
+            self.clear()
+
+    def fetch_pending(self, client: "MessageClient", format: str = "full") -> dict:
+        """Fetch and index the pending messages with batch requests
+
+        Returns:
+            Map from message id to the error of its fetch.
+        """
+        result = client.get_many(sorted(self.pending), format=format)
+        self.add_many(result.results)
+        return result.errors
+
+    def search(
+        self,
+        search_string: Optional[str] = None,
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        read: Optional[bool] = None,
+        from_: Optional[str] = None,
+        to: Optional[str] = None,
+        include_spam_trash: bool = False,
+        limit: Optional[int] = None,
+    ) -> List[dict]:
+        """Search the index. Arguments are the same as MessageClient.list.
+
+        Returns:
+            Dicts with id and threadId, newest first.
+
+        Raises:
+            UnsupportedQueryError: search_string uses syntax the index does not answer.
+        """
+        try:
+            terms = shlex.split(search_string) if search_string else []
+        except ValueError:
+            raise UnsupportedQueryError(search_string) from None
+        if before is not None:
+            terms.append(f"before:{before}")
+        if after is not None:
+            terms.append(f"after:{after}")
+        if read is not None:
+            terms.append("is:read" if read else "is:unread")
+        if from_ is not None:
+            terms.append(f"from:{from_}")
+        if to is not None:
+            terms.append(f"to:{to}")
+
+        with self._lock:
+            include: List[Set[str]] = []
+            exclude: List[Set[str]] = []
+            low, high = 0, None
+            for term in terms:
+                if term == "AND":
+                    continue
+                if not term:
+                    raise UnsupportedQueryError('""')
+                if term == "OR" or term[0] in "({" or term[-1] in ")}":
+                    raise UnsupportedQueryError(term)
+                negate = term.startswith("-") and len(term) > 1
+                if negate:
+                    term = term[1:]
+                operator, colon, value = term.partition(":")
+                if colon and not value and operator.lower() in OPERATORS:
+                    # Ex. subject:""
+                    raise UnsupportedQueryError(term)
+                if not value or operator.lower() not in OPERATORS:
+                    operator, value = "", term
+                operator = operator.lower()
+                if operator in ("before", "after"):
+                    if negate:
+                        raise UnsupportedQueryError(f"-{term}")
+                    if operator == "before":
+                        date = parse_date(value)
+                        high = date if high is None else min(high, date)
+                    else:
+                        low = max(low, parse_date(value))
+                    continue
+                if operator == "in" and value.lower() in ("spam", "trash", "anywhere"):
+                    include_spam_trash = True
+                    if value.lower() == "anywhere":
+                        continue
+                if operator == "is" and value.lower() == "read":
+                    # Read means not unread
+                    operator, value, negate = "is", "unread", not negate
+                matches = self._match(operator, value)
+                (exclude if negate else include).append(matches)
+            if not include_spam_trash:
+                exclude.append(self._labels.get("SPAM", set()))
+                exclude.append(self._labels.get("TRASH", set()))
+
+            if include:
+                # Set operations run in C, only the matches are sorted by date
+                ids = include[0].intersection(*include[1:])
+                ids.difference_update(*exclude)
+                documents = self._documents
+                candidates = [
+                    (documents[id].date, id)
+                    for id in ids
+                    if low <= documents[id].date
+                    and (high is None or documents[id].date < high)
+                ]
+                if limit is None:
+                    candidates.sort(reverse=True)
+                else:
+                    candidates = heapq.nlargest(limit, candidates)
+            else:
+                dates = self._dates()
+                start = bisect_left(dates, (low, ""))
+                end = len(dates)
+                if high is not None:
+                    end = bisect_left(dates, (high, ""))
+                candidates = (
+                    (date, id)
+                    for date, id in reversed(dates[start:end])
+                    if not any(id in ids for ids in exclude)
+                )
+            results = []
+            for date, id in candidates:
+                results.append({"id": id, "threadId": self._documents[id].thread_id})
+                if limit is not None and len(results) >= limit:
+                    break
+            return results
+
+    def _match(self, operator: str, value: str) -> Set[str]:
+        """Ids matching one term. May be a set of the index, never modify it."""
+        if operator in ("from", "to", "subject"):
+            return self._match_words(operator, value)
+        if operator == "":
+            return self._match_words("any", value)
+        value_lower = value.lower()
+        if operator == "has":
+            if value_lower != "attachment":
+                raise UnsupportedQueryError(f"has:{value}")
+            return self._labels.get("has:attachment", set())
+        if operator in ("is", "in"):
+            if value_lower not in LABEL_ALIASES:
+                raise UnsupportedQueryError(f"{operator}:{value}")
+            return self._labels.get(LABEL_ALIASES[value_lower], set())
+        # label:
+        if value_lower in LABEL_ALIASES:
+            return self._labels.get(LABEL_ALIASES[value_lower], set())
+        label_id = value
+        if self.label_index is not None:
+            # Only the labels already loaded, a search never makes a request
+            try:
+                label_id = self.label_index.resolve([value], refresh=False)[0]
+            except LabelNotFoundError:
+                raise UnsupportedQueryError(f"label:{value}") from None
+        return self._labels.get(label_id, set())
+
+    def _match_words(self, field: str, value: str) -> Set[str]:
+        """Ids which have every word of value in field"""
+        postings = self._postings[field]
+        matches = [postings.get(token, set()) for token in tokenize(value)]
+        if not matches:
+            return set()
+        if len(matches) == 1:
+            return matches[0]
+        return set.intersection(*matches)
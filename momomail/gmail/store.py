@@ -0,0 +1,358 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Iterable, Iterator, Optional
+
+# A message fetched with the key format also answers requests of these formats
+FORMAT_COVERS = {
+    "full": {"full", "metadata", "minimal"},
+    "metadata": {"metadata", "minimal"},
+    "minimal": {"minimal"},
+    "raw": {"raw", "minimal"},
+    # Neither full nor metadata covers raw, messages fetched in both keep both
+    "full+raw": {"full", "metadata", "minimal", "raw"},
+    "metadata+raw": {"metadata", "minimal", "raw"},
+}
+
+# Access times are only written back when older than this, so warm reads stay read-only
+ACCESS_RESOLUTION = 60.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    thread_id TEXT NOT NULL,
+    history_id INTEGER NOT NULL,
+    label_ids TEXT NOT NULL,
+    format TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_accessed ON messages (accessed);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO meta VALUES ('total_size', 0);
+"""
+
+
+def _merge_formats(*formats: str) -> str:
+    """Format of an entry merged from entries of these formats, e.g. full+raw"""
+    parts = {part for format in formats for part in format.split("+")}
+    kept = [
+        part
+        for part in parts
+        if not any(other != part and part in FORMAT_COVERS[other] for other in parts)
+    ]
+    return "+".join(sorted(kept))
+
+
+class MessageStore:
+    """Persistent local cache of messages backed by SQLite
+
+    Messages can not change except for their labels. The store keeps the
+    message compressed in one column and the label ids in another, so labels
+    can be updated cheaply, e.g. from the events of SyncEngine. The historyId
+    of each entry is recorded to tell whether it is stale.
+
+    The database runs in WAL mode, so it can be shared by several threads and
+    worker processes. When the compressed size grows over max_size, the least
+    recently used messages are evicted.
+
+    Arguments:
+        path (str): Path of the SQLite database file.
+        max_size (int): Max total bytes of compressed messages.
+        compress_level (int): zlib compression level.
+    """
+
+    def __init__(
+        self,
+        path: str = "messages.sqlite3",
+        max_size: int = 1 << 30,
+        compress_level: int = 6,
+    ) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.compress_level = compress_level
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        """Connection of the current thread and process"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def close(self) -> None:
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def __len__(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def __contains__(self, id: str) -> bool:
+        row = self._connection().execute("SELECT 1 FROM messages WHERE id = ?", (id,))
+        return row.fetchone() is not None
+
+    @property
+    def size(self) -> int:
+        """Total bytes of compressed messages"""
+        row = self._connection().execute(
+            "SELECT value FROM meta WHERE key = 'total_size'"
+        )
+        return row.fetchone()[0]
+
+    def get(
+        self,
+        id: str,
+        format: str = "full",
+        min_history_id: Optional[int] = None,
+    ) -> Optional[dict]:
+        """Get a message resource
+
+        Arguments:
+            id (str): Message id.
+            format (str): The format the caller needs. A message stored in a richer format is returned as well.
+            min_history_id (int): Treat entries older than this history id as stale.
+
+        Returns:
+            The message dict as returned by gmail, or None when it is missing or stale.
+        """
+        row = (
+            self._connection()
+            .execute(
+                "SELECT history_id, label_ids, format, payload, accessed"
+                " FROM messages WHERE id = ?",
+                (id,),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        history_id, label_ids, stored_format, payload, accessed = row
+        if format not in FORMAT_COVERS[stored_format]:
+            return None
+        if min_history_id is not None and history_id < int(min_history_id):
+            return None
+
+        now = time.time()
+        if now - accessed > ACCESS_RESOLUTION:
+            self._connection().execute(
+                "UPDATE messages SET accessed = ? WHERE id = ?", (now, id)
+            )
+        message = json.loads(zlib.decompress(payload))
+        if "+" in stored_format:
+            message.pop("payload" if format == "raw" else "raw", None)
+        message["labelIds"] = json.loads(label_ids)
+        message["historyId"] = str(history_id)
+        return message
+
+    def put(self, message: dict, format: str = "full") -> None:
+        """Save a message resource fetched with `format`
+
+        An entry stored in a format which covers `format` is kept, only its
+        labels are updated, so a minimal get does not replace a full message.
+        A raw message and a full or metadata one are merged into one entry.
+        """
+        history_id = int(message.get("historyId") or 0)
+        label_ids = json.dumps(message.get("labelIds", []))
+        data = {
+            key: value
+            for key, value in message.items()
+            if key not in ("labelIds", "historyId")
+        }
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT size, format, payload FROM messages WHERE id = ?",
+                (message["id"],),
+            ).fetchone()
+            if row is not None and format in FORMAT_COVERS[row[1]]:
+                connection.execute(
+                    "UPDATE messages SET label_ids = ?, history_id = ?"
+                    " WHERE id = ? AND history_id <= ?",
+                    (label_ids, history_id, message["id"], history_id),
+                )
+                connection.execute("COMMIT")
+                return
+            if row is not None and row[1] not in FORMAT_COVERS[format]:
+                data = {**json.loads(zlib.decompress(row[2])), **data}
+                format = _merge_formats(row[1], format)
+            payload = zlib.compress(json.dumps(data).encode(), self.compress_level)
+            connection.execute(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    message["id"],
+                    message["threadId"],
+                    history_id,
+                    label_ids,
+                    format,
+                    payload,
+                    len(payload),
+                    time.time(),
+                ),
+            )
+            connection.execute(
+                "UPDATE meta SET value = value + ? WHERE key = 'total_size'",
+                (len(payload) - (row[0] if row else 0),),
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        if self.size > self.max_size:
+            self.evict()
+
+    def update_labels(
+        self,
+        id: str,
+        label_ids: Iterable[str],
+        history_id: Optional[int] = None,
+    ) -> None:
+        """Replace the label ids of a stored message"""
+        if history_id is None:
+            self._connection().execute(
+                "UPDATE messages SET label_ids = ? WHERE id = ?",
+                (json.dumps(list(label_ids)), id),
+            )
+        else:
+            self._connection().execute(
+                "UPDATE messages SET label_ids = ?, history_id = ? WHERE id = ?",
+                (json.dumps(list(label_ids)), int(history_id), id),
+            )
+
+    def change_labels(
+        self,
+        ids: Iterable[str],
+        add_label_ids: Optional[Iterable[str]] = None,
+        remove_label_ids: Optional[Iterable[str]] = None,
+    ) -> None:
+        """Add and remove label ids of stored messages, e.g. after a batchModify"""
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for id in ids:
+                row = connection.execute(
+                    "SELECT label_ids FROM messages WHERE id = ?", (id,)
+                ).fetchone()
+                if row is None:
+                    continue
+                labels = dict.fromkeys(json.loads(row[0]))
+                labels.update(dict.fromkeys(add_label_ids or []))
+                for label_id in remove_label_ids or []:
+                    labels.pop(label_id, None)
+                connection.execute(
+                    "UPDATE messages SET label_ids = ? WHERE id = ?",
+                    (json.dumps(list(labels)), id),
+                )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def delete(self, id: str) -> None:
+        self.delete_many([id])
+
+    def delete_many(self, ids: Iterable[str]) -> None:
+        """Forget messages, e.g. after they were deleted"""
+        self._delete_where("id = ?", ((id,) for id in ids))
+
+    def delete_thread(self, thread_id: str) -> None:
+        """Forget the messages of a deleted thread"""
+        self._delete_where("thread_id = ?", [(thread_id,)])
+
+    def _delete_where(self, condition: str, params: Iterable[tuple]) -> None:
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for param in params:
+                row = connection.execute(
+                    f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM messages"
+                    f" WHERE {condition}",
+                    param,
+                ).fetchone()
+                if row[0]:
+                    connection.execute(f"DELETE FROM messages WHERE {condition}", param)
+                    connection.execute(
+                        "UPDATE meta SET value = value - ? WHERE key = 'total_size'",
+                        (row[1],),
+                    )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def iter_messages(self, formats: Optional[Iterable[str]] = None) -> Iterator[dict]:
+        """Stored message resources, without touching access times
+
+        Arguments:
+            formats (Iterable[str]): Only the messages stored in a format covering one of these. None means all.
+        """
+        query = "SELECT history_id, label_ids, payload FROM messages"
+        params = ()
+        if formats is not None:
+            wanted = set(formats)
+            params = tuple(
+                stored for stored, covered in FORMAT_COVERS.items() if covered & wanted
+            )
+            query += f" WHERE format IN ({', '.join('?' * len(params))})"
+        rows = self._connection().execute(query, params)
+        for history_id, label_ids, payload in rows:
+            message = json.loads(zlib.decompress(payload))
+            message["labelIds"] = json.loads(label_ids)
+            message["historyId"] = str(history_id)
+            yield message
+
+    def evict(self, target_size: Optional[int] = None) -> int:
+        """Evict least recently used messages until the size is under target_size
+
+        The default target is 90% of max_size, so eviction does not run on every put.
+
+        Returns:
+            Number of evicted messages.
+        """
+        if target_size is None:
+            target_size = int(self.max_size * 0.9)
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            total = connection.execute(
+                "SELECT value FROM meta WHERE key = 'total_size'"
+            ).fetchone()[0]
+            evicted = []
+            freed = 0
+            rows = connection.execute("SELECT id, size FROM messages ORDER BY accessed")
+            for id, size in rows:
+                if total - freed <= target_size:
+                    break
+                evicted.append((id,))
+                freed += size
+            connection.executemany("DELETE FROM messages WHERE id = ?", evicted)
+            connection.execute(
+                "UPDATE meta SET value = value - ? WHERE key = 'total_size'", (freed,)
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return len(evicted)
+
+    def apply(self, event) -> None:
+        """Apply a change event of SyncEngine to the store"""
+        # Imported here, sync imports message which imports this module
+        from .sync import LabelsAdded, LabelsRemoved, MessageDeleted
+
+        if isinstance(event, (LabelsAdded, LabelsRemoved)):
+            self.update_labels(event.id, event.message_label_ids)
+        elif isinstance(event, MessageDeleted):
+            self.delete(event.id)
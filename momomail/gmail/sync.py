@@ -0,0 +1,215 @@
+import json
+import os
+from dataclasses import dataclass, field
+from itertools import chain
+from typing import Iterator, List, Optional, Union
+
+from .batch import chunked
+from .client import MAX_PAGE_SIZE
+from .message import MessageClient
+
+
+@dataclass(frozen=True)
+class MessageAdded:
+    id: str
+    thread_id: str
+    label_ids: List[str] = field(default_factory=list)
+
+
+@dataclass(frozen=True)
+class MessageDeleted:
+    id: str
+    thread_id: str
+
+
+@dataclass(frozen=True)
+class LabelsAdded:
+    """label_ids were added to the message. message_label_ids are all its labels afterwards."""
+
+    id: str
+    thread_id: str
+    label_ids: List[str]
+    message_label_ids: List[str] = field(default_factory=list)
+
+
+@dataclass(frozen=True)
+class LabelsRemoved:
+    """label_ids were removed from the message. message_label_ids are all its labels afterwards."""
+
+    id: str
+    thread_id: str
+    label_ids: List[str]
+    message_label_ids: List[str] = field(default_factory=list)
+
+
+@dataclass(frozen=True)
+class FullResync:
+    """The local state should be dropped
+
+    Emitted when there is no saved history id or it has expired. It is followed
+    by a MessageAdded for every message in the mailbox.
+    """
+
+    history_id: str
+
+
+ChangeEvent = Union[
+    MessageAdded, MessageDeleted, LabelsAdded, LabelsRemoved, FullResync
+]
+
+HISTORY_TYPES = ["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"]
+
+
+class SyncEngine:
+    """Incremental mailbox sync based on users.history.list
+
+    The engine saves the historyId of the mailbox after each sync. The next
+    sync only asks gmail for the changes since then, so its cost is in
+    proportion to what changed instead of the size of the mailbox. When the
+    history id has expired (gmail keeps about a week of history), it falls back
+    to a full resync.
+
+        engine = SyncEngine(MessageClient.setup(), state_path="sync_state.json")
+        for event in engine.sync():
+            ...
+
+    The new history id is saved only after the events of a sync are all
+    consumed, so an interrupted sync is replayed from the start next time.
+
+    Ref:
+        https://developers.google.com/gmail/api/guides/sync
+
+    Arguments:
+        client (MessageClient): Client used to list history and messages.
+        state_path (str): JSON file keeping the history id between runs. None keeps it in memory only.
+        include_spam_trash (bool): Include SPAM and TRASH messages in a full resync.
+    """
+
+    def __init__(
+        self,
+        client: MessageClient,
+        state_path: Optional[str] = None,
+        include_spam_trash: bool = False,
+    ) -> None:
+        self.client = client
+        self.history = client.service.users().history()
+        self.state_path = state_path
+        self.include_spam_trash = include_spam_trash
+        self.history_id: Optional[str] = self._load_state()
+
+    def _load_state(self) -> Optional[str]:
+        if self.state_path is None or not os.path.isfile(self.state_path):
+            return None
+        with open(self.state_path, "r") as f:
+            return json.load(f).get("historyId")
+
+    def _save_state(self, history_id: str) -> None:
+        self.history_id = history_id
+        if self.state_path is None:
+            return
+        # Write then rename, so a crash never leaves a half written state file
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"historyId": history_id}, f)
+        os.replace(tmp_path, self.state_path)
+
+    def sync(self) -> Iterator[ChangeEvent]:
+        """Yield the changes since the last sync"""
+        from googleapiclient.errors import HttpError
+
+        if self.history_id is None:
+            yield from self.full_resync()
+            return
+        pages = self._iter_history(self.history_id)
+        try:
+            # Fetch the first page eagerly to know if the history id is still valid
+            first_page = next(pages)
+        except HttpError as error:
+            if error.resp.status != 404:
+                raise
+            yield from self.full_resync()
+            return
+
+        history_id = self.history_id
+        for result in chain([first_page], pages):
+            for record in result.get("history", []):
+                yield from self._parse_record(record)
+            history_id = result.get("historyId", history_id)
+        self._save_state(history_id)
+
+    def full_resync(self) -> Iterator[ChangeEvent]:
+        """List every message of the mailbox and start over from the current history id
+
+        list does not return labels, so the labels of each page of ids are
+        fetched with batched minimal gets, 5 quota units per message, and the
+        MessageAdded events carry them like the ones of a history sync.
+        """
+        # Take the history id before listing, changes made meanwhile are picked up by the next sync
+        history_id = (
+            self.client.service.users().getProfile(userId="me").execute()["historyId"]
+        )
+        yield FullResync(history_id=history_id)
+        refs = self.client.iter_messages(include_spam_trash=self.include_spam_trash)
+        for page in chunked(refs, MAX_PAGE_SIZE):
+            result = self.client.get_many(
+                [ref["id"] for ref in page],
+                format="minimal",
+                fields="id,labelIds",
+            )
+            for error in result.errors.values():
+                # Deleted since it was listed, the next sync reports it
+                if error.resp.status != 404:
+                    raise error
+            label_ids = {message.id: message.label_ids for message in result.results}
+            for ref in page:
+                if ref["id"] in label_ids:
+                    yield MessageAdded(
+                        id=ref["id"],
+                        thread_id=ref["threadId"],
+                        label_ids=label_ids[ref["id"]],
+                    )
+        self._save_state(history_id)
+
+    def _iter_history(self, start_history_id: str) -> Iterator[dict]:
+        page_token = None
+        while True:
+            result = self.history.list(
+                userId="me",
+                startHistoryId=start_history_id,
+                historyTypes=HISTORY_TYPES,
+                maxResults=MAX_PAGE_SIZE,
+                pageToken=page_token,
+            ).execute()
+            yield result
+            page_token = result.get("nextPageToken")
+            if not page_token:
+                return
+
+    @staticmethod
+    def _parse_record(record: dict) -> Iterator[ChangeEvent]:
+        for item in record.get("messagesAdded", []):
+            message = item["message"]
+            yield MessageAdded(
+                id=message["id"],
+                thread_id=message["threadId"],
+                label_ids=message.get("labelIds", []),
+            )
+        for item in record.get("messagesDeleted", []):
+            message = item["message"]
+            yield MessageDeleted(id=message["id"], thread_id=message["threadId"])
+        for item in record.get("labelsAdded", []):
+            message = item["message"]
+            yield LabelsAdded(
+                id=message["id"],
+                thread_id=message["threadId"],
+                label_ids=item["labelIds"],
+                message_label_ids=message.get("labelIds", []),
+            )
+        for item in record.get("labelsRemoved", []):
+            message = item["message"]
+            yield LabelsRemoved(
+                id=message["id"],
+                thread_id=message["threadId"],
+                label_ids=item["labelIds"],
+                message_label_ids=message.get("labelIds", []),
+            )
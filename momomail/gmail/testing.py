@@ -0,0 +1,908 @@
+"""In-process fake of the gmail api
+
+FakeGmailHttp can be passed to googleapiclient in place of httplib2.Http. It
+serves a small in-memory mailbox and counts the HTTP round trips, which makes
+it possible to test the clients without a gmail account.
+
+    http = FakeGmailHttp()
+    http.add_message(make_message("0000000000000001", subject="Hi"))
+    session = make_session(http)
+    message_client = session.messages()
+
+"""
+import asyncio
+import json
+import mimetypes
+import random
+import re
+import threading
+import time
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+from email.parser import Parser
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import httplib2
+
+from .batch import MAX_BULK_IDS
+from .client import GmailSession
+from .metrics import Instrumentation
+from .ratelimit import RateLimiter
+from .retry import RetryPolicy
+
+Route = Tuple[str, "re.Pattern", Callable]
+
+
+def make_session(
+    http: "FakeGmailHttp",
+    rate_limiter: Optional[RateLimiter] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+) -> GmailSession:
+    """A GmailSession on top of a fake transport, skipping the oauth flow
+
+    By default requests are not throttled and retries do not sleep.
+    """
+    from .pool import HttpPool
+
+    session = GmailSession.__new__(GmailSession)
+    session.rate_limiter = rate_limiter or RateLimiter(units_per_second=1e9)
+    session.retry_policy = retry_policy or RetryPolicy(sleep=lambda seconds: None)
+    session.token_cache = None
+    session.instrumentation = Instrumentation()
+    session.credentials = None
+    session._init_service(HttpPool(http_factory=lambda: http))
+    return session
+
+
+def make_message(
+    id: str,
+    thread_id: Optional[str] = None,
+    subject: str = "",
+    from_: str = "sender@example.com",
+    to: str = "me@example.com",
+    date: str = "Mon, 1 Jan 2024 00:00:00 +0000",
+    body: str = "",
+    label_ids: Optional[List[str]] = None,
+    attachments: Optional[Dict[str, bytes]] = None,
+) -> dict:
+    """Build a message resource in the "full" format of the gmail api.
+
+    With attachments, the payload is multipart/mixed: a text/plain part followed
+    by one part per attachment. Attachment parts keep their data next to the
+    attachmentId, FakeGmailHttp strips it from get responses.
+    """
+    headers = [
+        {"name": "Subject", "value": subject},
+        {"name": "From", "value": from_},
+        {"name": "To", "value": to},
+        {"name": "Date", "value": date},
+    ]
+    text_body = {
+        "size": len(body.encode()),
+        "data": urlsafe_b64encode(body.encode()).decode(),
+    }
+    payload = {
+        "partId": "",
+        "mimeType": "text/plain",
+        "filename": "",
+        "headers": headers,
+        "body": text_body,
+    }
+    size = len(body)
+    if attachments:
+        parts = [
+            {"partId": "0", "mimeType": "text/plain", "filename": "", "body": text_body}
+        ]
+        for index, (filename, data) in enumerate(attachments.items(), start=1):
+            parts.append(
+                {
+                    "partId": str(index),
+                    "mimeType": mimetypes.guess_type(filename)[0]
+                    or "application/octet-stream",
+                    "filename": filename,
+                    "body": {
+                        "size": len(data),
+                        "attachmentId": f"{id}-attachment-{index}",
+                        "data": urlsafe_b64encode(data).decode(),
+                    },
+                }
+            )
+            size += len(data)
+        payload.update(mimeType="multipart/mixed", body={"size": 0}, parts=parts)
+    return {
+        "id": id,
+        "threadId": thread_id or id,
+        "labelIds": label_ids if label_ids is not None else ["INBOX"],
+        "snippet": body[:100],
+        "historyId": "1",
+        "internalDate": str(int(parsedate_to_datetime(date).timestamp() * 1000)),
+        "sizeEstimate": size,
+        "payload": payload,
+    }
+
+
+def iter_parts(payload: dict) -> Iterator[dict]:
+    """Leaf parts of a payload, depth first"""
+    if payload.get("parts"):
+        for part in payload["parts"]:
+            yield from iter_parts(part)
+    else:
+        yield payload
+
+
+def to_rfc822(message: dict) -> bytes:
+    """Rebuild the RFC 822 bytes of a message made by make_message"""
+    email = EmailMessage()
+    for header in message["payload"]["headers"]:
+        email[header["name"]] = header["value"]
+    for part in iter_parts(message["payload"]):
+        data = urlsafe_b64decode(part["body"].get("data", ""))
+        if "attachmentId" in part["body"]:
+            maintype, subtype = part["mimeType"].split("/")
+            email.add_attachment(data, maintype, subtype, filename=part["filename"])
+        elif not email.get_content_type().startswith("multipart"):
+            email.set_content(data.decode())
+    return email.as_bytes()
+
+
+def strip_attachment_data(payload: dict) -> dict:
+    """Attachment content is only returned by attachments.get"""
+    if "attachmentId" in payload.get("body", {}):
+        body = {k: v for k, v in payload["body"].items() if k != "data"}
+        return {**payload, "body": body}
+    if payload.get("parts"):
+        return {
+            **payload,
+            "parts": [strip_attachment_data(part) for part in payload["parts"]],
+        }
+    return payload
+
+
+def shape_message(message: dict, query: dict) -> dict:
+    """Apply the format, metadataHeaders and top level fields of a get request"""
+    format = query.get("format", "full")
+    summary = {key: value for key, value in message.items() if key != "payload"}
+    if format == "full":
+        message = {**summary, "payload": strip_attachment_data(message["payload"])}
+    elif format == "minimal":
+        message = summary
+    elif format == "metadata":
+        names = query.get("metadataHeaders")
+        if isinstance(names, str):
+            names = [names]
+        headers = message["payload"]["headers"]
+        if names:
+            names = {name.lower() for name in names}
+            headers = [h for h in headers if h["name"].lower() in names]
+        message = {**summary, "payload": {"headers": headers}}
+    elif format == "raw":
+        raw = urlsafe_b64encode(to_rfc822(message)).decode()
+        message = {**summary, "raw": raw}
+    if "fields" in query:
+        keys = [
+            field.split("/")[0].split("(")[0] for field in query["fields"].split(",")
+        ]
+        message = {key: value for key, value in message.items() if key in keys}
+    return message
+
+
+# Headers of delivered mail which come before the ones momomail reads
+TRANSPORT_HEADERS = [
+    "Delivered-To",
+    "Received",
+    "X-Received",
+    "ARC-Seal",
+    "ARC-Message-Signature",
+    "ARC-Authentication-Results",
+    "Return-Path",
+    "Received-SPF",
+    "Authentication-Results",
+    "DKIM-Signature",
+    "X-Google-Smtp-Source",
+    "MIME-Version",
+]
+
+WORDS = (
+    "the quarterly report is attached please review before our meeting on "
+    "thursday we need to finalize budget numbers and confirm vendor contracts "
+    "let me know if you have questions about invoice shipment schedule project "
+    "timeline deadline update design draft feedback thanks regards team"
+).split()
+
+ATTACHMENT_TYPES = [
+    ("report.pdf", "application/pdf"),
+    ("photo.jpg", "image/jpeg"),
+    ("data.csv", "text/csv"),
+    ("slides.pptx", "application/vnd.ms-powerpoint"),
+    ("archive.zip", "application/zip"),
+]
+
+
+def _text(rng: random.Random, lines: int) -> List[str]:
+    return [
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 16))).capitalize()
+        + "."
+        for _ in range(lines)
+    ]
+
+
+def _leaf(
+    mime_type: str,
+    data: bytes,
+    filename: str = "",
+    attachment_id: Optional[str] = None,
+) -> dict:
+    headers = [{"name": "Content-Type", "value": mime_type}]
+    body = {"size": len(data), "data": urlsafe_b64encode(data).decode()}
+    if attachment_id:
+        headers.append(
+            {
+                "name": "Content-Disposition",
+                "value": f'attachment; filename="{filename}"',
+            }
+        )
+        body["attachmentId"] = attachment_id
+    return {
+        "mimeType": mime_type,
+        "filename": filename,
+        "headers": headers,
+        "body": body,
+    }
+
+
+def _multipart(subtype: str, parts: List[dict]) -> dict:
+    return {
+        "mimeType": f"multipart/{subtype}",
+        "filename": "",
+        "headers": [{"name": "Content-Type", "value": f"multipart/{subtype}"}],
+        "body": {"size": 0},
+        "parts": parts,
+    }
+
+
+def _number_parts(part: dict, part_id: str) -> None:
+    """Part ids like gmail gives them: "" for the root, then "0", "0.1", ..."""
+    part["partId"] = part_id
+    for index, child in enumerate(part.get("parts", [])):
+        _number_parts(child, f"{part_id}.{index}" if part_id else str(index))
+
+
+def make_mime_message(
+    id: str,
+    rng: random.Random,
+    thread_id: Optional[str] = None,
+    date: Optional[datetime] = None,
+    label_ids: Optional[List[str]] = None,
+    max_attachment_size: int = 200_000,
+) -> dict:
+    """Build a message resource shaped like real mail, picked at random by rng
+
+    The payload is one of text/plain, multipart/alternative with a text and
+    an html body, multipart/mixed with attachments, multipart/related with an
+    inline image, or a forward nesting the original message and its
+    attachment. The transport headers of delivered mail come first.
+    """
+    date = date or datetime(2024, 1, 1, tzinfo=timezone.utc)
+    lines = _text(rng, rng.randint(2, 30))
+    subject = " ".join(lines[0].split()[:6])
+    plain = _leaf("text/plain", "\n\n".join(lines).encode())
+    html = "".join(f"<p>{line}</p>" for line in lines)
+    count = 0
+
+    def alternative() -> dict:
+        html_part = _leaf("text/html", f"<html><body>{html}</body></html>".encode())
+        return _multipart("alternative", [dict(plain), html_part])
+
+    def attachment(filename: Optional[str] = None, mime_type: str = "") -> dict:
+        nonlocal count
+        count += 1
+        if filename is None:
+            filename, mime_type = rng.choice(ATTACHMENT_TYPES)
+        data = rng.randbytes(rng.randint(1_000, max_attachment_size))
+        return _leaf(mime_type, data, filename, f"{id}-attachment-{count}")
+
+    shape = rng.choices(
+        ["plain", "alternative", "mixed", "related", "forward"],
+        weights=[20, 35, 25, 10, 10],
+    )[0]
+    if shape == "plain":
+        payload = plain
+    elif shape == "alternative":
+        payload = alternative()
+    elif shape == "mixed":
+        attachments = [attachment() for _ in range(rng.randint(1, 3))]
+        payload = _multipart("mixed", [alternative(), *attachments])
+    elif shape == "related":
+        payload = _multipart(
+            "related", [alternative(), attachment("image001.png", "image/png")]
+        )
+    else:
+        subject = f"Fwd: {subject}"
+        original = _multipart("mixed", [alternative(), attachment()])
+        payload = _multipart("mixed", [plain, original])
+    payload = dict(payload)
+    _number_parts(payload, "")
+
+    sender = rng.choice(["alice", "bob", "carol", "dave", "erin"])
+    headers = [
+        {"name": name, "value": f"{name.lower()} of {id}"} for name in TRANSPORT_HEADERS
+    ]
+    headers += [
+        *payload["headers"],
+        {"name": "Subject", "value": subject},
+        {"name": "From", "value": f"{sender.title()} <{sender}@example.com>"},
+        {"name": "To", "value": "me@example.com"},
+        {"name": "Date", "value": format_datetime(date)},
+        {"name": "Message-ID", "value": f"<{id}@example.com>"},
+    ]
+    payload["headers"] = headers
+    return {
+        "id": id,
+        "threadId": thread_id or id,
+        "labelIds": label_ids if label_ids is not None else ["INBOX"],
+        "snippet": lines[0][:100],
+        "historyId": "1",
+        "internalDate": str(int(date.timestamp() * 1000)),
+        "sizeEstimate": sum(part["body"]["size"] for part in iter_parts(payload)),
+        "payload": payload,
+    }
+
+
+def fill_mailbox(
+    http: "FakeGmailHttp",
+    count: int,
+    seed: int = 0,
+    label_count: int = 20,
+    max_attachment_size: int = 200_000,
+) -> List[str]:
+    """Add a generated mailbox to a fake, the same one for the same seed
+
+    Messages are built by make_mime_message, about a third of them are replies
+    in an earlier thread, and they carry INBOX, UNREAD and `label_count` user
+    labels named like "Projects/3" in varying proportions.
+
+    Returns:
+        The message ids, newest first like messages.list returns them.
+    """
+    rng = random.Random(seed)
+    user_labels = []
+    for index in range(label_count):
+        label = {
+            "id": f"Label_{len(http.labels) + 1}",
+            "name": f"{rng.choice(['Projects', 'Clients', 'Receipts'])}/{index}",
+            "type": "user",
+        }
+        http.labels.append(label)
+        user_labels.append(label["id"])
+
+    date = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    messages = []
+    for index in range(count):
+        id = f"{0x18A0000000000000 + index * 0x1F3D:016x}"
+        date += timedelta(minutes=rng.randint(1, 600))
+        thread_id = None
+        if messages and rng.random() < 0.3:
+            thread_id = rng.choice(messages[-20:])["threadId"]
+        label_ids = ["INBOX"] if rng.random() < 0.9 else []
+        if rng.random() < 0.3:
+            label_ids.append("UNREAD")
+        if user_labels and rng.random() < 0.4:
+            label_ids.append(rng.choice(user_labels))
+        messages.append(
+            make_mime_message(
+                id,
+                rng,
+                thread_id=thread_id,
+                date=date,
+                label_ids=label_ids,
+                max_attachment_size=max_attachment_size,
+            )
+        )
+    messages.reverse()
+    for message in messages:
+        http.add_message(message)
+    return [message["id"] for message in messages]
+
+
+def error_payload(code: int, message: str, reason: str) -> dict:
+    return {
+        "error": {
+            "code": code,
+            "message": message,
+            "errors": [{"domain": "global", "reason": reason, "message": message}],
+        }
+    }
+
+
+NOT_FOUND = (404, error_payload(404, "Requested entity was not found.", "notFound"))
+
+# Label changes of the trash and untrash methods
+TRASH_BODIES = {
+    "trash": {"addLabelIds": ["TRASH"]},
+    "untrash": {"removeLabelIds": ["TRASH"]},
+}
+RATE_LIMITED = (
+    429,
+    error_payload(429, "Rate Limit Exceeded", "rateLimitExceeded"),
+    {},
+)
+
+
+class FakeGmailHttp:
+    """A thread-safe stand-in for httplib2.Http backed by a fake mailbox
+
+    Attributes:
+        messages (dict): Map from message id to the message resource.
+        labels (list): Label resources returned by labels.list.
+        round_trips (int): Number of HTTP requests received. A batch request counts once.
+        calls (list): (method, path) of every api call, including the ones inside batches.
+        latency (float): Seconds every HTTP request takes, to simulate the network.
+        error_rate (float): Chance of an api call failing with rateLimitExceeded, to
+            simulate running into the quota. Drawn from `random`, seed it to replay a run.
+        quota_errors (int): Number of api calls failed by error_rate.
+    """
+
+    def __init__(self) -> None:
+        self.messages: Dict[str, dict] = {}
+        self.labels: List[dict] = [
+            {"id": "INBOX", "name": "INBOX", "type": "system"},
+            {"id": "TRASH", "name": "TRASH", "type": "system"},
+            {"id": "UNREAD", "name": "UNREAD", "type": "system"},
+        ]
+        self.round_trips = 0
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.random = random.Random(0)
+        self.quota_errors = 0
+        self.calls: List[Tuple[str, str]] = []
+        self.failures: List[Optional[Tuple[int, dict, dict]]] = []
+        # Raw bytes of the sent messages, by message id
+        self.sent: Dict[str, bytes] = {}
+        # Bytes received by each resumable upload session
+        self.uploads: Dict[str, bytearray] = {}
+        self.history: List[dict] = []
+        self.history_id = 1
+        # History older than this id has expired
+        self.oldest_history_id = 1
+        self.lock = threading.Lock()
+        self.routes: List[Route] = []
+        self.route("GET", r"/gmail/v1/users/me/messages", self.list_messages)
+        self.route("GET", r"/gmail/v1/users/me/messages/(?P<id>\w+)", self.get_message)
+        self.route(
+            "GET",
+            r"/gmail/v1/users/me/messages/(?P<message_id>\w+)/attachments/(?P<id>[\w-]+)",
+            self.get_attachment,
+        )
+        self.route(
+            "POST", r"/gmail/v1/users/me/messages/batchModify", self.batch_modify
+        )
+        self.route(
+            "POST", r"/gmail/v1/users/me/messages/batchDelete", self.batch_delete
+        )
+        self.route(
+            "POST",
+            r"/gmail/v1/users/me/messages/(?P<id>\w+)/modify",
+            self.modify_message,
+        )
+        self.route(
+            "POST",
+            r"/gmail/v1/users/me/messages/(?P<id>\w+)/(?P<action>trash|untrash)",
+            self.trash_message,
+        )
+        self.route(
+            "DELETE", r"/gmail/v1/users/me/messages/(?P<id>\w+)", self.delete_message
+        )
+        self.route("GET", r"/gmail/v1/users/me/threads", self.list_threads)
+        self.route("GET", r"/gmail/v1/users/me/threads/(?P<id>\w+)", self.get_thread)
+        self.route(
+            "POST",
+            r"/gmail/v1/users/me/threads/(?P<id>\w+)/(?P<action>modify|trash|untrash)",
+            self.modify_thread,
+        )
+        self.route(
+            "DELETE", r"/gmail/v1/users/me/threads/(?P<id>\w+)", self.delete_thread
+        )
+        self.route("GET", r"/gmail/v1/users/me/labels", self.list_labels)
+        self.route("POST", r"/gmail/v1/users/me/labels", self.create_label)
+        self.route("PATCH", r"/gmail/v1/users/me/labels/(?P<id>\w+)", self.patch_label)
+        self.route("PUT", r"/gmail/v1/users/me/labels/(?P<id>\w+)", self.patch_label)
+        self.route(
+            "DELETE", r"/gmail/v1/users/me/labels/(?P<id>\w+)", self.delete_label
+        )
+        self.route("POST", r"/gmail/v1/users/me/messages/send", self.send_message)
+        self.route("GET", r"/gmail/v1/users/me/history", self.list_history)
+        self.route("GET", r"/gmail/v1/users/me/profile", self.get_profile)
+
+    def route(self, method: str, pattern: str, handler: Callable) -> None:
+        """Register handler(query, body, **path_params) -> (status, payload)"""
+        self.routes.insert(0, (method, re.compile(pattern + "$"), handler))
+
+    def add_message(self, message: dict) -> None:
+        self.messages[message["id"]] = message
+
+    def add_history(self, **record) -> str:
+        """Record a change. Ex. add_history(labelsAdded=[...]). Returns its history id"""
+        self.history_id += 1
+        self.history.append({"id": str(self.history_id), **record})
+        return str(self.history_id)
+
+    def fail_next(
+        self,
+        times: int = 1,
+        status: int = 429,
+        reason: str = "rateLimitExceeded",
+        retry_after: Optional[str] = None,
+        skip: int = 0,
+    ) -> None:
+        """Answer `times` api calls with an error, after letting `skip` calls through"""
+        headers = {"retry-after": retry_after} if retry_after is not None else {}
+        payload = error_payload(status, reason, reason)
+        self.failures.extend([None] * skip + [(status, payload, headers)] * times)
+
+    # httplib2.Http interface
+
+    def request(
+        self,
+        uri: str,
+        method: str = "GET",
+        body=None,
+        headers: Optional[dict] = None,
+        redirections: int = 5,
+        connection_type=None,
+    ) -> Tuple[httplib2.Response, bytes]:
+        with self.lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return self.respond(uri, method, body, headers)
+
+    def respond(
+        self, uri: str, method: str = "GET", body=None, headers: Optional[dict] = None
+    ) -> Tuple[httplib2.Response, bytes]:
+        """Serve an HTTP request, without counting it or waiting for the latency"""
+        parsed = urlparse(uri)
+        if parsed.path == "/batch" or parsed.path.startswith("/batch/"):
+            return self._batch(body, headers or {})
+        if parsed.path.startswith("/upload/"):
+            status, payload, headers = self._upload(method, parsed, body, headers or {})
+        else:
+            status, payload, headers = self.dispatch(
+                method, parsed.path, parsed.query, body
+            )
+        response = httplib2.Response(
+            {"status": str(status), "content-type": "application/json", **headers}
+        )
+        return response, json.dumps(payload).encode()
+
+    def dispatch(
+        self, method: str, path: str, query: str, body
+    ) -> Tuple[int, dict, dict]:
+        """Serve one api call. Returns status, payload and extra headers"""
+        failure = self._next_failure(method, path)
+        if failure is not None:
+            return failure
+        return (*self.handle(method, path, query, body), {})
+
+    def _next_failure(self, method: str, path: str) -> Optional[Tuple[int, dict, dict]]:
+        with self.lock:
+            self.calls.append((method, path))
+            if self.failures:
+                return self.failures.pop(0)
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.quota_errors += 1
+                return RATE_LIMITED
+        return None
+
+    def _upload(
+        self, method: str, parsed, body, headers: dict
+    ) -> Tuple[int, dict, dict]:
+        """Serve the resumable upload protocol of messages.send"""
+        failure = self._next_failure(method, parsed.path)
+        if failure is not None:
+            return failure
+        headers = {name.lower(): value for name, value in headers.items()}
+        query = parse_qs(parsed.query)
+        if "upload_id" not in query:
+            with self.lock:
+                upload_id = str(len(self.uploads))
+                self.uploads[upload_id] = bytearray()
+            location = (
+                f"https://gmail.googleapis.com{parsed.path}"
+                f"?uploadType=resumable&upload_id={upload_id}"
+            )
+            return 200, {}, {"location": location}
+        data = self.uploads[query["upload_id"][0]]
+        match = re.match(r"bytes (\*|(\d+)-\d+)/(\d+)", headers["content-range"])
+        if hasattr(body, "read"):
+            # googleapiclient streams the chunks of seekable files
+            body = body.read()
+        if body:
+            if isinstance(body, str):
+                body = body.encode()
+            if int(match.group(2)) != len(data):
+                return 400, error_payload(400, "Bad range.", "badRequest"), {}
+            data.extend(body)
+        if len(data) < int(match.group(3)):
+            range_header = {"range": f"bytes=0-{len(data) - 1}"} if data else {}
+            return 308, {}, range_header
+        return 200, self._send(data), {}
+
+    def _send(self, raw) -> dict:
+        """Deliver a sent message to the mailbox"""
+        header_end = raw.find(b"\n\n")
+        message = Parser().parsestr(bytes(raw[:header_end]).decode(), headersonly=True)
+        with self.lock:
+            id = f"{0x5E17000000000000 + len(self.sent):016x}"
+            self.sent[id] = raw
+            self.messages[id] = {
+                "id": id,
+                "threadId": id,
+                "labelIds": ["SENT"],
+                "historyId": str(self.history_id),
+                "internalDate": str(int(time.time() * 1000)),
+                "payload": {
+                    "mimeType": message.get_content_type(),
+                    "headers": [
+                        {"name": name, "value": value}
+                        for name, value in message.items()
+                    ],
+                    "body": {"size": 0},
+                },
+            }
+        return {"id": id, "threadId": id, "labelIds": ["SENT"]}
+
+    def handle(self, method: str, path: str, query: str, body) -> Tuple[int, dict]:
+        if isinstance(body, bytes):
+            body = body.decode()
+        data = json.loads(body) if body else {}
+        params = {
+            key: values if len(values) > 1 else values[0]
+            for key, values in parse_qs(query).items()
+        }
+        for route_method, pattern, handler in self.routes:
+            match = pattern.match(path)
+            if match and route_method == method:
+                return handler(params, data, **match.groupdict())
+        return NOT_FOUND
+
+    def _batch(self, body: str, headers: dict) -> Tuple[httplib2.Response, bytes]:
+        content_type = headers["content-type"]
+        message = Parser().parsestr(f"content-type: {content_type}\r\n\r\n{body}")
+        boundary = "batch_fake_boundary"
+        chunks = []
+        for part in message.get_payload():
+            sub_request = part.get_payload().replace("\r\n", "\n")
+            request_line, _, rest = sub_request.partition("\n")
+            method, target, _ = request_line.split(" ", 2)
+            _, _, sub_body = rest.partition("\n\n")
+            parsed = urlparse(target)
+            status, payload, headers = self.dispatch(
+                method, parsed.path, parsed.query, sub_body
+            )
+            content_id = part["Content-ID"].replace("<", "<response-", 1)
+            extra_headers = "".join(f"{k}: {v}\r\n" for k, v in headers.items())
+            chunks.append(
+                f"--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: {content_id}\r\n\r\n"
+                f"HTTP/1.1 {status} OK\r\n"
+                f"{extra_headers}"
+                "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+                f"{json.dumps(payload)}\r\n"
+            )
+        chunks.append(f"--{boundary}--")
+        response = httplib2.Response(
+            {
+                "status": "200",
+                "content-type": f"multipart/mixed; boundary={boundary}",
+            }
+        )
+        return response, "".join(chunks).encode()
+
+    # api handlers
+
+    def get_message(self, query: dict, body: dict, id: str) -> Tuple[int, dict]:
+        message = self.messages.get(id)
+        if message is None:
+            return NOT_FOUND
+        return 200, shape_message(message, query)
+
+    def get_attachment(
+        self, query: dict, body: dict, message_id: str, id: str
+    ) -> Tuple[int, dict]:
+        message = self.messages.get(message_id)
+        for part in iter_parts(message["payload"]) if message else []:
+            if part["body"].get("attachmentId") == id:
+                return 200, {"size": part["body"]["size"], "data": part["body"]["data"]}
+        return NOT_FOUND
+
+    def list_messages(self, query: dict, body: dict) -> Tuple[int, dict]:
+        messages = list(self.messages.values())
+        # The only search operator the fake understands
+        match = re.search(r"rfc822msgid:<?([^\s>]+)", query.get("q", ""))
+        if match:
+            messages = [
+                m
+                for m in messages
+                if any(
+                    h["name"].lower() == "message-id"
+                    and h["value"].strip("<>") == match.group(1)
+                    for h in m["payload"]["headers"]
+                )
+            ]
+        refs = [{"id": m["id"], "threadId": m["threadId"]} for m in messages]
+        return 200, self._page(refs, "messages", query)
+
+    def batch_modify(self, query: dict, body: dict) -> Tuple[int, dict]:
+        if len(body["ids"]) > MAX_BULK_IDS:
+            return 400, error_payload(400, "Too many ids.", "invalidArgument")
+        with self.lock:
+            for id in body["ids"]:
+                if id in self.messages:
+                    self._modify_labels(self.messages[id], body)
+        return 200, {}
+
+    def modify_message(self, query: dict, body: dict, id: str) -> Tuple[int, dict]:
+        if id not in self.messages:
+            return NOT_FOUND
+        with self.lock:
+            self._modify_labels(self.messages[id], body)
+        return 200, shape_message(self.messages[id], {"format": "minimal"})
+
+    def trash_message(
+        self, query: dict, body: dict, id: str, action: str
+    ) -> Tuple[int, dict]:
+        return self.modify_message(query, TRASH_BODIES[action], id)
+
+    def delete_message(self, query: dict, body: dict, id: str) -> Tuple[int, dict]:
+        with self.lock:
+            message = self.messages.pop(id, None)
+        return NOT_FOUND if message is None else (200, {})
+
+    def modify_thread(
+        self, query: dict, body: dict, id: str, action: str
+    ) -> Tuple[int, dict]:
+        body = TRASH_BODIES.get(action, body)
+        with self.lock:
+            messages = [m for m in self.messages.values() if m["threadId"] == id]
+            for message in messages:
+                self._modify_labels(message, body)
+        if not messages:
+            return NOT_FOUND
+        minimal = {"format": "minimal"}
+        return 200, {
+            "id": id,
+            "messages": [shape_message(m, minimal) for m in messages],
+        }
+
+    def delete_thread(self, query: dict, body: dict, id: str) -> Tuple[int, dict]:
+        with self.lock:
+            ids = [m["id"] for m in self.messages.values() if m["threadId"] == id]
+            for message_id in ids:
+                del self.messages[message_id]
+        return (200, {}) if ids else NOT_FOUND
+
+    @staticmethod
+    def _modify_labels(message: dict, body: dict) -> None:
+        labels = dict.fromkeys(message.get("labelIds", []))
+        labels.update(dict.fromkeys(body.get("addLabelIds", [])))
+        for label_id in body.get("removeLabelIds", []):
+            labels.pop(label_id, None)
+        message["labelIds"] = list(labels)
+
+    def batch_delete(self, query: dict, body: dict) -> Tuple[int, dict]:
+        if len(body["ids"]) > MAX_BULK_IDS:
+            return 400, error_payload(400, "Too many ids.", "invalidArgument")
+        with self.lock:
+            for id in body["ids"]:
+                self.messages.pop(id, None)
+        return 200, {}
+
+    def send_message(self, query: dict, body: dict) -> Tuple[int, dict]:
+        return 200, self._send(urlsafe_b64decode(body["raw"]))
+
+    def get_thread(self, query: dict, body: dict, id: str) -> Tuple[int, dict]:
+        messages = [
+            shape_message(m, query)
+            for m in self.messages.values()
+            if m["threadId"] == id
+        ]
+        if not messages:
+            return NOT_FOUND
+        return 200, {"id": id, "historyId": "1", "messages": messages}
+
+    def list_threads(self, query: dict, body: dict) -> Tuple[int, dict]:
+        thread_ids = dict.fromkeys(m["threadId"] for m in self.messages.values())
+        refs = [{"id": id, "snippet": "", "historyId": "1"} for id in thread_ids]
+        return 200, self._page(refs, "threads", query)
+
+    def list_labels(self, query: dict, body: dict) -> Tuple[int, dict]:
+        return 200, {"labels": self.labels}
+
+    def create_label(self, query: dict, body: dict) -> Tuple[int, dict]:
+        with self.lock:
+            label = {
+                **{key: value for key, value in body.items() if value is not None},
+                "id": f"Label_{len(self.labels) + 1}",
+                "type": "user",
+            }
+            self.labels.append(label)
+        return 200, label
+
+    def patch_label(self, query: dict, body: dict, id: str) -> Tuple[int, dict]:
+        for label in self.labels:
+            if label["id"] == id:
+                label.update(body)
+                return 200, label
+        return NOT_FOUND
+
+    def delete_label(self, query: dict, body: dict, id: str) -> Tuple[int, dict]:
+        with self.lock:
+            self.labels = [label for label in self.labels if label["id"] != id]
+        return 200, {}
+
+    def list_history(self, query: dict, body: dict) -> Tuple[int, dict]:
+        start = int(query["startHistoryId"])
+        if start < self.oldest_history_id:
+            return NOT_FOUND
+        records = [record for record in self.history if int(record["id"]) > start]
+        result = self._page(records, "history", query)
+        result.pop("resultSizeEstimate")
+        result["historyId"] = str(self.history_id)
+        return 200, result
+
+    def get_profile(self, query: dict, body: dict) -> Tuple[int, dict]:
+        return 200, {
+            "emailAddress": "me@example.com",
+            "messagesTotal": len(self.messages),
+            "historyId": str(self.history_id),
+        }
+
+    @staticmethod
+    def _page(items: list, key: str, query: dict) -> dict:
+        start = int(query.get("pageToken") or 0)
+        end = start + int(query.get("maxResults") or 100)
+        result = {"resultSizeEstimate": len(items)}
+        if items[start:end]:
+            result[key] = items[start:end]
+        if end < len(items):
+            result["nextPageToken"] = str(end)
+        return result
+
+
+class AsyncFakeTransport:
+    """Async transport serving requests from a FakeGmailHttp
+
+    The latency of the fake is awaited instead of slept, so requests overlap
+    on the event loop like they would over the network.
+
+    Attributes:
+        in_flight (int): Requests being served now.
+        max_in_flight (int): The most requests served at the same time.
+    """
+
+    def __init__(self, http: FakeGmailHttp) -> None:
+        self.http = http
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def request(
+        self, method: str, uri: str, body=None, headers: Optional[dict] = None
+    ) -> Tuple[int, dict, bytes]:
+        with self.http.lock:
+            self.http.round_trips += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.http.latency:
+                await asyncio.sleep(self.http.latency)
+            response, content = self.http.respond(uri, method, body, headers)
+        finally:
+            self.in_flight -= 1
+        return response.status, dict(response), content
+
+    async def close(self) -> None:
+        pass
@@ -1,24 +1,39 @@
-import time
-from typing import List, Optional
+from typing import TYPE_CHECKING, Iterable, Iterator, List, Optional
 
-from googleapiclient.discovery import Resource
-
-from .client import GmailClient
+from .batch import MAX_BATCH_SIZE, BatchResult, execute_batched
+from .client import MAX_PAGE_SIZE, GmailClient, build_query_string
+from .idset import IdSet
 from .message import Message
+from .store import MessageStore
+from .writeback import current_queue
+
+if TYPE_CHECKING:
+    from googleapiclient.discovery import Resource
+
+    from .labelindex import LabelIndex
 
 
 class Thread:
-    """Thread ORM"""
+    """Thread ORM
+
+    The Message objects of the thread are built on first access of messages
+    and kept, so iterating them again does not build them again.
+    """
 
     def __init__(
         self,
         raw_data: dict,
-        client: Resource,
-        message_client: Resource,
+        client: "Resource",
+        message_client: "Resource",
+        metadata_headers: Optional[List[str]] = None,
+        label_index: Optional["LabelIndex"] = None,
     ) -> None:
         self.raw_data = raw_data
         self.client = client
         self.message_client = message_client
+        self.metadata_headers = metadata_headers
+        self.label_index = label_index
+        self._messages: Optional[List[Message]] = None
 
     @property
     def id(self):
@@ -26,10 +41,17 @@ class Thread:
 
     @property
     def messages(self) -> List[Message]:
-        return [
-            Message(message_data, self.message_client)
-            for message_data in self.raw_data["messages"]
-        ]
+        if self._messages is None:
+            self._messages = [
+                Message(
+                    message_data,
+                    self.message_client,
+                    self.metadata_headers,
+                    self.label_index,
+                )
+                for message_data in self.raw_data["messages"]
+            ]
+        return self._messages
 
     def delete(self):
         self.client.delete(userId="me", id=self.id).execute()
@@ -39,40 +61,199 @@ class Thread:
         add_label_ids: Optional[List[str]] = None,
         remove_label_ids: Optional[List[str]] = None,
     ):
+        """Modify the labels of the messages of this thread
+
+        Label names are accepted as well as ids when the thread was built by a
+        client, inside a ModifyQueue or not.
+        """
+        if self.label_index is not None:
+            add_label_ids = self.label_index.resolve(add_label_ids)
+            remove_label_ids = self.label_index.resolve(remove_label_ids)
         body = {}
         if add_label_ids:
             body["addLabelIds"] = add_label_ids
         if remove_label_ids:
             body["removeLabelIds"] = remove_label_ids
+        if self._queue_modify(add_label_ids, remove_label_ids):
+            return
         self.client.modify(userId="me", id=self.id, body=body).execute()
 
     def trash(self) -> None:
         """Move this thread to trash."""
+        if self._queue_modify(add_label_ids=["TRASH"]):
+            return
         self.client.trash(userId="me", id=self.id).execute()
 
     def untrash(self) -> None:
         """Untrash this thread."""
+        if self._queue_modify(remove_label_ids=["TRASH"]):
+            return
         self.client.untrash(userId="me", id=self.id).execute()
 
+    def _queue_modify(
+        self,
+        add_label_ids: Optional[List[str]] = None,
+        remove_label_ids: Optional[List[str]] = None,
+    ) -> bool:
+        """Record the change of every message on the current ModifyQueue, if any
+
+        Only the messages fetched with the thread are changed. Returns False
+        when there is no queue or the message ids were not fetched.
+        """
+        queue = current_queue()
+        messages = self.raw_data.get("messages")
+        if queue is None or not messages or any("id" not in m for m in messages):
+            return False
+        queue.add([m["id"] for m in messages], add_label_ids, remove_label_ids)
+        return True
+
 
 class ThreadClient(GmailClient):
     """Thread Client"""
 
-    def __init__(self, client_secret: dict, refresh_token: str) -> None:
-        super().__init__(client_secret, refresh_token)
+    def __init__(
+        self,
+        client_secret: Optional[dict] = None,
+        refresh_token: Optional[str] = None,
+        store: Optional[MessageStore] = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(client_secret, refresh_token, **kwargs)
         self.client = self.service.users().threads()
         self.message_client = self.service.users().messages()
+        self.store = store
 
     def delete(self, id: str):
         self.client.delete(userId="me", id=id).execute()
+        if self.store is not None:
+            self.store.delete_thread(id)
+
+    def _store_labels(self, thread: dict) -> None:
+        """Save the labels returned by a write of a thread to the store"""
+        if self.store is None:
+            return
+        for message in thread.get("messages", []):
+            if "labelIds" in message:
+                self.store.update_labels(message["id"], message["labelIds"])
+
+    def get(
+        self,
+        id: str,
+        format: str = "full",
+        metadata_headers: Optional[List[str]] = None,
+        fields: Optional[str] = None,
+    ) -> Thread:
+        """Get a thread and its messages
 
-    def get(self, id: str) -> Thread:
-        thread = self.client.get(userId="me", id=id).execute()
+        Arguments:
+            id (str): Thread id.
+            format (str): minimal, metadata or full. The format of the messages in the thread.
+            metadata_headers (list): Headers to return when format is metadata. None means all.
+            fields (str): Partial response mask. Ex. "id,messages(id,labelIds)"
+        """
+        if format == "raw":
+            raise ValueError("threads.get does not support the raw format.")
+        if self.store is not None and format == "full" and fields is None:
+            thread = self._get_with_store(id)
+        else:
+            thread = self.client.get(
+                **self._get_params(id, format, metadata_headers, fields)
+            ).execute()
         return Thread(
             raw_data=thread,
             client=self.client,
             message_client=self.message_client,
+            metadata_headers=metadata_headers,
+            label_index=self.label_index,
+        )
+
+    def get_many(
+        self,
+        ids: Iterable[str],
+        format: str = "full",
+        metadata_headers: Optional[List[str]] = None,
+        fields: Optional[str] = None,
+        batch_size: int = MAX_BATCH_SIZE,
+        max_workers: int = 4,
+    ) -> BatchResult:
+        """Get many threads with batch requests
+
+        Same as MessageClient.get_many, up to 100 threads per round trip. With
+        format=metadata only the headers are fetched, which is usually enough
+        to triage conversations. When there is a store, the fetched messages
+        are saved to it.
+
+        Arguments:
+            ids (Iterable[str]): Thread ids. Ex. the ids returned by iter_threads.
+            format (str): minimal, metadata or full. The format of the messages in the threads.
+            metadata_headers (list): Headers to return when format is metadata. None means all.
+            fields (str): Partial response mask applied to each thread.
+            batch_size (int): Threads per batch request, up to 100.
+            max_workers (int): Number of batch requests in flight.
+
+        Returns:
+            A BatchResult. results is a list of Thread in the same order as ids,
+            errors maps the id of each failed thread to its HttpError.
+        """
+        if format == "raw":
+            raise ValueError("threads.get does not support the raw format.")
+        result = execute_batched(
+            self,
+            ids,
+            lambda id: self.client.get(
+                **self._get_params(id, format, metadata_headers, fields)
+            ),
+            batch_size=batch_size,
+            max_workers=max_workers,
+        )
+        if self.store is not None and fields is None and not metadata_headers:
+            for thread in result.results:
+                for message in thread.get("messages", []):
+                    self.store.put(message, format=format)
+        result.results = [
+            Thread(
+                raw_data=thread,
+                client=self.client,
+                message_client=self.message_client,
+                metadata_headers=metadata_headers,
+                label_index=self.label_index,
+            )
+            for thread in result.results
+        ]
+        return result
+
+    def _get_with_store(self, id: str) -> dict:
+        """Get a thread, taking the content of its messages from the store
+
+        Only the ids and labels of the messages are requested. Messages missing
+        from the store are fetched with one batch request and saved.
+        """
+        thread = self.client.get(userId="me", id=id, format="minimal").execute()
+        messages = {}
+        for minimal in thread["messages"]:
+            message = self.store.get(minimal["id"])
+            if message is None:
+                continue
+            if message["historyId"] != minimal["historyId"]:
+                self.store.update_labels(
+                    minimal["id"], minimal["labelIds"], minimal["historyId"]
+                )
+            messages[minimal["id"]] = {**message, **minimal}
+
+        missing = [m["id"] for m in thread["messages"] if m["id"] not in messages]
+        result = execute_batched(
+            self,
+            missing,
+            lambda id: self.message_client.get(userId="me", id=id),
         )
+        if result.errors:
+            raise next(iter(result.errors.values()))
+        for message in result.results:
+            self.store.put(message)
+            messages[message["id"]] = message
+
+        thread["messages"] = [messages[m["id"]] for m in thread["messages"]]
+        return thread
 
     def list(
         self,
@@ -88,9 +269,10 @@ class ThreadClient(GmailClient):
     ):
         """Create a query string from arguments and query all the results
 
-        Each query has the max results. The default value is 100. To make the arguments simple,
-        we do not change the maxResults parameter. Instead, we add a exhausted parameter to let
-        user to decide if query to the end.
+        Without exhausted, one page is requested with the default maxResults of
+        gmail, 100, and nextPageToken tells how to get the next one. With
+        exhausted, pages of maxResults=500 are requested until the end, like
+        iter_threads does, and the threads are returned in one list.
 
         Ref:
             https://developers.google.com/gmail/api/reference/rest/v1/users.messages/list
@@ -113,21 +295,24 @@ class ThreadClient(GmailClient):
             nextPageToken: A token which is used to get next page data. If exhausted is True, this item will be empty string.
 
         """
-        # Build the query string
-        criteria_list = []
-        if search_string is not None:
-            criteria_list.append(search_string)
-        if before is not None:
-            criteria_list.append(f"before:{before}")
-        if after is not None:
-            criteria_list.append(f"after:{after}")
-        if read is not None:
-            criteria_list.append(f"is:{'read' if read else 'unread'}")
-        if from_ is not None:
-            criteria_list.append(f"from:{from_}")
-        if to is not None:
-            criteria_list.append(f"to:{to}")
-        query_string = " ".join(criteria_list)
+        query_string = build_query_string(
+            search_string=search_string,
+            before=before,
+            after=after,
+            read=read,
+            from_=from_,
+            to=to,
+        )
+
+        if exhausted:
+            # Throttling is done by the rate limiter under every request
+            total_result = self._iter_list(
+                "threads",
+                query_string=query_string,
+                include_spam_trash=include_spam_trash,
+                page_token=page_token,
+            )
+            return {"threads": list(total_result), "nextPageToken": ""}
 
         if query_string:
             result = self.client.list(
@@ -142,22 +327,85 @@ class ThreadClient(GmailClient):
                 pageToken=page_token,
                 includeSpamTrash=include_spam_trash,
             ).execute()
+        result.pop("resultSizeEstimate")
+        return result
+
+    def iter_threads(
+        self,
+        search_string: Optional[str] = None,
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        read: Optional[bool] = None,
+        from_: Optional[str] = None,
+        to: Optional[str] = None,
+        include_spam_trash: bool = False,
+        page_token: Optional[str] = None,
+        limit: Optional[int] = None,
+        page_size: int = MAX_PAGE_SIZE,
+    ) -> Iterator[dict]:
+        """Iterate over the threads matching the arguments
 
-        if not exhausted or (exhausted and not result.get("nextPageToken")):
-            result.pop("resultSizeEstimate")
-            return result
+        Unlike list with exhausted=True, threads are yielded as soon as each page
+        arrives and only one page is held in memory, so the memory usage does not
+        grow with the size of the mailbox.
 
-        total_result = result["threads"]
-        while result.get("nextPageToken"):
-            # max limit is 250 units per second
-            time.sleep(1)
-            result = self.client.list(
-                userId="me",
-                q=query_string,
-                pageToken=result["nextPageToken"],
-            ).execute()
-            total_result.extend(result["threads"])
-        return {"threads": total_result, "nextPageToken": ""}
+        Arguments:
+            search_string, before, after, read, from_, to: Same as list.
+            include_spam_trash (bool): Include threads from SPAM and TRASH.
+            page_token (str): Start from a specific page.
+            limit (int): Stop after this many threads. None means all of them.
+            page_size (int): Threads requested per page, up to 500.
+
+        Yields:
+            dict: The element of threads in list result. Ex. {"id": ..., "snippet": ..., "historyId": ...}
+
+        """
+        query_string = build_query_string(
+            search_string=search_string,
+            before=before,
+            after=after,
+            read=read,
+            from_=from_,
+            to=to,
+        )
+        return self._iter_list(
+            "threads",
+            query_string=query_string,
+            include_spam_trash=include_spam_trash,
+            page_token=page_token,
+            limit=limit,
+            page_size=page_size,
+        )
+
+    def list_ids(
+        self,
+        search_string: Optional[str] = None,
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        read: Optional[bool] = None,
+        from_: Optional[str] = None,
+        to: Optional[str] = None,
+        include_spam_trash: bool = False,
+    ) -> IdSet:
+        """Ids of the threads matching the arguments, packed in an IdSet
+
+        Pages are added to the IdSet as they arrive. The ids of 2M threads take
+        16 MB, instead of the hundreds of MB of list with exhausted=True.
+
+        Arguments:
+            search_string, before, after, read, from_, to, include_spam_trash: Same as iter_threads.
+        """
+        return IdSet.from_refs(
+            self.iter_threads(
+                search_string=search_string,
+                before=before,
+                after=after,
+                read=read,
+                from_=from_,
+                to=to,
+                include_spam_trash=include_spam_trash,
+            ),
+        )
 
     def modify(
         self,
@@ -165,17 +413,18 @@ class ThreadClient(GmailClient):
         add_label_ids: Optional[List[str]] = None,
         remove_label_ids: Optional[List[str]] = None,
     ) -> None:
+        """Modify the labels of a thread. Label names are accepted as well as ids."""
         body = {}
         if add_label_ids:
-            body["addLabelIds"] = add_label_ids
+            body["addLabelIds"] = self.label_index.resolve(add_label_ids)
         if remove_label_ids:
-            body["removeLabelIds"] = remove_label_ids
-        self.client.modify(userId="me", id=id, body=body).execute()
+            body["removeLabelIds"] = self.label_index.resolve(remove_label_ids)
+        self._store_labels(self.client.modify(userId="me", id=id, body=body).execute())
 
     def trash(self, id: str) -> None:
         """Move thread to trash."""
-        self.client.trash(userId="me", id=id).execute()
+        self._store_labels(self.client.trash(userId="me", id=id).execute())
 
     def untrash(self, id: str) -> None:
         """Untrash thread."""
-        self.client.untrash(userId="me", id=id).execute()
+        self._store_labels(self.client.untrash(userId="me", id=id).execute())
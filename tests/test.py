@@ -0,0 +1,1127 @@
+import asyncio
+import contextvars
+import email
+import io
+import json
+import mailbox
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from email import policy
+from pathlib import Path
+
+import pytest
+from google.oauth2.credentials import Credentials
+from googleapiclient.errors import HttpError
+from momomail.gmail.aio import (
+    AsyncLabelClient,
+    AsyncMessageClient,
+    AsyncThreadClient,
+)
+from momomail.gmail.export import Exporter
+from momomail.gmail.idset import IdSet
+from momomail.gmail.client import GmailSession, TokenCache
+from momomail.gmail.exceptions import (
+    FieldNotFetchedError,
+    LabelNotAvailableError,
+    LabelNotFoundError,
+    UnsupportedQueryError,
+)
+from momomail.gmail.merge import MailMerge, MailTemplate
+from momomail.gmail.message import Message, MessageClient
+from momomail.gmail.metrics import HistogramSink, PrometheusExporter
+from momomail.gmail.pipeline import Pipeline
+from momomail.gmail.pool import HttpPool, SharedCredentials
+from momomail.gmail.ratelimit import RateLimiter
+from momomail.gmail.retry import RetryPolicy
+from momomail.gmail.search import SearchIndex
+from momomail.gmail.store import MessageStore
+from momomail.gmail.sync import (
+    FullResync,
+    LabelsAdded,
+    LabelsRemoved,
+    MessageAdded,
+    MessageDeleted,
+    SyncEngine,
+)
+from momomail.gmail.testing import (
+    AsyncFakeTransport,
+    FakeGmailHttp,
+    error_payload,
+    fill_mailbox,
+    make_message,
+    make_session,
+)
+from momomail.gmail.thread import ThreadClient
+from momomail.gmail.writeback import ModifyQueue
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def make_client(
+    cls,
+    http: FakeGmailHttp,
+    rate_limiter: RateLimiter = None,
+    retry_policy: RetryPolicy = None,
+    store: MessageStore = None,
+):
+    session = make_session(http, rate_limiter, retry_policy)
+    if store is not None:
+        return cls(session=session, store=store)
+    return cls(session=session)
+
+
+def make_mailbox(count: int) -> FakeGmailHttp:
+    http = FakeGmailHttp()
+    for i in range(count):
+        http.add_message(make_message(f"{i:016x}", subject=f"subject {i}"))
+    return http
+
+
+def test_get_many_uses_one_round_trip_per_batch():
+    http = make_mailbox(250)
+    client = make_client(MessageClient, http)
+    ids = [f"{i:016x}" for i in reversed(range(250))]
+
+    result = client.get_many(ids)
+
+    assert http.round_trips == 3
+    assert len(http.calls) == 250
+    assert [message.id for message in result.results] == ids
+    assert all(isinstance(message, Message) for message in result.results)
+    assert result.errors == {}
+
+
+def test_get_many_reports_errors_per_id():
+    http = make_mailbox(3)
+    client = make_client(MessageClient, http)
+    ids = ["0000000000000000", "ffffffffffffffff", "0000000000000002"]
+
+    result = client.get_many(ids, batch_size=2)
+
+    assert http.round_trips == 2
+    assert [message.subject for message in result.results] == ["subject 0", "subject 2"]
+    assert list(result.errors) == ["ffffffffffffffff"]
+    assert result.errors["ffffffffffffffff"].resp.status == 404
+
+
+def test_iter_messages_streams_pages_of_500():
+    http = make_mailbox(1200)
+    client = make_client(MessageClient, http)
+
+    iterator = client.iter_messages()
+    first = next(iterator)
+    assert first["id"] == "0000000000000000"
+    assert http.round_trips == 1
+
+    assert len(list(iterator)) == 1199
+    assert http.round_trips == 3
+
+
+def test_iter_messages_stops_at_limit():
+    http = make_mailbox(1200)
+    client = make_client(MessageClient, http)
+
+    messages = list(client.iter_messages(limit=600))
+
+    assert len(messages) == 600
+    assert http.round_trips == 2
+
+
+def test_rate_limiter_allows_burst_then_paces():
+    clock = FakeClock()
+    limiter = RateLimiter(units_per_second=250, clock=clock, sleep=clock.sleep)
+
+    for _ in range(50):
+        assert limiter.acquire(5) == 0
+    # Concurrent callers queue up behind each other
+    assert limiter.reserve(5) == pytest.approx(0.02)
+    assert limiter.reserve(5) == pytest.approx(0.04)
+    clock.now += 0.04
+    assert limiter.acquire(5) == pytest.approx(0.02)
+    clock.now += 10
+    assert limiter.acquire(250) == 0
+
+
+def test_requests_are_charged_their_quota_units():
+    clock = FakeClock()
+    limiter = RateLimiter(units_per_second=100, clock=clock, sleep=clock.sleep)
+    client = make_client(MessageClient, make_mailbox(150), rate_limiter=limiter)
+
+    client.get("0000000000000000")
+    client.get_many([f"{i:016x}" for i in range(19)])
+    assert clock.sleeps == []
+
+    # messages.list costs 5 units, the bucket is 5 units short
+    client.list()
+    assert clock.sleeps == [pytest.approx(0.05)]
+
+
+def test_retry_honors_retry_after_and_counts_retries():
+    http = make_mailbox(1)
+    clock = FakeClock()
+    policy = RetryPolicy(sleep=clock.sleep, uniform=lambda low, high: low)
+    client = make_client(MessageClient, http, retry_policy=policy)
+    http.fail_next(status=429, retry_after="3")
+    http.fail_next(status=503, reason="backendError")
+
+    assert client.get("0000000000000000").id == "0000000000000000"
+    assert clock.sleeps == [3.0, 0.5]
+    assert policy.stats.retries == {"429 rateLimitExceeded": 1, "503 backendError": 1}
+
+
+def test_retry_gives_up_after_max_attempts():
+    http = make_mailbox(1)
+    policy = RetryPolicy(max_attempts=3, sleep=lambda seconds: None)
+    client = make_client(MessageClient, http, retry_policy=policy)
+    http.fail_next(times=3, status=403, reason="userRateLimitExceeded")
+
+    with pytest.raises(HttpError):
+        client.get("0000000000000000")
+    assert policy.stats.retries == {"403 userRateLimitExceeded": 2}
+    assert policy.stats.give_ups == {"403 userRateLimitExceeded": 1}
+
+
+def test_get_many_retries_failed_sub_requests_only():
+    http = make_mailbox(10)
+    client = make_client(MessageClient, http)
+    http.fail_next(times=2, status=500, reason="backendError")
+
+    result = client.get_many([f"{i:016x}" for i in range(10)])
+
+    assert len(result.results) == 10
+    assert result.errors == {}
+    assert http.round_trips == 2
+    assert len(http.calls) == 12
+
+
+def test_sync_engine_pulls_only_changes(tmp_path):
+    http = make_mailbox(3)
+    client = make_client(MessageClient, http)
+    state_path = str(tmp_path / "sync_state.json")
+
+    events = list(SyncEngine(client, state_path=state_path).sync())
+    assert events[0] == FullResync(history_id="1")
+    assert len(events) == 4
+
+    ref = {"id": "0000000000000001", "threadId": "0000000000000001"}
+    http.add_history(
+        labelsAdded=[
+            {
+                "message": {**ref, "labelIds": ["INBOX", "STARRED"]},
+                "labelIds": ["STARRED"],
+            }
+        ]
+    )
+    http.add_history(messagesDeleted=[{"message": ref}])
+    http.round_trips = 0
+
+    # A new engine picks up the saved history id
+    events = list(SyncEngine(client, state_path=state_path).sync())
+    assert events == [
+        LabelsAdded(
+            id=ref["id"],
+            thread_id=ref["threadId"],
+            label_ids=["STARRED"],
+            message_label_ids=["INBOX", "STARRED"],
+        ),
+        MessageDeleted(id=ref["id"], thread_id=ref["threadId"]),
+    ]
+    assert http.round_trips == 1
+
+
+def test_sync_engine_falls_back_to_full_resync_when_history_expired():
+    http = make_mailbox(2)
+    client = make_client(MessageClient, http)
+    engine = SyncEngine(client)
+    engine.history_id = "1"
+    http.add_history()
+    http.oldest_history_id = 2
+    http.messages[f"{1:016x}"]["labelIds"] = ["STARRED"]
+
+    events = list(engine.sync())
+
+    assert events[0] == FullResync(history_id="2")
+    # With their labels, which list does not return
+    assert events[1:] == [
+        MessageAdded(id=f"{i:016x}", thread_id=f"{i:016x}", label_ids=labels)
+        for i, labels in enumerate([["INBOX"], ["STARRED"]])
+    ]
+    assert engine.history_id == "2"
+
+
+def test_message_store_serves_warm_reads(tmp_path):
+    http = make_mailbox(5)
+    store = MessageStore(str(tmp_path / "messages.sqlite3"))
+    client = make_client(MessageClient, http, store=store)
+
+    client.get_many([f"{i:016x}" for i in range(3)])
+    http.round_trips = 0
+    message = client.get("0000000000000001")
+    result = client.get_many([f"{i:016x}" for i in range(5)])
+
+    assert message.subject == "subject 1"
+    assert [m.subject for m in result.results] == [f"subject {i}" for i in range(5)]
+    assert http.round_trips == 1
+    assert len(http.calls) == 5
+    assert len(store) == 5
+
+
+def test_message_store_updates_labels_and_evicts(tmp_path):
+    store = MessageStore(str(tmp_path / "messages.sqlite3"))
+    for i in range(20):
+        store.put(make_message(f"{i:016x}", body="x" * i))
+    store.update_labels("0000000000000000", ["STARRED"], history_id=7)
+
+    assert store.get("0000000000000000")["labelIds"] == ["STARRED"]
+    assert store.get("0000000000000000", min_history_id=8) is None
+    assert store.get("0000000000000000", format="raw") is None
+
+    store.max_size = store.size // 2
+    assert store.evict() > 0
+    assert store.size <= store.max_size
+    assert "0000000000000013" in store
+
+
+def test_message_store_keeps_the_richer_format(tmp_path):
+    store = MessageStore(str(tmp_path / "messages.sqlite3"))
+    full = make_message("0000000000000000", subject="kept")
+    full["historyId"] = "5"
+    store.put(full)
+    size = store.size
+
+    # A later minimal get only brings newer labels
+    minimal = {"id": full["id"], "threadId": full["threadId"], "historyId": "6"}
+    store.put({**minimal, "labelIds": ["STARRED"]}, format="minimal")
+    assert store.size == size
+    assert store.get(full["id"])["payload"] == full["payload"]
+    assert store.get(full["id"])["labelIds"] == ["STARRED"]
+
+    # Neither full nor raw covers the other, both are kept
+    store.put({**minimal, "raw": "cmF3"}, format="raw")
+    assert store.get(full["id"], format="raw")["raw"] == "cmF3"
+    assert "payload" not in store.get(full["id"], format="raw")
+    assert store.get(full["id"])["payload"] == full["payload"]
+    assert "raw" not in store.get(full["id"], format="metadata")
+    assert len(list(store.iter_messages(formats=("full", "metadata")))) == 1
+
+
+def test_client_writes_update_its_store(tmp_path):
+    http = make_mailbox(6)
+    http.add_message(make_message("00000000000000aa", thread_id="t1"))
+    store = MessageStore(str(tmp_path / "messages.sqlite3"))
+    client = make_client(MessageClient, http, store=store)
+    thread_client = make_client(ThreadClient, http, store=store)
+    ids = [f"{i:016x}" for i in range(6)]
+    client.get_many(ids + ["00000000000000aa"])
+    labels = lambda id: client.get(id).label_ids  # noqa: E731
+
+    client.modify(ids[0], add_label_ids=["STARRED"])
+    client.trash(ids[1])
+    client.batch_modify(ids[2:4], add_label_ids=["STARRED"], remove_label_ids=["INBOX"])
+    thread_client.modify("t1", add_label_ids=["IMPORTANT"])
+    assert labels(ids[0]) == ["INBOX", "STARRED"]
+    assert labels(ids[1]) == ["INBOX", "TRASH"]
+    assert labels(ids[3]) == ["STARRED"]
+    assert labels("00000000000000aa") == ["INBOX", "IMPORTANT"]
+    client.untrash(ids[1])
+    assert labels(ids[1]) == ["INBOX"]
+
+    size = store.size
+    client.delete(ids[4])
+    client.batch_delete([ids[5]])
+    thread_client.delete("t1")
+    assert [id in store for id in (ids[4], ids[5], "00000000000000aa")] == [False] * 3
+    assert 0 < store.size < size
+
+
+def test_get_partial_message_reports_fields_not_fetched():
+    client = make_client(MessageClient, make_mailbox(2))
+
+    message = client.get(
+        "0000000000000000", format="metadata", metadata_headers=["Subject"]
+    )
+    assert message.subject == "subject 0"
+    with pytest.raises(FieldNotFetchedError):
+        message.from_
+
+    result = client.get_many(["0000000000000001"], format="minimal")
+    assert result.results[0].label_ids == ["INBOX"]
+    with pytest.raises(FieldNotFetchedError):
+        result.results[0].subject
+
+    message = client.get("0000000000000001", fields="labelIds")
+    assert message.label_ids == ["INBOX"]
+    with pytest.raises(FieldNotFetchedError):
+        message.id
+
+
+def test_parts_are_fetched_lazily_and_saved_in_chunks(tmp_path):
+    http = FakeGmailHttp()
+    content = bytes(range(256)) * 1000
+    http.add_message(
+        make_message(
+            "0000000000000000", body="hello", attachments={"data.bin": content}
+        )
+    )
+    client = make_client(MessageClient, http)
+    message = client.get("0000000000000000")
+    http.round_trips = 0
+
+    text, attachment = message.parts
+    assert http.round_trips == 0
+    assert (text["type"], text["data"]) == ("text/plain", "hello")
+    assert (attachment.filename, attachment.size) == ("data.bin", len(content))
+
+    assert attachment.save(tmp_path / "data.bin", chunk_size=1000) == len(content)
+    assert (tmp_path / "data.bin").read_bytes() == content
+    assert attachment.data == content
+    assert http.round_trips == 2
+
+
+@pytest.mark.parametrize("format", ["maildir", "mbox", "eml"])
+def test_exporter_resumes_from_journal(tmp_path, format):
+    http = make_mailbox(30)
+    client = make_client(MessageClient, http)
+    path = tmp_path / "export"
+    ids = [f"{i:016x}" for i in range(30)]
+
+    stats = Exporter(client, path, format=format, batch_size=5).export(ids[:12])
+    assert stats.messages == 12 and stats.bytes > 0
+    stats = Exporter(client, path, format=format, batch_size=5).export(ids)
+    assert (stats.skipped, stats.messages) == (12, 18)
+
+    if format == "eml":
+        messages = [p.read_bytes() for p in sorted(path.iterdir())]
+        assert len(messages) == 30 and b"Subject: subject 0" in messages[0]
+    else:
+        box = mailbox.Maildir(path) if format == "maildir" else mailbox.mbox(path)
+        assert sorted(message["subject"] for message in box) == sorted(
+            f"subject {i}" for i in range(30)
+        )
+
+
+def test_batch_modify_splits_ids_into_chunks_and_reports_failures():
+    http = make_mailbox(2500)
+    client = make_client(MessageClient, http, retry_policy=RetryPolicy(max_attempts=1))
+    http.fail_next(1, status=400, reason="invalidArgument")
+
+    ids = (f"{i:016x}" for i in range(2500))
+    result = client.batch_modify(ids, add_label_ids=["STARRED"], max_workers=1)
+
+    assert len(http.calls) == 3
+    assert len(result.failed) == 1000 and len(result.succeeded) == 1500
+    assert result.succeeded[0] == f"{1000:016x}"
+    assert "STARRED" in http.messages[f"{2499:016x}"]["labelIds"]
+    assert "STARRED" not in http.messages[f"{0:016x}"]["labelIds"]
+
+
+def test_modify_queue_coalesces_message_and_thread_changes():
+    http = make_mailbox(30)
+    http.add_message(make_message("00000000000000aa", thread_id="t1"))
+    http.add_message(make_message("00000000000000ab", thread_id="t1"))
+    client = make_client(MessageClient, http)
+    thread_client = make_client(ThreadClient, http)
+    messages = client.get_many([f"{i:016x}" for i in range(30)]).results
+    thread = thread_client.get("t1", format="minimal")
+    calls = len(http.calls)
+
+    with ModifyQueue(client) as queue:
+        for message in messages[:20]:
+            message.modify(add_label_ids=["STARRED"], remove_label_ids=["INBOX"])
+        for message in messages[20:]:
+            message.trash()
+        messages[0].untrash()
+        thread.modify(add_label_ids=["STARRED"], remove_label_ids=["INBOX"])
+        assert len(http.calls) == calls
+
+    # STARRED/-INBOX, TRASH, and STARRED/-INBOX/-TRASH for the first message
+    assert len(http.calls) == calls + 3
+    assert queue.result.ok and len(queue.result.succeeded) == 32
+    assert "TRASH" in http.messages[f"{29:016x}"]["labelIds"]
+    assert "STARRED" in http.messages["00000000000000ab"]["labelIds"]
+    assert "INBOX" not in http.messages[f"{0:016x}"]["labelIds"]
+
+
+def test_modify_queue_flushes_on_size_and_time():
+    http = make_mailbox(10)
+    client = make_client(MessageClient, http)
+    messages = client.get_many([f"{i:016x}" for i in range(10)]).results
+    clock = FakeClock()
+    calls = len(http.calls)
+
+    with ModifyQueue(client, max_pending=4, max_delay=60, clock=clock) as queue:
+        for message in messages[:4]:
+            message.trash()
+        assert len(http.calls) == calls + 1 and len(queue) == 0
+        messages[4].trash()
+        clock.now += 60
+        messages[5].trash()
+        assert len(http.calls) == calls + 2
+    assert len(queue.result.succeeded) == 6
+
+
+def test_modify_queue_timer_names_and_worker_threads():
+    http = make_mailbox(6)
+    session = make_session(http)
+    client = session.messages()
+    label = session.labels().create("Receipts")
+    messages = client.get_many([f"{i:016x}" for i in range(6)]).results
+    labels_of = lambda i: http.messages[f"{i:016x}"]["labelIds"]  # noqa: E731
+
+    # Label names work the same outside and inside a queue, given by name and id
+    messages[0].modify(add_label_ids=["receipts"])
+    assert label["id"] in labels_of(0)
+    with ModifyQueue(client, max_delay=0.05) as queue:
+        messages[1].modify(add_label_ids=["Receipts"])
+        messages[1].modify(remove_label_ids=[label["id"]])
+        messages[2].modify(add_label_ids=["receipts"])
+        # Flushed by the timer, without another change or the exit
+        deadline = time.monotonic() + 5
+        while len(queue.result.succeeded) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(queue) == 0 and len(queue.result.succeeded) == 2
+    assert label["id"] not in labels_of(1) and label["id"] in labels_of(2)
+
+    calls = len(http.calls)
+    star = lambda message: message.modify(add_label_ids=["STARRED"])  # noqa: E731
+    with ModifyQueue(client) as queue, ThreadPoolExecutor(2) as executor:
+        # Worker threads do not see the queue unless they run in its context
+        executor.submit(star, messages[3]).result()
+        assert len(http.calls) == calls + 1
+        executor.submit(contextvars.copy_context().run, star, messages[4]).result()
+        executor.submit(queue.add, [messages[5].id], ["STARRED"]).result()
+        assert len(http.calls) == calls + 1 and len(queue) == 2
+    assert all("STARRED" in labels_of(i) for i in (3, 4, 5))
+
+
+def test_http_pool_keeps_one_gzip_transport_per_thread():
+    http = make_mailbox(8)
+    created = []
+
+    class Transport:
+        def __init__(self) -> None:
+            self.headers = []
+            created.append(self)
+
+        def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+            self.headers.append(headers)
+            return http.request(uri, method, body, headers, **kwargs)
+
+    session = make_session(http)
+    session._init_service(HttpPool(http_factory=Transport))
+    client = MessageClient(session=session)
+    barrier = threading.Barrier(4)
+
+    def get(id: str) -> str:
+        barrier.wait()
+        return client.get(id).id
+
+    ids = [f"{i:016x}" for i in range(8)]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        assert list(executor.map(get, ids)) == ids
+    assert len(created) == 4
+    headers = [h for transport in created for h in transport.headers]
+    assert all("gzip" in h["user-agent"] for h in headers)
+    assert all("gzip" in h["accept-encoding"] for h in headers)
+
+
+def test_shared_credentials_refresh_once_for_concurrent_requests(monkeypatch):
+    refreshes = []
+
+    def refresh(self, request):
+        time.sleep(0.05)
+        refreshes.append(request)
+        self.token = f"token-{len(refreshes)}"
+
+    monkeypatch.setattr(Credentials, "refresh", refresh)
+    credentials = SharedCredentials(
+        None,
+        refresh_token="refresh",
+        token_uri="https://oauth2.googleapis.com/token",
+        client_id="id",
+        client_secret="secret",
+    )
+
+    def authorize(_) -> str:
+        headers = {}
+        credentials.before_request(None, "GET", "https://example.com", headers)
+        return headers["authorization"]
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        assert set(executor.map(authorize, range(8))) == {"Bearer token-1"}
+    assert len(refreshes) == 1
+
+
+def test_session_shares_service_and_reuses_cached_token(tmp_path):
+    secret = {"installed": {"client_id": "id", "client_secret": "secret"}}
+    cache = TokenCache(str(tmp_path / "tokens.json"))
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    cache.save("id", "refresh", "cached", now + timedelta(hours=1))
+
+    session = GmailSession(secret, "refresh", token_cache=cache)
+    assert session.credentials.token == "cached" and session.credentials.valid
+    clients = [session.messages(), session.threads(), session.labels()]
+    assert all(client.service is session.service for client in clients)
+    assert GmailSession(secret, "other", token_cache=cache).credentials.token is None
+
+    # Refreshed tokens are saved for the next process
+    session.credentials.token = "refreshed"
+    session.credentials.expiry = now + timedelta(seconds=30)
+    session.credentials.on_refresh(session.credentials)
+    assert cache.load("id", "refresh") is None
+    assert TokenCache(cache.path, margin=0).load("id", "refresh")[0] == "refreshed"
+
+
+def test_label_index_resolves_names_without_extra_requests():
+    http = make_mailbox(3)
+    session = make_session(http)
+    labels, messages = session.labels(), session.messages()
+    label = labels.create("Receipts")
+    labels_listed = http.calls.count(("GET", "/gmail/v1/users/me/labels"))
+
+    messages.batch_modify([f"{i:016x}" for i in range(3)], add_label_ids=["receipts"])
+    messages.modify(
+        f"{0:016x}", add_label_ids=["STARRED"], remove_label_ids=["Receipts"]
+    )
+    labels.patch(label["id"], {"name": "Bills"})
+    messages.modify(f"{1:016x}", remove_label_ids=["Bills"])
+    assert labels.index.id_of("bills") == label["id"]
+    with pytest.raises(LabelNotFoundError):
+        messages.modify(f"{2:016x}", add_label_ids=["Receipts"])
+
+    # One listing for the index, one more when the unknown name was looked up
+    assert http.calls.count(("GET", "/gmail/v1/users/me/labels")) == labels_listed + 2
+    assert http.messages[f"{0:016x}"]["labelIds"] == ["INBOX", "STARRED"]
+    assert http.messages[f"{1:016x}"]["labelIds"] == ["INBOX"]
+    assert http.messages[f"{2:016x}"]["labelIds"] == ["INBOX", label["id"]]
+
+
+def test_label_index_looks_names_up_before_id_forms():
+    http = make_mailbox(1)
+    session = make_session(http)
+    labels, messages = session.labels(), session.messages()
+    # Named like the id another label will get
+    named = labels.create(f"Label_{len(http.labels) + 2}")
+    other = labels.create("Other")
+    assert other["id"] == named["name"]
+    labels.list()
+    listed = http.calls.count(("GET", "/gmail/v1/users/me/labels"))
+
+    messages.modify(f"{0:016x}", add_label_ids=[named["name"], "TRASH"])
+    assert http.messages[f"{0:016x}"]["labelIds"] == ["INBOX", named["id"], "TRASH"]
+    with pytest.raises(LabelNotFoundError):
+        labels.index.resolve(["Label_999"])
+    assert labels.index.resolve(["other", other["id"]]) == [other["id"], named["id"]]
+    # Loaded by LabelClient.list, listed again only for the unknown id
+    assert http.calls.count(("GET", "/gmail/v1/users/me/labels")) == listed + 1
+
+
+def test_thread_get_many_batches_and_keeps_messages(tmp_path):
+    http = make_mailbox(250)
+    store = MessageStore(str(tmp_path / "messages.sqlite3"))
+    client = make_client(ThreadClient, http, store=store)
+    ids = [f"{i:016x}" for i in range(250)] + ["missing"]
+
+    result = client.get_many(ids, format="metadata", metadata_headers=None)
+
+    assert http.round_trips == 3
+    assert [thread.id for thread in result.results] == ids[:250]
+    assert list(result.errors) == ["missing"]
+    thread = result.results[7]
+    assert thread.messages is thread.messages
+    assert thread.messages[0].subject == "subject 7"
+    assert store.get(f"{7:016x}", format="metadata")["id"] == f"{7:016x}"
+
+
+def test_async_gets_overlap_up_to_max_in_flight():
+    http = make_mailbox(1000)
+    http.latency = 0.05
+    transport = AsyncFakeTransport(http)
+    client = AsyncMessageClient(
+        session=make_session(http), transport=transport, max_in_flight=200
+    )
+    ids = [f"{i:016x}" for i in range(1000)] + ["missing"]
+
+    async def main():
+        start = time.perf_counter()
+        result = await client.get_many(ids, format="metadata")
+        listed = [ref["id"] async for ref in client.iter_messages(limit=700)]
+        return result, listed, time.perf_counter() - start
+
+    result, listed, seconds = asyncio.run(main())
+
+    assert [message.id for message in result.results] == ids[:1000]
+    assert list(result.errors) == ["missing"]
+    assert listed == ids[:700]
+    assert transport.max_in_flight == 200
+    # 1003 requests of 50ms each, 200 at a time
+    assert seconds < 2.0
+
+
+def test_async_clients_retry_and_resolve_label_names():
+    http = make_mailbox(3)
+    session = make_session(
+        http, retry_policy=RetryPolicy(uniform=lambda low, high: 0.0)
+    )
+    transport = AsyncFakeTransport(http)
+    labels = AsyncLabelClient(session=session, transport=transport)
+    messages = AsyncMessageClient(session=session, transport=transport)
+    http.fail_next(times=2, status=503, reason="backendError")
+
+    async def main():
+        label = await labels.create("Receipts")
+        result = await messages.batch_modify(
+            [f"{i:016x}" for i in range(3)], add_label_ids=["receipts"]
+        )
+        # System labels cannot be changed, as with LabelClient
+        for write in (labels.patch, labels.update):
+            with pytest.raises(LabelNotAvailableError):
+                await write("INBOX", {"name": "Inbox"})
+        await labels.patch(label["id"], {"name": "Bills"})
+        return label, result
+
+    label, result = asyncio.run(main())
+
+    assert result.ok
+    assert session.retry_policy.stats.retries == {"503 backendError": 2}
+    assert http.messages[f"{2:016x}"]["labelIds"] == ["INBOX", label["id"]]
+
+
+def test_async_clients_list_send_and_download_without_blocking(tmp_path):
+    http = make_mailbox(3)
+    content = bytes(range(256)) * 100
+    http.add_message(
+        make_message("00000000000000aa", body="hi", attachments={"a.bin": content})
+    )
+    session = make_session(http)
+    transport = AsyncFakeTransport(http)
+    messages = AsyncMessageClient(session=session, transport=transport)
+    threads = AsyncThreadClient(session=session, transport=transport)
+    report = tmp_path / "report.pdf"
+    report.write_bytes(bytes(range(256)) * 2048)
+
+    async def main():
+        listed = await messages.list(exhausted=True)
+        page = await threads.list()
+        message = await messages.get("00000000000000aa")
+        attachment = message.parts[1]
+        data = await messages.get_attachment(message.id, attachment.attachment_id)
+        small = await messages.send("a@example.com", subject="hi", content="hello")
+        large = await messages.send(
+            "a@example.com",
+            subject="report",
+            attachment_path=str(report),
+            resumable_threshold=256 * 1024,
+        )
+        return listed, page, data, small, large
+
+    listed, page, data, small, large = asyncio.run(main())
+
+    assert len(listed["messages"]) == 4 and listed["nextPageToken"] == ""
+    assert "resultSizeEstimate" not in page and len(page["threads"]) == 4
+    assert data == content
+    assert b"hello" in http.sent[small["id"]]
+    # Larger than resumable_threshold, uploaded in chunks from a worker thread
+    assert ("POST", "/upload/gmail/v1/users/me/messages/send") in http.calls
+    sent = email.message_from_bytes(http.sent[large["id"]], policy=policy.default)
+    assert next(sent.iter_attachments()).get_content() == report.read_bytes()
+
+
+def test_pipeline_overlaps_stages_and_bounds_memory():
+    http = make_mailbox(1000)
+    http.latency = 0.01
+    client = make_client(MessageClient, http)
+    handled = []
+
+    def handler(message):
+        time.sleep(0.001)
+        handled.append((message.id, http.round_trips))
+
+    pipeline = Pipeline(
+        client, handler, format="metadata", batch_size=50, fetch_workers=2
+    )
+    stats = pipeline.run(page_size=100)
+
+    assert sorted(id for id, _ in handled) == [f"{i:016x}" for i in range(1000)]
+    # Handling started before the last page of ids was listed
+    assert handled[0][1] < 10
+    # 20 batches of 50 and 10 pages, messages were not all fetched ahead
+    assert handled[500][1] < 30
+    assert stats.stages["handle"].items == 1000
+    assert stats.stages["list"].items == 1000
+    assert stats.bottleneck == "handle"
+
+
+def test_search_index_answers_list_criteria_and_follows_sync(tmp_path):
+    http = FakeGmailHttp()
+    messages = [
+        make_message(
+            "0000000000000001",
+            subject="Invoice for March",
+            from_="Bank <alerts@bank.com>",
+            date="Fri, 1 Mar 2024 10:00:00 +0000",
+            body="Amount due: 30 USD",
+            label_ids=["INBOX", "UNREAD"],
+        ),
+        make_message(
+            "0000000000000002",
+            subject="Invoice paid",
+            from_="alerts@bank.com",
+            date="Mon, 1 Apr 2024 10:00:00 +0000",
+            attachments={"receipt.pdf": b"%PDF"},
+        ),
+        make_message(
+            "0000000000000003",
+            subject="Lunch?",
+            from_="friend@example.com",
+            to="me@example.com, boss@example.com",
+            date="Wed, 1 May 2024 10:00:00 +0000",
+            label_ids=["TRASH"],
+        ),
+    ]
+    store = MessageStore(str(tmp_path / "messages.sqlite3"))
+    for message in messages:
+        store.put(message)
+    client = make_client(MessageClient, http)
+    index = SearchIndex.from_store(store)
+
+    def ids(**kwargs):
+        return [ref["id"][-1] for ref in index.search(**kwargs)]
+
+    assert ids(search_string="invoice") == ["2", "1"]
+    assert ids(from_="bank.com", read=False) == ["1"]
+    assert ids(search_string='"amount due" -paid') == ["1"]
+    assert ids(search_string="has:attachment", after="2024/3/15") == ["2"]
+    assert ids(before="2024/3/15") == ["1"]
+    assert ids(to="boss@example.com") == []
+    assert ids(to="boss@example.com", include_spam_trash=True) == ["3"]
+    with pytest.raises(UnsupportedQueryError):
+        index.search(search_string="invoice OR lunch")
+
+    http.add_message(
+        make_message("0000000000000004", subject="New invoice", from_="bank.com")
+    )
+    index.apply(MessageAdded(id="0000000000000004", thread_id="0000000000000004"))
+    index.apply(
+        LabelsRemoved(
+            id="0000000000000001",
+            thread_id="0000000000000001",
+            label_ids=["UNREAD"],
+            message_label_ids=["INBOX"],
+        )
+    )
+    index.apply(MessageDeleted(id="0000000000000002", thread_id="0000000000000002"))
+    assert index.pending == {"0000000000000004"}
+    http.round_trips = 0
+
+    assert index.fetch_pending(client) == {}
+    assert http.round_trips == 1
+    assert ids(search_string="invoice") == ["1", "4"]
+    assert ids(search_string="subject:new invoice", read=True) == ["4"]
+
+
+def test_send_streams_attachments_and_resumes_upload(tmp_path):
+    http = FakeGmailHttp()
+    client = make_client(MessageClient, http)
+    report = tmp_path / "report.pdf"
+    report.write_bytes(bytes(range(256)) * 4096)
+
+    small = client.send("a@example.com", subject="hi", content="hello")
+    assert http.calls[-1] == ("POST", "/gmail/v1/users/me/messages/send")
+    assert b"hello" in http.sent[small["id"]]
+
+    http.calls = []
+    # The second chunk fails once and is resent after a status query
+    http.fail_next(status=503, reason="backendError", skip=2)
+    sent = client.send(
+        "a@example.com",
+        subject="report",
+        content="attached",
+        attachment_path=str(report),
+        attachments=[("notes.txt", io.BytesIO(b"notes"))],
+        resumable_threshold=256 * 1024,
+        chunk_size=512 * 1024,
+    )
+
+    message = email.message_from_bytes(http.sent[sent["id"]], policy=policy.default)
+    parts = list(message.iter_attachments())
+    assert [part.get_filename() for part in parts] == ["report.pdf", "notes.txt"]
+    assert parts[0].get_content() == report.read_bytes()
+    assert http.calls[0][1] == "/upload/gmail/v1/users/me/messages/send"
+    # Session start, 3 chunks, 1 failure and 1 status query
+    assert len(http.calls) == 6
+
+
+def test_mail_merge_sends_each_recipient_once_across_crashes(tmp_path):
+    http = FakeGmailHttp()
+    client = make_client(MessageClient, http)
+    template = MailTemplate(
+        subject="Invoice for {name}",
+        content="Hi {name}, you owe {amount:.2f}.",
+        attachments=[("terms.txt", io.BytesIO(b"terms"))],
+    )
+    records = [
+        {"email": f"user{i}@example.com", "name": f"User {i}", "amount": i}
+        for i in range(5)
+    ]
+    journal_path = tmp_path / "march.journal"
+
+    def merge(**kwargs):
+        return MailMerge(client, template, "march", journal_path=journal_path, **kwargs)
+
+    result = merge(max_sends=3).send(records + [{"email": "broken@example.com"}])
+    assert result.counts == {"sent": 3, "deferred": 3}
+    assert list(result.statuses) == [r["email"] for r in records] + [
+        "broken@example.com"
+    ]
+
+    # Crash: user2 was sent but not journaled, user3 was about to be sent
+    lines = journal_path.read_text().splitlines()
+    lines = [line for line in lines if not ('"user2@' in line and '"sent"' in line)]
+    lines.append(
+        json.dumps(
+            {
+                "key": "user3@example.com",
+                "status": "sending",
+                "message_id": merge().message_id("user3@example.com"),
+                "id": None,
+            }
+        )
+    )
+    journal_path.write_text("\n".join(lines) + "\n")
+
+    result = merge().send(records + [{"email": "broken@example.com"}])
+
+    statuses = {key: status.status for key, status in result.statuses.items()}
+    assert statuses == {
+        "user0@example.com": "already_sent",
+        "user1@example.com": "already_sent",
+        "user2@example.com": "already_sent",
+        "user3@example.com": "sent",
+        "user4@example.com": "sent",
+        "broken@example.com": "failed",
+    }
+    assert isinstance(result.statuses["broken@example.com"].error, KeyError)
+    assert len(http.sent) == 5
+    message = email.message_from_bytes(
+        http.sent[result.statuses["user4@example.com"].id], policy=policy.default
+    )
+    assert message["To"] == "user4@example.com"
+    assert message.get_body().get_content() == "Hi User 4, you owe 4.00.\n"
+    assert [part.get_content() for part in message.iter_attachments()] == ["terms"]
+
+
+def test_mail_merge_looks_up_a_send_answered_with_5xx_before_resending(tmp_path):
+    http = FakeGmailHttp()
+    client = make_client(
+        MessageClient, http, retry_policy=RetryPolicy(sleep=lambda seconds: None)
+    )
+    answers = [503, 500]
+
+    def send_then_fail(query: dict, body: dict):
+        # Delivered, then answered with an error
+        status, message = http.send_message(query, body)
+        if answers:
+            status = answers.pop(0)
+            return status, error_payload(status, "Backend Error", "backendError")
+        return status, message
+
+    http.route("POST", r"/gmail/v1/users/me/messages/send", send_then_fail)
+    merge = MailMerge(
+        client,
+        MailTemplate(subject="Hi {name}", content="Hello"),
+        "retries",
+        journal_path=tmp_path / "retries.journal",
+    )
+    result = merge.send([{"email": "a@example.com", "name": "A"}])
+
+    status = result.statuses["a@example.com"]
+    assert status.status == "sent" and status.id in http.sent
+    assert len(http.sent) == 1 and answers == [500]
+
+
+def test_instrumentation_reports_every_attempt_batch_and_sub_request():
+    http = make_mailbox(150)
+    session = make_session(http)
+    client = session.messages()
+    events = []
+    histogram = HistogramSink()
+    client.get("0000000000000000")
+    assert events == []
+
+    session.instrumentation.add_sink(events.append)
+    session.instrumentation.add_sink(histogram)
+    http.fail_next(status=429)
+    client.get("0000000000000000")
+    # One sub-request of a batch is rate limited and retried in a batch of its own
+    http.fail_next(status=429, skip=10)
+    client.get_many([f"{i:016x}" for i in range(150)], format="minimal")
+
+    get_events = [e for e in events if e.method == "gmail.users.messages.get"]
+    # Sub-requests have events of their own, their bytes count in the batch
+    direct = [e for e in get_events if e.bytes_received > 0]
+    assert [(e.status, e.attempt, e.error) for e in direct] == [
+        (429, 1, "rateLimitExceeded"),
+        (200, 2, None),
+    ]
+    sub_requests = [e for e in get_events if e.bytes_received == 0]
+    assert len(sub_requests) == 151
+    assert [
+        (e.status, e.attempt, e.error) for e in sub_requests if e.attempt > 1 or e.error
+    ] == [(429, 1, "rateLimitExceeded"), (200, 2, None)]
+    batches = [e for e in events if e.method == "batch"]
+    assert sorted(e.batch_size for e in batches) == [1, 50, 100]
+    assert sum(e.quota_units for e in batches) == 0
+    assert sum(e.quota_units for e in get_events) == 153 * 5
+    assert all(e.bytes_sent > 0 and e.bytes_received > 0 for e in batches)
+
+    text = PrometheusExporter(histogram).render()
+    assert (
+        'momomail_requests_total{method="gmail.users.messages.get",status="429"} 2'
+        in text
+    )
+    assert 'momomail_request_seconds_count{method="batch"} 3' in text
+    assert 'momomail_quota_units_total{method="gmail.users.messages.get"} 765' in text
+
+
+def test_generated_mailbox_is_reproducible_and_survives_quota_errors():
+    http = FakeGmailHttp()
+    ids = fill_mailbox(http, 200, seed=7, max_attachment_size=5000)
+    other = FakeGmailHttp()
+    assert fill_mailbox(other, 200, seed=7, max_attachment_size=5000) == ids
+    assert other.messages == http.messages
+    mime_types = {m["payload"]["mimeType"] for m in http.messages.values()}
+    assert mime_types >= {"text/plain", "multipart/alternative", "multipart/mixed"}
+
+    client = make_session(http).messages()
+    assert [m["id"] for m in client.iter_messages()] == ids
+    http.error_rate = 0.05
+    messages = client.get_many(ids).results
+    assert http.quota_errors > 0
+    assert [m.id for m in messages] == ids
+    attachments = [p for m in messages for p in m.parts if p.type == "attachment"]
+    assert attachments and all(len(p.content) == p.size for p in attachments[:10])
+
+
+def test_id_set_packs_ids_and_feeds_bulk_calls(tmp_path):
+    http = FakeGmailHttp()
+    ids = [f"{i:016x}" for i in range(1, 2501)]
+    for id in ids:
+        http.add_message(make_message(id, thread_id=f"{int(id, 16) % 7 + 1:016x}"))
+    client = make_session(http).messages()
+
+    listed = client.list_ids()
+    assert len(listed) == 2500 and list(listed) == ids
+    assert len(client.list_ids(key="threadId")) == 7
+    # Pages added twice are deduplicated
+    listed.update(ids[:500])
+    assert len(listed) == 2500 and ids[0] in listed and "x" not in listed
+
+    keep = IdSet(ids[:1000])
+    trash = listed - keep
+    assert len(trash) == 1500 and len(trash & keep) == 0
+    assert trash | keep == listed
+    trash.save(tmp_path / "trash.ids")
+    assert (tmp_path / "trash.ids").stat().st_size == 16 + 8 * 1500
+    trash = IdSet.load(tmp_path / "trash.ids")
+
+    result = client.batch_trash(trash)
+    assert isinstance(result.succeeded, IdSet) and result.succeeded == trash
+    assert sum("TRASH" in m["labelIds"] for m in http.messages.values()) == 1500
+
+    with pytest.raises(ValueError):
+        IdSet(["not-an-id"])
+
+
+def test_importing_the_clients_does_not_load_googleapiclient():
+    code = (
+        "import sys, momomail.gmail, momomail.gmail.message, momomail.gmail.thread, "
+        "momomail.gmail.sync, momomail.gmail.search, momomail.gmail.idset; "
+        "print('googleapiclient' in sys.modules)"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+        # The repository root, where momomail is importable
+        cwd=Path(__file__).resolve().parent.parent,
+    ).stdout
+    assert output.strip() == "False"
+
+
+def test_message_header_index_and_release_payload():
+    raw = make_message(
+        "0000000000000001",
+        subject="Hi",
+        body="hello",
+        label_ids=["INBOX", "UNREAD"],
+        attachments={"a.txt": b"data"},
+    )
+    raw["payload"]["headers"] += [
+        {"name": "X-Mailer", "value": "first"},
+        {"name": "x-mailer", "value": "second"},
+    ]
+    message = Message(raw, None)
+    assert message.header("X-MAILER") == "first"
+    assert message.header("subject") == message.header("Subject") == "Hi"
+    assert message.header("X-Missing") is None
+    assert message.subject == "Hi" and len(message.parts) == 2
+
+    message.release_payload()
+    assert "payload" not in message.raw_data
+    with pytest.raises(FieldNotFetchedError):
+        message.body
+    with pytest.raises(FieldNotFetchedError):
+        message.parts
+    assert message.id == "0000000000000001"
+    assert message.label_ids == ["INBOX", "UNREAD"]
+    assert message.subject == "Hi" and message.from_ == "sender@example.com"
+    assert message.header("x-mailer") == "first"
+
+
+def test_search_index_edge_cases_stay_local(tmp_path):
+    http = FakeGmailHttp()
+    http.labels.append({"id": "Label_9", "name": "Receipts", "type": "user"})
+    store = MessageStore(str(tmp_path / "messages.sqlite3"))
+    # Stored newest first, the index sorts the dates once
+    for day in (3, 2, 1):
+        store.put(
+            make_message(
+                f"000000000000000{day}",
+                subject=f"Receipt {day}",
+                date=f"Mon, {day} Jan 2024 00:00:00 +0000",
+                label_ids=["Label_9"],
+            )
+        )
+    store.put(make_message("0000000000000009", subject="Receipt"), format="minimal")
+    store.put(make_message("0000000000000008", subject="Receipt"), format="raw")
+    label_index = make_session(http).label_index
+    index = SearchIndex.from_store(store, label_index)
+    assert len(index) == 3
+    assert [r["id"][-1] for r in index.search(after="2024/1/1")] == ["3", "2", "1"]
+
+    for query in ('""', 'subject:""', "-from:"):
+        with pytest.raises(UnsupportedQueryError):
+            index.search(search_string=query)
+    # Labels were never listed, so the name is not looked up with a request
+    with pytest.raises(UnsupportedQueryError):
+        index.search(search_string="label:receipts")
+    assert http.round_trips == 0
+    label_index.refresh()
+    assert len(index.search(search_string="label:receipts")) == 3